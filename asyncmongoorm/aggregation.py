@@ -0,0 +1,155 @@
+# coding: utf-8
+"""Aggregation pipelines.
+
+:meth:`Manager.aggregate <asyncmongoorm.manager.Manager.aggregate>` starts
+a :class:`Pipeline`; each stage method appends a stage and returns the
+pipeline, and :meth:`Pipeline.run` sends it as an ``aggregate`` command::
+
+    Sale.objects.aggregate() \\
+        .match({'paid': True}) \\
+        .group('$store', total={'$sum': '$amount'}, sales={'$sum': 1}) \\
+        .sort('-total') \\
+        .limit(10) \\
+        .run(callback=self.on_totals)
+
+The field names of the stages, and the ``$field`` paths of their
+expressions, are checked against the fields of the model as the pipeline
+reshapes its documents: after a ``group`` only ``_id`` and the
+accumulators are known, after a ``project`` only the projected fields.
+A misspelled name raises ValueError before anything is sent.
+"""
+from bson.son import SON
+
+LOGICAL_OPERATORS = ('$and', '$or', '$nor')
+
+
+class Pipeline(object):
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.model = manager.collection
+        self.stages = []
+        self.fields = set(field.name for field in self.model._fields) | set(['_id'])
+
+    def _check(self, name, fields=None):
+        fields = self.fields if fields is None else fields
+        if name.split('.')[0] not in fields:
+            raise ValueError("%s is not a field of the %s pipeline" % (name, self.model.__name__))
+
+    def _check_expression(self, expression):
+        if isinstance(expression, basestring):
+            # $$ names a variable, not a field
+            if expression.startswith('$') and not expression.startswith('$$'):
+                self._check(expression[1:])
+        elif isinstance(expression, dict):
+            for value in expression.values():
+                self._check_expression(value)
+        elif isinstance(expression, (list, tuple)):
+            for value in expression:
+                self._check_expression(value)
+
+    def _check_query(self, query):
+        for name, condition in query.iteritems():
+            if name in LOGICAL_OPERATORS:
+                for clause in condition:
+                    self._check_query(clause)
+            elif not name.startswith('$'):
+                self._check(name)
+
+    def match(self, query):
+        self._check_query(query)
+        self.stages.append({'$match': query})
+        return self
+
+    def project(self, *fields, **spec):
+        """Keeps `fields` and computes the expressions of `spec`; a value
+        of 0 excludes a field instead."""
+        spec = dict(dict((name, 1) for name in fields), **spec)
+        kept = set()
+        for name, value in spec.iteritems():
+            if value in (0, 1, True, False):
+                self._check(name)
+            else:
+                self._check_expression(value)
+            if value not in (0, False):
+                kept.add(name.split('.')[0])
+        if kept - set(['_id']):
+            if spec.get('_id', 1):
+                kept.add('_id')
+            self.fields = kept
+        else:
+            self.fields = self.fields - set(name for name, value in spec.iteritems() if value in (0, False))
+        self.stages.append({'$project': spec})
+        return self
+
+    def group(self, _id, **accumulators):
+        """Groups by the expression `_id`, computing each accumulator, such
+        as ``total={'$sum': '$amount'}``."""
+        self._check_expression(_id)
+        for name, accumulator in accumulators.iteritems():
+            if not isinstance(accumulator, dict) or len(accumulator) != 1:
+                raise ValueError("%s must be a single accumulator such as {'$sum': 1}" % name)
+            self._check_expression(accumulator.values()[0])
+        self.stages.append({'$group': dict(accumulators, _id=_id)})
+        self.fields = set(accumulators) | set(['_id'])
+        return self
+
+    def sort(self, *keys):
+        """Sorts by `keys`, each a name, ``'-name'`` for descending order or
+        a ``(name, direction)`` pair."""
+        spec = SON()
+        for key in keys:
+            if isinstance(key, basestring):
+                key = (key[1:], -1) if key.startswith('-') else (key, 1)
+            name, direction = key
+            self._check(name)
+            spec[name] = direction
+        self.stages.append({'$sort': spec})
+        return self
+
+    def skip(self, count):
+        self.stages.append({'$skip': int(count)})
+        return self
+
+    def limit(self, count):
+        self.stages.append({'$limit': int(count)})
+        return self
+
+    def unwind(self, name, preserve_empty=False):
+        """Emits a document per element of the array `name`."""
+        self._check(name)
+        if preserve_empty:
+            self.stages.append({'$unwind': {'path': '$' + name, 'preserveNullAndEmptyArrays': True}})
+        else:
+            self.stages.append({'$unwind': '$' + name})
+        return self
+
+    def lookup(self, from_, local_field, foreign_field, as_):
+        """Stores in `as_` the documents of `from_`, a model or a collection
+        name, whose `foreign_field` equals `local_field`."""
+        self._check(local_field)
+        if isinstance(from_, basestring):
+            collection = from_
+        else:
+            self._check(foreign_field, set(field.name for field in from_._fields) | set(['_id']))
+            collection = from_.__collection__
+        self.stages.append({'$lookup': SON([('from', collection), ('localField', local_field),
+                                            ('foreignField', foreign_field), ('as', as_)])})
+        self.fields = self.fields | set([as_.split('.')[0]])
+        return self
+
+    def run(self, callback, batch_size=None, allow_disk_use=False, hydrate=False, on_batch=None, timeout=None):
+        """Runs the pipeline and calls back with its rows, read from the
+        server's cursor `batch_size` at a time. With `on_batch`, every batch
+        is handed to ``on_batch(rows)`` as it arrives and `callback` gets
+        the number of rows. `hydrate` turns the rows into instances of the
+        model, or of the model it names. `timeout` applies to each batch.
+
+        When the server fails the pipeline, or a batch after the first,
+        `callback` gets the rows, or the number of rows, read until then
+        and ``error``, the :exc:`asyncmongo.errors.DatabaseError`."""
+        model = None
+        if hydrate:
+            model = self.model if hydrate is True else hydrate
+        self.manager.run_pipeline(self.stages, callback, batch_size=batch_size, allow_disk_use=allow_disk_use,
+                                  model=model, on_batch=on_batch, timeout=timeout)
@@ -69,6 +69,7 @@ but it will be faster as there is less recursion.
 """
 
 import base64
+import calendar
 import datetime
 import re
 
@@ -105,7 +106,8 @@ def dumps(obj, json_lib=json, *args, **kwargs):
     """
     if not _json_lib_imported:
         raise Exception("No json library available")
-    return json_lib.dumps(normalize(obj), *args, **kwargs)
+    convert = strict_default if kwargs.pop('strict', False) else default
+    return json_lib.dumps(normalize(obj, convert), *args, **kwargs)
 
 
 def loads(s, json_lib=json, *args, **kwargs):
@@ -115,20 +117,21 @@ def loads(s, json_lib=json, *args, **kwargs):
     """
     if not _json_lib_imported:
         raise Exception("No json library available")
-    kwargs['object_hook'] = object_hook
+    kwargs['object_hook'] = object_hook if kwargs.pop('tz_aware', True) else naive_object_hook
     return json_lib.loads(s, *args, **kwargs)
 
 
-def normalize(obj):
+def normalize(obj, convert=None):
     """Recursive helper method that converts BSON types so they can be
-    converted into json.
+    converted into json, with `convert` (:func:`default` unless given).
     """
+    convert = convert or default
     if hasattr(obj, 'iteritems') or hasattr(obj, 'items'):  # PY3 support
-        return dict(((k, normalize(v)) for k, v in obj.iteritems()))
+        return dict(((k, normalize(v, convert)) for k, v in obj.iteritems()))
     elif hasattr(obj, '__iter__') and not isinstance(obj, string_types):
-        return list((normalize(v) for v in obj))
+        return list((normalize(v, convert) for v in obj))
     try:
-        return default(obj)
+        return convert(obj)
     except TypeError:
         return obj
 
@@ -161,6 +164,15 @@ def object_hook(dct):
     return dct
 
 
+def naive_object_hook(dct):
+    """Like :func:`object_hook`, with dates as naive UTC datetimes, the way
+    the driver decodes them."""
+    value = object_hook(dct)
+    if isinstance(value, datetime.datetime):
+        return value.replace(tzinfo=None)
+    return value
+
+
 def default(obj):
     if isinstance(obj, ObjectId):
         # return { "$oid": str(obj) }
@@ -199,4 +211,19 @@ def default(obj):
                 '$type': 0}
     if bson.has_uuid() and isinstance(obj, bson.uuid.UUID):
         return {"$uuid": obj.hex}
-    raise TypeError("%r is not JSON serializable" % obj)
\ No newline at end of file
+    raise TypeError("%r is not JSON serializable" % obj)
+
+
+def strict_default(obj):
+    """Like :func:`default`, but in the *Strict* mode that :func:`loads`
+    reads back: ObjectIds as ``$oid`` and datetimes as ``$date``
+    milliseconds."""
+    if isinstance(obj, ObjectId):
+        return {"$oid": str(obj)}
+    if isinstance(obj, datetime.datetime):
+        if obj.utcoffset() is not None:
+            obj = obj - obj.utcoffset()
+        millis = int(calendar.timegm(obj.timetuple()) * 1000 +
+                     obj.microsecond / 1000)
+        return {"$date": millis}
+    return default(obj)
@@ -0,0 +1,195 @@
+# coding: utf-8
+"""Concurrency limits (bulkheads) for the calls of
+:class:`~asyncmongoorm.manager.Manager`.
+
+A :class:`Bulkhead` lets `limit` calls run at a time and queues up to
+`queue` more, so an expensive operation of one model can not take every
+pooled connection away from the others::
+
+    from asyncmongoorm import bulkhead
+    bulkhead.limit(2, model=Report, operation='map_reduce', queue=10, queue_timeout=1.0)
+    bulkhead.limit(40, queue=200)
+
+A call uses the most specific bulkhead configured for its model and
+operation: model and operation, model, operation, then the default one.
+A full queue raises :exc:`Rejected` right away; a call waiting longer
+than `queue_timeout`, or than its deadline, fails with
+:exc:`QueueTimeout`.
+
+Queued calls are admitted by priority, lowest first, then in order of
+arrival. The priority is set for a block of code and the callbacks it
+spawns with :func:`priority`::
+
+    with bulkhead.priority(bulkhead.BACKGROUND):
+        Event.objects.find({'processed': False}, callback=self.on_events)
+"""
+import heapq
+import itertools
+import threading
+import time
+from functools import partial
+
+from tornado import stack_context
+from tornado.ioloop import IOLoop
+from tornado.stack_context import StackContext
+
+from asyncmongoorm import deadline
+from asyncmongoorm import metrics
+
+INTERACTIVE = 0
+BACKGROUND = 10
+
+
+class Rejected(Exception):
+    pass
+
+
+class QueueTimeout(deadline.DeadlineExceeded):
+    pass
+
+
+class _ScopeState(threading.local):
+    def __init__(self):
+        self.priority = INTERACTIVE
+_scope = _ScopeState()
+
+class _PriorityScope(object):
+
+    def __init__(self, priority):
+        self.priority = priority
+
+    def __enter__(self):
+        self.previous = _scope.priority
+        _scope.priority = self.priority
+
+    def __exit__(self, type, value, traceback):
+        _scope.priority = self.previous
+
+def priority(level):
+    """Returns a StackContext queueing the calls made inside it, and inside
+    the callbacks it spawns, with priority `level`."""
+    return StackContext(partial(_PriorityScope, level))
+
+def current_priority():
+    return _scope.priority
+
+
+class Bulkhead(object):
+
+    def __init__(self, limit, queue=100, queue_timeout=None, name=None):
+        self.limit = limit
+        self.queue = queue
+        self.queue_timeout = queue_timeout
+        self.name = name
+        self.active = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.peak_queue = 0
+        self._waiting = []
+        self._order = itertools.count()
+
+    def acquire(self, callback, priority=None, wait=None):
+        """Calls ``callback()`` once a slot is free, or
+        ``callback(error=QueueTimeout(...))`` when the wait exceeds
+        `queue_timeout` or `wait` seconds."""
+        if self.active < self.limit and not self._waiting:
+            self.active += 1
+            self.admitted += 1
+            callback()
+            return
+        if len(self._waiting) >= self.queue:
+            self.rejected += 1
+            raise Rejected("%s has %d calls running and %d queued" % (self.name, self.active, len(self._waiting)))
+
+        if priority is None:
+            priority = current_priority()
+        # the call is admitted from the callback of another one
+        entry = [priority, next(self._order), stack_context.wrap(callback), None]
+        heapq.heappush(self._waiting, entry)
+        self.queued += 1
+        self.peak_queue = max(self.peak_queue, len(self._waiting))
+        timeouts = [t for t in (self.queue_timeout, wait) if t is not None]
+        if timeouts:
+            entry[3] = IOLoop.instance().add_timeout(time.time() + min(timeouts), partial(self._expire, entry))
+
+    def _expire(self, entry):
+        entry[3] = None
+        self._waiting.remove(entry)
+        heapq.heapify(self._waiting)
+        self.timed_out += 1
+        entry[2](error=QueueTimeout("%s did not admit the call in time" % self.name))
+
+    def release(self):
+        self.active -= 1
+        io_loop = IOLoop.instance()
+        while self._waiting and self.active < self.limit:
+            entry = heapq.heappop(self._waiting)
+            if entry[3] is not None:
+                io_loop.remove_timeout(entry[3])
+            self.active += 1
+            self.admitted += 1
+            io_loop.add_callback(entry[2])
+
+    def call(self, timeout, method, *args, **kwargs):
+        """:func:`deadline.call <asyncmongoorm.deadline.call>` once the call
+        is admitted; the time spent queued counts against `timeout`."""
+        callback = kwargs.pop('callback')
+        started = time.time()
+
+        def admitted(error=None):
+            if error is not None:
+                callback(None, error=error)
+                return
+            left = timeout
+            if timeout is not None:
+                left = timeout - (time.time() - started)
+
+            def done(*args, **kwargs):
+                self.release()
+                callback(*args, **kwargs)
+            try:
+                deadline.call(left, method, *args, callback=done, **kwargs)
+            except:
+                self.release()
+                raise
+
+        self.acquire(admitted, wait=deadline.remaining(timeout))
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'waiting': len(self._waiting),
+            'admitted': self.admitted,
+            'queued': self.queued,
+            'rejected': self.rejected,
+            'timed_out': self.timed_out,
+            'peak_queue': self.peak_queue,
+        }
+
+
+_bulkheads = {}
+
+def limit(concurrency, model=None, operation=None, **kwargs):
+    """Limits the calls of `operation` on `model` to `concurrency` at a
+    time; leaving either out applies to every model or operation."""
+    name = '.'.join(part for part in (model and metrics.model_name(model), operation) if part) or 'default'
+    compartment = _bulkheads[model, operation] = Bulkhead(concurrency, name=name, **kwargs)
+    return compartment
+
+def remove(model=None, operation=None):
+    _bulkheads.pop((model, operation), None)
+
+def clear():
+    _bulkheads.clear()
+
+def bulkhead_for(model, operation):
+    for key in ((model, operation), (model, None), (None, operation), (None, None)):
+        compartment = _bulkheads.get(key)
+        if compartment is not None:
+            return compartment
+    return None
+
+def stats():
+    return dict((compartment.name, compartment.stats()) for compartment in _bulkheads.itervalues())
@@ -0,0 +1,229 @@
+# coding: utf-8
+"""Change feed of the writes made by every process.
+
+The signals of :mod:`asyncmongoorm.signal` only report the writes of the
+current process. A :class:`ChangeFeed` reads the replica set oplog, or a
+capped collection of entries in the oplog format, and dispatches each
+insert, update and remove of a model's collection as its ``post_save``,
+``post_update`` or ``post_remove``, so caches kept through those signals
+stay coherent across processes and hosts::
+
+    from asyncmongoorm import changefeed
+    changefeed.start()
+
+The instance handed to the receivers holds the ``_id`` and what the entry
+carries: the whole document of an insert or a replacement, the ``$set``
+fields of an update (with the ``$unset`` ones as None), nothing else for a
+remove. The writes of the process itself come through the feed as well,
+so receivers must be idempotent.
+
+The feed reads through a tailable, ``awaitData`` cursor opened with
+``oplogReplay``, so the server seeks to the last entry seen instead of
+scanning the oplog, and holds each ``getMore`` up to `interval` seconds
+until new entries come in. A dead cursor is opened again after `interval`
+seconds. Without `since` the feed starts after the newest entry, going by
+the timestamps of the database rather than the clock of the process.
+"""
+import logging
+import time
+
+from asyncmongo.errors import DatabaseError
+from bson.son import SON
+from bson.timestamp import Timestamp
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from asyncmongoorm import deadline
+from asyncmongoorm.collection import get_collections
+from asyncmongoorm.session import DEFAULT_ALIAS, Session
+from asyncmongoorm.signal import post_save, post_update, post_remove
+
+
+def log_error(feed, error):
+    logging.error("change feed of %s.%s failed: %s", feed.database, feed.collection, error)
+
+
+class ChangeFeed(object):
+
+    def __init__(self, database='local', collection='oplog.rs', since=None, interval=0.5, batch_size=1000,
+                 alias=None, timeout=None, on_error=log_error, io_loop=None):
+        self.database = database
+        self.collection = collection
+        self.last = since
+        self.interval = interval
+        self.batch_size = batch_size
+        self.alias = alias
+        self.timeout = timeout
+        self.on_error = on_error
+        self.io_loop = io_loop
+        self.running = False
+        self.entries = 0
+        self.dispatched = 0
+        self.errors = 0
+        self.cursor_id = None
+        self._timer = None
+
+    def models(self):
+        """The models of the feed's session, by the namespace of their
+        collection."""
+        dbname = Session._settings[self.alias or DEFAULT_ALIAS][2]
+        namespaces = {}
+        for model in get_collections():
+            if getattr(model, '__session__', None) not in (None, self.alias or DEFAULT_ALIAS):
+                continue
+            namespace = '%s.%s' % (getattr(model, '__database__', None) or dbname, model.__collection__)
+            namespaces[namespace] = model
+        return namespaces
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.poll()
+
+    def stop(self):
+        self.running = False
+        if self._timer is not None:
+            (self.io_loop or IOLoop.instance()).remove_timeout(self._timer)
+            self._timer = None
+        self.close()
+
+    def close(self):
+        """Kills the cursor of the feed; the next poll opens another one
+        after the last entry seen."""
+        if self.cursor_id:
+            command = SON([('killCursors', self.collection), ('cursors', [self.cursor_id])])
+            Session(alias=self.alias, dbname=self.database).command(command, callback=lambda *args, **kwargs: None)
+        self.cursor_id = None
+
+    def _call(self, timeout, method, *args, **kwargs):
+        # a connection asyncmongo fails to open raises before sending;
+        # the engines get it through the callback, like a failed reply
+        try:
+            deadline.call(timeout, method, *args, **kwargs)
+        except Exception, e:
+            kwargs['callback'](None, error=e)
+
+    @gen.engine
+    def seed(self, callback):
+        """Sets the last entry seen to the newest one of the feed, or to
+        the beginning of time when there is none. `callback` gets the
+        error of the query, None on success."""
+        try:
+            session = Session(self.collection, alias=self.alias, dbname=self.database)
+        except Exception, e:
+            callback(e)
+            return
+        result, error = yield gen.Task(self._call, self.timeout, session.find_one, {}, sort=[('$natural', -1)])
+        if error.get('error'):
+            callback(error['error'])
+            return
+        entry = result[0]
+        self.last = entry['ts'] if entry else Timestamp(0, 0)
+        callback(None)
+
+    @gen.engine
+    def poll(self, callback=None):
+        """Reads the next batch of entries from the cursor of the feed,
+        opening it after the last entry seen when it is not open, dispatches
+        them and schedules the next poll."""
+        self._timer = None
+        namespaces = self.models()
+        entries = []
+        try:
+            if self.last is None:
+                # an engine does not hand its exceptions back to the caller's
+                error = yield gen.Task(self.seed)
+                if error is not None:
+                    raise error
+            if self.cursor_id:
+                # the server holds the reply until an entry comes in or
+                # maxTimeMS passes
+                command = SON([('getMore', self.cursor_id), ('collection', self.collection),
+                               ('batchSize', self.batch_size), ('maxTimeMS', int(self.interval * 1000))])
+                timeout = self.timeout and self.timeout + self.interval
+            else:
+                spec = {'ts': {'$gt': self.last}, 'ns': {'$in': namespaces.keys()}}
+                command = SON([('find', self.collection), ('filter', spec), ('batchSize', self.batch_size),
+                               ('tailable', True), ('awaitData', True), ('oplogReplay', True)])
+                timeout = self.timeout
+                deadline.limit(command, timeout)
+            session = Session(alias=self.alias, dbname=self.database)
+            result, error = yield gen.Task(self._call, timeout, session.command, command)
+            if error.get('error'):
+                raise error['error']
+            response = result[0]
+            if int(response.get('ok', 0)) != 1:
+                raise DatabaseError(response.get('errmsg'))
+
+            cursor = response['cursor']
+            entries = cursor['firstBatch'] if 'firstBatch' in cursor else cursor['nextBatch']
+            self.cursor_id = cursor['id'] or None
+            for entry in entries:
+                self.last = entry['ts']
+                self.entries += 1
+                self.dispatch(namespaces.get(entry['ns']), entry)
+        except Exception, e:
+            self.errors += 1
+            self.close()
+            self.on_error(self, e)
+
+        if self.running:
+            io_loop = self.io_loop or IOLoop.instance()
+            if self.cursor_id:
+                io_loop.add_callback(self.poll)
+            else:
+                self._timer = io_loop.add_timeout(time.time() + self.interval, self.poll)
+        if callback:
+            callback(len(entries))
+
+    def dispatch(self, model, entry):
+        if model is None:
+            return
+        operation, document = entry['op'], entry.get('o') or {}
+        unset = ()
+        if operation == 'i':
+            signal = post_save
+        elif operation == 'u':
+            signal = post_update
+            if any(key.startswith('$') for key in document):
+                unset = document.get('$unset', ())
+                document = document.get('$set', {})
+            document = dict(document, _id=entry['o2']['_id'])
+        elif operation == 'd':
+            signal = post_remove
+        else:
+            return
+        instance = model.create(document)
+        for name in unset:
+            # assigning None to a field that has no value does not store it
+            instance._data[name] = None
+        self.dispatched += 1
+        signal.send(instance=instance)
+
+    def stats(self):
+        return {
+            'last': self.last,
+            'entries': self.entries,
+            'dispatched': self.dispatched,
+            'errors': self.errors,
+        }
+
+
+_feed = None
+
+def start(**kwargs):
+    """Starts the change feed of the process."""
+    global _feed
+    stop()
+    _feed = ChangeFeed(**kwargs)
+    _feed.start()
+    return _feed
+
+def stop():
+    global _feed
+    if _feed is not None:
+        _feed.stop()
+        _feed = None
+
+def current():
+    return _feed
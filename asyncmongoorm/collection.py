@@ -3,9 +3,13 @@ import logging
 import types
 from tornado import gen
 from asyncmongoorm import bson_json
+from asyncmongoorm import deadline
+from asyncmongoorm import identitymap
+from asyncmongoorm import metrics
+from asyncmongoorm.writeconcern import ACKNOWLEDGED
 from asyncmongoorm.signal import pre_save, post_save, pre_remove, post_remove, pre_update, post_update
 from asyncmongoorm.manager import Manager
-from asyncmongoorm.session import Session
+from asyncmongoorm.session import Session, route
 from asyncmongoorm.field import Field
 
 __lazy_classes__ = {}
@@ -31,6 +35,9 @@ class CollectionMetaClass(type):
                 fields.append(attr_value)
 
         new_class = super(CollectionMetaClass, cls).__new__(cls, name, bases, attrs)
+        # the read-only variant of a model is not a model of its own
+        if attrs.get('_read_only'):
+            return new_class
 
         __lazy_classes__[name] = new_class
         new_class._fields = tuple(fields)
@@ -38,10 +45,15 @@ class CollectionMetaClass(type):
         register_collection(new_class)
         return new_class
 
+def _refuse_assignment(self, name, value=None):
+    raise AttributeError("%s was loaded read-only and can not be modified" % type(self).__name__)
+
 class Collection(object):
 
     __metaclass__ = CollectionMetaClass
 
+    _read_only = False
+
     def __new__(cls, class_name=None, *args, **kwargs):
         if class_name:
             global __lazy_classes__
@@ -52,6 +64,7 @@ class Collection(object):
     def __init__(self):
         self._data = { }
         self._changed_fields = set()
+        self._related = { }
 
     @property
     def _field_names(self):
@@ -75,6 +88,11 @@ class Collection(object):
     def changed_data_dict(self):
         return self.as_dict(fields=list(self._changed_fields))
 
+    def related(self, field_name):
+        """The instance referenced by the ReferenceField `field_name`, when
+        it was assigned or prefetched."""
+        return self._related.get(field_name)
+
     @classmethod
     def field_indexes(cls):
         indexes = []
@@ -92,6 +110,31 @@ class Collection(object):
             except TypeError, e:
                 logging.warn(e)
 
+    @classmethod
+    def _frozen_class(cls):
+        frozen = cls.__dict__.get('_frozen')
+        if frozen is None:
+            frozen = type(cls)(cls.__name__, (cls,), {
+                '__module__': cls.__module__,
+                '_read_only': True,
+                '_is_new': False,
+                '__setattr__': _refuse_assignment,
+                '__delattr__': _refuse_assignment,
+            })
+            cls._frozen = frozen
+        return frozen
+
+    @classmethod
+    def create_read_only(cls, dictionary):
+        """A frozen instance reading its fields from `dictionary`, which is
+        shared, not copied. It has no change tracking and refuses any
+        assignment."""
+        instance = object.__new__(cls._frozen_class())
+        instance.__dict__['_data'] = dictionary
+        # read-only results are not prefetched, nothing is related
+        instance.__dict__['_related'] = {}
+        return instance
+
     @classmethod
     def create(cls, dictionary):
         instance = cls()
@@ -100,37 +143,68 @@ class Collection(object):
         
         assert isinstance(dictionary, dict)
 
+        identity_map = identitymap.current()
+        if identity_map is not None and '_id' in dictionary:
+            known = identity_map.get(cls, dictionary['_id'])
+            if known is not None:
+                return known
+
         if '_id' in dictionary:
             instance._is_new = False
 
         instance.update_attrs(dictionary)
+        if identity_map is not None and not instance.is_new():
+            identity_map.add(instance)
         return instance
 
     def is_new(self):
         return getattr(self, '_is_new', True)
 
+    def _session_for(self, operation):
+        return Session(self.__collection__, **route(self.__class__, operation))
+
+    def _write_concern(self, write_concern=None):
+        return write_concern or getattr(self.__class__, '__write_concern__', None) or ACKNOWLEDGED
+
     @staticmethod
-    def _handle_errors(error):
-        if error and "error" in error and error["error"]:
+    def _handle_errors(error, operation=None):
+        if isinstance(error, dict) and error.get("error"):
+            if operation is not None:
+                operation.fail(error)
+                operation.finish()
             raise error["error"]
 
     @gen.engine
-    def save(self, obj_data=None, callback=None):
+    def save(self, obj_data=None, callback=None, timeout=None, write_concern=None):
         if not isinstance(obj_data, (types.NoneType, dict)):
             raise ValueError("obj_data should be either None or dict")
         if callback and not callable(callback):
             raise ValueError("callback should be callable")
+        if self._read_only:
+            raise AttributeError("%s was loaded read-only and can not be saved" % type(self).__name__)
 
+        identity_map = identitymap.current()
         if self.is_new():
+            operation = metrics.start(self.__class__, 'insert')
             yield gen.Task(pre_save.send, instance=self)
+            operation.lap('signal')
             if not obj_data:
                 obj_data = self.as_dict()
-            result, error = yield gen.Task(Session(self.__collection__).insert, obj_data, safe=True)
-            self._handle_errors(error)
+            operation.lap('serialization')
+            session = self._session_for('insert')
+            concern = self._write_concern(write_concern)
+            result, error = yield gen.Task(deadline.call, timeout, concern.write, session.insert, obj_data, safe=True)
+            operation.lap('wire')
+            self._handle_errors(error, operation)
             self._is_new = False
+            # receivers see the instance as it was written
+            self.update_attrs(obj_data)
             yield gen.Task(post_save.send, instance=self)
+            operation.lap('signal')
         else:
+            operation = metrics.start(self.__class__, 'update')
             yield gen.Task(pre_update.send, instance=self)
+            operation.lap('signal')
 
             if not obj_data:
                 obj_data = self.changed_data_dict()
@@ -138,22 +212,54 @@ class Collection(object):
                 # Normalize custom obj_data, to avoid setting values for fields that are not
                 normalize = lambda s: dict(filter(lambda (f, v): f in self._field_names, s.iteritems()))
                 obj_data = normalize(obj_data)
-            response, error = yield gen.Task(Session(self.__collection__).update, {'_id': self._id}, { "$set": obj_data }, safe=True)
-            self._handle_errors(error)
+            operation.lap('serialization')
+            session = self._session_for('update')
+            concern = self._write_concern(write_concern)
+            response, error = yield gen.Task(deadline.call, timeout, concern.write, session.update, {'_id': self._id},
+                                             { "$set": obj_data }, safe=True)
+            operation.lap('wire')
+            self._handle_errors(error, operation)
+            self.update_attrs(obj_data)
             yield gen.Task(post_update.send, instance=self)
+            operation.lap('signal')
 
-        self.update_attrs(obj_data)
+        if identity_map is not None:
+            identity_map.add(self)
+        operation.finish(documents=1)
 
         if callback:
             callback(error)
 
+    def save_later(self, obj_data=None):
+        """Buffers the changed fields, or `obj_data`, of a saved instance
+        in the model's write-behind buffer."""
+        if self.is_new():
+            raise ValueError("only saved instances can be written behind")
+        if obj_data:
+            self.update_attrs(obj_data)
+        else:
+            obj_data = self.changed_data_dict()
+        self.objects.update_later(self._id, values=obj_data)
+        # the buffer writes them now, the next save does not send them again
+        self._changed_fields.difference_update(obj_data)
+
     @gen.engine
-    def remove(self, callback=None):
+    def remove(self, callback=None, timeout=None, write_concern=None):
+        operation = metrics.start(self.__class__, 'remove')
+        identity_map = identitymap.current()
         pre_remove.send(instance=self)
-
-        response, error = yield gen.Task(Session(self.__collection__).remove, {'_id': self._id})
-        self._handle_errors(error)
+        operation.lap('signal')
+
+        session = self._session_for('remove')
+        concern = self._write_concern(write_concern)
+        response, error = yield gen.Task(deadline.call, timeout, concern.write, session.remove, {'_id': self._id})
+        operation.lap('wire')
+        self._handle_errors(error, operation)
+        if identity_map is not None:
+            identity_map.discard(self)
         post_remove.send(instance=self)
+        operation.lap('signal')
+        operation.finish(documents=1)
 
         if callback:
             callback(error)
@@ -0,0 +1,121 @@
+# coding: utf-8
+"""Columnar results for analytics queries.
+
+:meth:`Manager.find_columns <asyncmongoorm.manager.Manager.find_columns>`
+pages through the matching documents by ``_id`` and appends the
+requested numeric fields to typed arrays, without building
+:class:`~asyncmongoorm.collection.Collection` instances::
+
+    Article.objects.find_columns({'published': True}, ('views', 'score'), callback=self.on_columns)
+
+    def on_columns(self, columns):
+        views = columns['views']
+        total = sum(views.compressed())
+
+Each :class:`Column` holds its values in an ``array.array`` and a null
+mask, 1 where the document has no value. When NumPy is installed the
+arrays are handed out as NumPy arrays (``values`` and a boolean ``mask``)
+ready for vectorized aggregation. Dates are stored as seconds since the
+epoch.
+"""
+import array
+import calendar
+from datetime import date, datetime
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from asyncmongoorm.field import BooleanField, DateField, DateTimeField, FloatField, IntegerField
+
+TYPECODES = (
+    (BooleanField, 'b'),
+    (IntegerField, 'l'),
+    (FloatField, 'd'),
+    (DateTimeField, 'd'),
+    (DateField, 'd'),
+)
+
+def _timestamp(value):
+    if isinstance(value, datetime):
+        return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+    if isinstance(value, date):
+        return float(calendar.timegm(value.timetuple()))
+    return value
+
+
+class Column(object):
+
+    def __init__(self, name, typecode):
+        self.name = name
+        self.typecode = typecode
+        self.values = array.array(typecode)
+        self.mask = array.array('b')
+
+    def __len__(self):
+        return len(self.values)
+
+    def append(self, value):
+        if value is None:
+            self.values.append(0)
+            self.mask.append(1)
+        else:
+            self.values.append(_timestamp(value))
+            self.mask.append(0)
+
+    @property
+    def null_count(self):
+        return sum(self.mask)
+
+    def compressed(self):
+        """The values of the documents that have one."""
+        if numpy is not None and isinstance(self.values, numpy.ndarray):
+            return self.values[~self.mask]
+        return array.array(self.typecode, (v for v, null in zip(self.values, self.mask) if not null))
+
+    def to_numpy(self):
+        self.values = numpy.frombuffer(self.values, dtype=self.values.typecode)
+        self.mask = numpy.frombuffer(self.mask, dtype=numpy.int8).astype(bool)
+
+
+class Columns(object):
+    """The columns of a result, by field name."""
+
+    def __init__(self, model, fields):
+        types = dict((field.name, field) for field in model._fields)
+        self.columns = {}
+        for name in fields:
+            field = types.get(name)
+            typecode = None
+            for field_class, code in TYPECODES:
+                if isinstance(field, field_class):
+                    typecode = code
+                    break
+            if typecode is None:
+                raise ValueError("%s is not a numeric or date field of %s" % (name, model.__name__))
+            self.columns[name] = Column(name, typecode)
+        self.count = 0
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __iter__(self):
+        return iter(self.columns)
+
+    def __len__(self):
+        return self.count
+
+    def extend(self, documents):
+        for document in documents:
+            for name, column in self.columns.iteritems():
+                column.append(document.get(name))
+        self.count += len(documents)
+
+    def finish(self, as_numpy=None):
+        if as_numpy is None:
+            as_numpy = numpy is not None
+        if as_numpy:
+            for column in self.columns.itervalues():
+                column.to_numpy()
+        return self
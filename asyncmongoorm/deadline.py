@@ -0,0 +1,157 @@
+# coding: utf-8
+"""Deadlines for the database calls of the ORM.
+
+Every :class:`~asyncmongoorm.manager.Manager` method and
+:meth:`Collection.save <asyncmongoorm.collection.Collection.save>` and
+:meth:`~asyncmongoorm.collection.Collection.remove` take a `timeout` in
+seconds. A default deadline can be set for a block of code, and for the
+callbacks it spawns, with :func:`scope`; nested scopes and explicit
+timeouts can only make it shorter::
+
+    with deadline.scope(0.5):
+        User.objects.find({'active': True}, callback=self.on_users)
+
+When the deadline passes before the reply the call fails with
+:exc:`DeadlineExceeded`. The connection it was sent on is closed, so the
+late reply does not keep it busy; asyncmongo reconnects it on next use.
+Commands also carry the remaining time as ``maxTimeMS`` so the server
+stops working on them (asyncmongo offers no way to add it to queries).
+"""
+import threading
+import time
+from functools import partial
+
+from asyncmongo.pool import ConnectionPool
+from tornado.ioloop import IOLoop
+from tornado.stack_context import NullContext, StackContext, wrap
+
+from asyncmongoorm.session import Session
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class _ScopeState(threading.local):
+    def __init__(self):
+        self.deadline = None
+_scope = _ScopeState()
+
+class _DeadlineScope(object):
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+
+    def __enter__(self):
+        self.previous = _scope.deadline
+        _scope.deadline = self.deadline
+
+    def __exit__(self, type, value, traceback):
+        _scope.deadline = self.previous
+
+def scope(timeout):
+    """Returns a StackContext giving the calls made inside it, and inside
+    the callbacks it spawns, `timeout` seconds from now to complete."""
+    deadline = time.time() + timeout
+    # the scope restores the deadline it was opened with, whatever state
+    # tornado re-enters it on
+    if _scope.deadline is not None and _scope.deadline < deadline:
+        deadline = _scope.deadline
+    return StackContext(partial(_DeadlineScope, deadline))
+
+def remaining(timeout=None):
+    """Seconds left for a call given its own `timeout` and the scoped
+    deadline, None when neither is set."""
+    deadline = _scope.deadline
+    if timeout is not None:
+        own = time.time() + timeout
+        if deadline is None or own < deadline:
+            deadline = own
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+def limit(command, timeout=None):
+    """Adds the time left to `command` as ``maxTimeMS``."""
+    left = remaining(timeout)
+    if left is not None:
+        command['maxTimeMS'] = max(int(left * 1000), 1)
+    return command
+
+def check(error, operation=None):
+    """Raises the :exc:`DeadlineExceeded` carried by the error arguments of
+    an asyncmongo callback."""
+    if isinstance(error, dict) and isinstance(error.get('error'), DeadlineExceeded):
+        if operation is not None:
+            operation.finish()
+        raise error['error']
+
+
+class _Recording(object):
+    """Makes the pools of every session record the connections they hand
+    out, for the call being sent and for the sends of the callbacks it
+    spawned, such as a hedge."""
+
+    def __init__(self, connections, state):
+        self.connections = connections
+        self.state = state
+
+    def __enter__(self):
+        self.patched = []
+        for pool in Session.pools():
+            if isinstance(pool, ConnectionPool):
+                self.patched.append((pool, pool.__dict__.get('connection')))
+                pool.connection = partial(self.connection, pool)
+
+    def connection(self, pool):
+        taken = type(pool).connection(pool)
+        if not self.state['done']:
+            self.connections.append(taken)
+        return taken
+
+    def __exit__(self, type, value, traceback):
+        for pool, previous in reversed(self.patched):
+            if previous is None:
+                del pool.connection
+            else:
+                pool.connection = previous
+
+def call(timeout, method, *args, **kwargs):
+    """Calls the asyncmongo `method`, failing its callback with
+    :exc:`DeadlineExceeded` once `timeout` or the scoped deadline passes."""
+    left = remaining(timeout)
+    if left is None:
+        return method(*args, **kwargs)
+
+    # the reply comes back inside the recording context; the caller's
+    # callback runs in its own contexts only
+    callback = wrap(kwargs.pop('callback'))
+    name = getattr(method, '__name__', 'call')
+    if left <= 0:
+        callback(None, error=DeadlineExceeded("deadline passed before %s was sent" % name))
+        return
+
+    io_loop = IOLoop.instance()
+    connections = []
+    state = {'done': False}
+
+    def expire():
+        if state['done']:
+            return
+        state['done'] = True
+        for connection in connections:
+            connection.close()
+        callback(None, error=DeadlineExceeded("%s did not complete in %.3fs" % (name, left)))
+
+    def complete(*args, **kwargs):
+        if state['done']:
+            return
+        state['done'] = True
+        io_loop.remove_timeout(timer)
+        with NullContext():
+            callback(*args, **kwargs)
+
+    timer = io_loop.add_timeout(time.time() + left, expire)
+    # the method may be wrapped, by a hedge or a Database, so the pools are
+    # taken from the sessions rather than from the method
+    with StackContext(partial(_Recording, connections, state)):
+        return method(*args, callback=complete, **kwargs)
@@ -33,7 +33,8 @@ class Field(object):
                 value = self.default()
             else:
                 value = self.default
-            setattr(instance, self.name, value)
+            if not instance._read_only:
+                setattr(instance, self.name, value)
 
         return value
 
@@ -93,7 +94,8 @@ class DateField(Field):
                 value = self.default()
             else:
                 value = self.default
-            setattr(instance, self.name, value)
+            if not instance._read_only:
+                setattr(instance, self.name, value)
 
         return datetime(value.year, value.month, value.day)
     
@@ -131,3 +133,39 @@ class BinaryField(Field):
     def __init__(self, *args, **kwargs):
 
         super(BinaryField, self).__init__(field_type=Binary, *args, **kwargs)
+
+class ReferenceField(ObjectIdField):
+    """The ``_id`` of a document of `target_model`, a Collection class or
+    its name. Assigning an instance stores its ``_id``; the instance
+    loaded by ``Manager.find(..., prefetch=...)`` is returned by
+    ``Collection.related``."""
+
+    def __init__(self, target_model, *args, **kwargs):
+
+        super(ReferenceField, self).__init__(*args, **kwargs)
+        self._target_model = target_model
+
+    @property
+    def target_model(self):
+        """The referenced model, looked up when first needed, so a model
+        can be named before it is defined."""
+        if isinstance(self._target_model, basestring):
+            from asyncmongoorm.collection import Collection
+            model = Collection(self._target_model)
+            if model is None:
+                raise ValueError("%s references the unknown model %s" % (self.name, self._target_model))
+            self._target_model = model
+        return self._target_model
+
+    def __set__(self, instance, value):
+        from asyncmongoorm.collection import Collection
+        # an _id does not need the target model, which may not exist yet
+        if isinstance(value, Collection) and isinstance(value, self.target_model):
+            instance._related[self.name] = value
+            value = value._id
+        else:
+            related = instance._related.get(self.name)
+            if related is not None and related._id != value:
+                del instance._related[self.name]
+
+        super(ReferenceField, self).__set__(instance, value)
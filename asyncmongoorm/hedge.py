@@ -0,0 +1,129 @@
+# coding: utf-8
+"""Hedged reads.
+
+A :class:`HedgePolicy` watches the latency of the idempotent reads of
+:class:`~asyncmongoorm.manager.Manager` (``find_one``, ``find``, ``count``
+and ``distinct``). When a read has not been answered within a percentile
+of the recent latency of the same model and operation, a duplicate is sent
+through a newly resolved session, so over another connection, and on a
+replica set possibly to another member. The first reply wins; the other
+one is ignored when it arrives::
+
+    from asyncmongoorm import hedge
+    hedge.enable(percentile=0.95, budget=0.05)
+
+A model can use its own policy, or opt out, with ``__hedge__``. The
+`budget` caps hedges to that fraction of the reads.
+"""
+import collections
+import time
+from functools import partial
+
+from tornado.ioloop import IOLoop
+
+from asyncmongoorm import metrics
+
+HEDGED_OPERATIONS = ('find_one', 'find', 'count', 'distinct')
+
+
+class HedgePolicy(object):
+
+    def __init__(self, percentile=0.95, budget=0.05, min_delay=0.002, window=500, min_samples=20):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_delay = min_delay
+        self.window = window
+        self.min_samples = min_samples
+        self.latencies = {}
+        self.delays = {}
+        self.reads = 0
+        self.hedged = 0
+        self.won = 0
+        self.over_budget = 0
+
+    def observe(self, key, latency):
+        latencies = self.latencies.get(key)
+        if latencies is None:
+            latencies = self.latencies[key] = collections.deque(maxlen=self.window)
+        latencies.append(latency)
+        # the percentile is only recomputed every few replies
+        if len(latencies) >= self.min_samples and (key not in self.delays or len(latencies) % 16 == 0):
+            ordered = sorted(latencies)
+            index = min(int(self.percentile * len(ordered)), len(ordered) - 1)
+            self.delays[key] = max(ordered[index], self.min_delay)
+
+    def delay(self, key):
+        """Seconds to wait for a reply before hedging, None while there
+        are not enough samples."""
+        return self.delays.get(key)
+
+    def call(self, key, resolve, *args, **kwargs):
+        """Calls ``resolve()``, a function returning the asyncmongo method
+        to run, hedging it with a second resolved method if needed."""
+        callback = kwargs.pop('callback')
+        io_loop = IOLoop.instance()
+        started = time.time()
+        state = {'done': False, 'timer': None}
+        self.reads += 1
+
+        def reply(sent, hedge, *args, **kwargs):
+            if state['done']:
+                return
+            state['done'] = True
+            if state['timer'] is not None:
+                io_loop.remove_timeout(state['timer'])
+            self.observe(key, time.time() - sent)
+            if hedge:
+                self.won += 1
+            callback(*args, **kwargs)
+
+        def send_hedge():
+            state['timer'] = None
+            if state['done']:
+                return
+            if self.hedged >= self.budget * self.reads:
+                self.over_budget += 1
+                return
+            self.hedged += 1
+            resolve()(*args, callback=partial(reply, time.time(), True), **kwargs)
+
+        delay = self.delay(key)
+        if delay is not None:
+            state['timer'] = io_loop.add_timeout(started + delay, send_hedge)
+        resolve()(*args, callback=partial(reply, started, False), **kwargs)
+
+    def stats(self):
+        return {
+            'reads': self.reads,
+            'hedged': self.hedged,
+            'won': self.won,
+            'over_budget': self.over_budget,
+            'delays': dict(('%s.%s' % key, delay) for key, delay in self.delays.iteritems()),
+        }
+
+
+_policy = None
+
+def enable(**kwargs):
+    """Hedges the reads of every model without a ``__hedge__`` of its own."""
+    global _policy
+    _policy = HedgePolicy(**kwargs)
+    return _policy
+
+def disable():
+    global _policy
+    _policy = None
+
+def current():
+    return _policy
+
+def policy_for(model, operation):
+    if operation not in HEDGED_OPERATIONS:
+        return None
+    policy = getattr(model, '__hedge__', None)
+    if policy is None:
+        return _policy
+    return policy or None
+
+def key(model, operation):
+    return metrics.model_name(model), operation
@@ -0,0 +1,119 @@
+# coding: utf-8
+"""Identity map for a request or unit of work.
+
+While the scope of an :class:`IdentityMap` is active, including in the
+callbacks spawned from it, every document is loaded into a single
+instance: :meth:`Collection.create
+<asyncmongoorm.collection.Collection.create>` returns the instance already
+loaded for an ``_id`` and :meth:`Manager.find_one
+<asyncmongoorm.manager.Manager.find_one>` by ``_id`` alone is answered
+from the map without a query::
+
+    identity_map = IdentityMap()
+    with identity_map.scope():
+        User.objects.find_one({'_id': user_id}, callback=self.on_user)
+    ...
+    identity_map.flush(callback=self.on_saved)
+
+:meth:`IdentityMap.flush` saves the instances changed since they were
+loaded, each with the model's write concern unless another one is given,
+and reports the saves that failed.
+"""
+import threading
+from functools import partial
+
+from tornado.stack_context import ExceptionStackContext, StackContext
+
+class _ScopeState(threading.local):
+    def __init__(self):
+        self.identity_map = None
+_scope = _ScopeState()
+
+class _IdentityMapScope(object):
+
+    def __init__(self, identity_map):
+        self.identity_map = identity_map
+
+    def __enter__(self):
+        self.previous = _scope.identity_map
+        _scope.identity_map = self.identity_map
+
+    def __exit__(self, type, value, traceback):
+        _scope.identity_map = self.previous
+
+def current():
+    return _scope.identity_map
+
+
+class IdentityMap(object):
+
+    def __init__(self, io_loop=None):
+        self._instances = {}
+        self.hits = 0
+        self.io_loop = io_loop
+
+    def scope(self):
+        return StackContext(partial(_IdentityMapScope, self))
+
+    def __len__(self):
+        return len(self._instances)
+
+    def __contains__(self, instance):
+        return self._instances.get((type(instance), getattr(instance, '_id', None))) is instance
+
+    def get(self, model, _id):
+        instance = self._instances.get((model, _id))
+        if instance is not None:
+            self.hits += 1
+        return instance
+
+    def add(self, instance):
+        """Registers a loaded `instance`; its fields count as unchanged."""
+        _id = getattr(instance, '_id', None)
+        if _id is None:
+            return
+        self._instances[type(instance), _id] = instance
+        instance._changed_fields.clear()
+
+    def discard(self, instance):
+        if instance in self:
+            del self._instances[type(instance), instance._id]
+
+    def dirty(self):
+        return [instance for instance in self._instances.itervalues() if instance._changed_fields]
+
+    def flush(self, callback=None, write_concern=None):
+        """Saves the changed instances with `write_concern`, the model's
+        own by default. Once all of them are done `callback` gets the
+        ``(instance, error)`` pairs of the saves that failed; those
+        instances keep their changes."""
+        dirty = self.dirty()
+        failures = []
+        if not dirty:
+            if callback:
+                callback(failures)
+            return
+        pending = set(id(instance) for instance in dirty)
+
+        def done(instance, error):
+            if id(instance) not in pending:
+                return
+            pending.discard(id(instance))
+            if error is None:
+                instance._changed_fields.clear()
+            else:
+                failures.append((instance, error))
+            if not pending and callback:
+                callback(failures)
+
+        def saved(instance, error):
+            done(instance, error.get('error') if isinstance(error, dict) else error)
+
+        def failed(instance, type, value, traceback):
+            # save raises the errors of the write, and of its signals
+            done(instance, value)
+            return True
+
+        for instance in dirty:
+            with ExceptionStackContext(partial(failed, instance)):
+                instance.save(callback=partial(saved, instance), write_concern=write_concern)
@@ -1,39 +1,417 @@
 # coding: utf-8
+import copy
+import hashlib
+import itertools
 import logging
+import math
+import time
+from datetime import datetime
+from functools import partial
+from asyncmongo.errors import DatabaseError
+from bson import ObjectId
 from bson.son import SON
 from tornado import gen
-from asyncmongoorm.session import Session
+from tornado.ioloop import IOLoop
+from asyncmongoorm import bson_json
+from asyncmongoorm import bulkhead
+from asyncmongoorm import deadline
+from asyncmongoorm import hedge
+from asyncmongoorm import identitymap
+from asyncmongoorm import metrics
+from asyncmongoorm import offload
+from asyncmongoorm import replica
+from asyncmongoorm import writebehind
+from asyncmongoorm.aggregation import Pipeline
+from asyncmongoorm.columnar import Columns
+from asyncmongoorm.field import ReferenceField
+from asyncmongoorm.session import Session, route
+
+# the high-water marks of the incremental map_reduce jobs
+WATERMARKS = 'map_reduce_watermarks'
+
+
+def _next_iteration(io_loop, callback):
+    # answers from memory call back on a later iteration, as replies do
+    (io_loop or IOLoop.instance()).add_callback(callback)
+
+
+class MapReduceResult(object):
+    """The output collection of a :meth:`Manager.map_reduce`, with the
+    ``counts`` of the run."""
+
+    def __init__(self, collection, counts, model=None, **session):
+        self.collection = collection
+        self.counts = counts
+        self.model = model
+        self._session = session
+
+    @gen.engine
+    def find(self, callback, query=None, timeout=None, **kw):
+        """Reads the ``{'_id': key, 'value': value}`` documents of the
+        output collection, as instances of `model` when there is one."""
+        session = Session(self.collection, **self._session)
+        result, error = yield gen.Task(deadline.call, timeout, session.find, query or {}, **kw)
+        deadline.check(error)
+        documents = result[0] if result and result[0] else []
+        if self.model is not None:
+            documents = [self.model.create(document) for document in documents]
+        callback(documents)
 
 
 class Manager(object):
 
     def __init__(self, collection):
         self.collection = collection
+
+    def _session_for(self, operation, collection=True, read_preference=None):
+        options = route(self.collection, operation, read_preference)
+        if collection:
+            return Session(self.collection.__collection__, **options)
+        return Session(**options)
+
+    def _read_method(self, operation, method, collection=True, read_preference=None):
+        """The session method running the read `operation`, hedged when a
+        policy applies to the model."""
+        resolve = lambda: getattr(self._session_for(operation, collection, read_preference), method)
+        policy = hedge.policy_for(self.collection, operation)
+        if policy is None:
+            return resolve()
+        return partial(policy.call, hedge.key(self.collection, operation), resolve)
+
+    def _call(self, operation, timeout, method, *args, **kwargs):
+        """Runs `method` under the deadline, once admitted by the bulkhead
+        of the model and `operation` if there is one."""
+        compartment = bulkhead.bulkhead_for(self.collection, operation)
+        if compartment is None:
+            return deadline.call(timeout, method, *args, **kwargs)
+        return compartment.call(timeout, method, *args, **kwargs)
     
+    def _from_replica(self, query, kw, read_only, limit=None):
+        """Instances of the documents matching `query` in the model's
+        replica, or None when the query has to go to the database."""
+        local = replica.replica_for(self.collection)
+        documents = local.lookup(query) if local is not None and not kw else None
+        if documents is None:
+            return None
+        if limit:
+            documents = documents[:limit]
+        if read_only:
+            return [self.collection.create_read_only(document) for document in documents]
+        # the replica's documents are shared, an instance gets a copy it can change
+        return [self.collection.create(copy.deepcopy(document)) for document in documents]
+
     @gen.engine
-    def find_one(self, query, callback, **kw):
-        result, error = yield gen.Task(Session(self.collection.__collection__).find_one, query, **kw)
+    def find_one(self, query, callback, read_preference=None, timeout=None, read_only=False, **kw):
+        identity_map = identitymap.current()
+        if identity_map is not None and not read_only and not kw and isinstance(query, dict) and query.keys() == ['_id']:
+            instance = identity_map.get(self.collection, query['_id'])
+            if instance is not None:
+                yield gen.Task(_next_iteration, identity_map.io_loop)
+                callback(instance)
+                return
+        local = self._from_replica(query, kw, read_only, limit=1)
+        if local is not None:
+            yield gen.Task(_next_iteration, replica.replica_for(self.collection).io_loop)
+            callback(local[0] if local else None)
+            return
+        operation = metrics.start(self.collection, 'find_one', query, **kw)
+        find_one = self._read_method('find_one', 'find_one', read_preference=read_preference)
+        result, error = yield gen.Task(self._call, 'find_one', timeout, find_one, query, **kw)
+        operation.lap('wire')
+        operation.fail(error)
+        deadline.check(error, operation)
 
         instance = None
         if result and result[0]:
-            instance = self.collection.create(result[0])
-        
+            create = self.collection.create_read_only if read_only else self.collection.create
+            instance = create(result[0])
+        operation.lap('hydration')
+        operation.finish(documents=int(instance is not None))
+
         callback(instance) 
    
     @gen.engine
-    def find(self, query, callback, **kw):
-        result, error = yield gen.Task(Session(self.collection.__collection__).find, query, **kw)
-        items = []
+    def find(self, query, callback, read_preference=None, timeout=None, prefetch=(), read_only=False, **kw):
+        if prefetch and read_only:
+            raise ValueError("read-only instances can not hold prefetched references")
+        items = self._from_replica(query, kw, read_only)
+        if items is not None:
+            yield gen.Task(_next_iteration, replica.replica_for(self.collection).io_loop)
+        else:
+            operation = metrics.start(self.collection, 'find', query, **kw)
+            find = self._read_method('find', 'find', read_preference=read_preference)
+            result, error = yield gen.Task(self._call, 'find', timeout, find, query, **kw)
+            operation.lap('wire')
+            operation.fail(error)
+            deadline.check(error, operation)
+            items = []
+
+            if result and result[0]:
+                pool = offload.current()
+                if not read_only and pool is not None and pool.wanted(len(result[0])):
+                    hydrated, error = yield gen.Task(pool.hydrate, self.collection, result[0])
+                    if error.get('error'):
+                        operation.fail(error)
+                        operation.finish()
+                        raise error['error']
+                    items = hydrated[0]
+                else:
+                    create = self.collection.create_read_only if read_only else self.collection.create
+                    for item in result[0]:
+                        items.append(create(item))
+            operation.lap('hydration')
+            operation.finish(documents=len(items))
+
+        if prefetch:
+            yield gen.Task(prefetch_related, items, prefetch, timeout=timeout)
+        callback(items)
 
-        if result and result[0]:
-            for item in result[0]:
-                items.append(self.collection.create(item))
+    @gen.engine
+    def find_columns(self, query, fields, callback, batch_size=1000, read_preference=None, timeout=None,
+                     as_numpy=None):
+        """Calls back with the :class:`~asyncmongoorm.columnar.Columns` of
+        the numeric and date `fields` of the matching documents, read
+        `batch_size` at a time in ``_id`` order. The `timeout` covers every
+        batch."""
+        columns = Columns(self.collection, fields)
+        started = time.time()
+        last = None
+        while True:
+            spec = query or {}
+            if last is not None:
+                after = {'_id': {'$gt': last}}
+                spec = {'$and': [spec, after]} if '_id' in spec else dict(spec, **after)
+            left = timeout
+            if timeout is not None:
+                left = timeout - (time.time() - started)
+
+            operation = metrics.start(self.collection, 'find_columns', spec, limit=batch_size)
+            find = self._read_method('find_columns', 'find', read_preference=read_preference)
+            result, error = yield gen.Task(self._call, 'find_columns', left, find, spec, fields=list(fields),
+                                           sort=[('_id', 1)], limit=batch_size)
+            operation.lap('wire')
+            operation.fail(error)
+            deadline.check(error, operation)
+
+            documents = result[0] if result and result[0] else []
+            columns.extend(documents)
+            operation.lap('hydration')
+            operation.finish(documents=len(documents))
+            if len(documents) < batch_size:
+                break
+            last = documents[-1]['_id']
+
+        callback(columns.finish(as_numpy))
 
-        callback(items)
+    @gen.engine
+    def split_points(self, segments, callback, query=None, key='_id', timeout=None):
+        """Calls back with up to ``segments - 1`` values of `key` that split
+        the documents matching `query` into ranges of about the same size.
+        The server's ``splitVector`` is used when there is no query and it
+        is allowed to run; otherwise the boundaries are sampled, one
+        skipped ``find`` each."""
+        total = yield gen.Task(self.count, query, timeout=timeout)
+        if segments < 2 or total < segments:
+            callback([])
+            return
+        per_segment = int(math.ceil(total / float(segments)))
+
+        if not query:
+            namespace = self._session_for('split_points').full_collection_name
+            command = SON([('splitVector', namespace), ('keyPattern', {key: 1}),
+                           ('maxChunkSizeBytes', 1 << 40), ('maxChunkObjects', per_segment)])
+            session = self._session_for('split_points', collection=False)
+            result, error = yield gen.Task(self._call, 'split_points', timeout, session.command, command)
+            deadline.check(error)
+            if result and result[0].get('ok'):
+                callback([split[key] for split in result[0]['splitKeys']][:segments - 1])
+                return
+
+        for index in range(1, segments):
+            self.find(query or {}, fields=[key], sort=[(key, 1)], skip=index * per_segment, limit=1,
+                      read_only=True, timeout=timeout, callback=(yield gen.Callback(index)))
+        samples = yield gen.WaitAll(range(1, segments))
+        callback([_value(found[0], key) for found in samples if found])
+
+    @gen.engine
+    def parallel_scan(self, callback, query=None, segments=4, key='_id', boundaries=None, on_batch=None,
+                      batch_size=1000, read_only=False, timeout=None):
+        """Reads the documents matching `query` as `segments` ranges of
+        `key` scanned concurrently, each over its own pooled connection.
+
+        With `on_batch`, every batch is handed to ``on_batch(instances,
+        segment)`` as it arrives and `callback` gets the number of
+        documents read; otherwise `callback` gets all of them in `key`
+        order. The ranges are cut at `boundaries`, or at the
+        :meth:`split_points` of the collection. `timeout` applies to each
+        batch."""
+        query = query or {}
+        if boundaries is None:
+            boundaries = yield gen.Task(self.split_points, segments, query=query, key=key, timeout=timeout)
+        boundaries = list(boundaries)
+        ranges = zip([None] + boundaries, boundaries + [None])
+
+        collected = [[] for _ in ranges]
+        for segment, (low, high) in enumerate(ranges):
+            deliver = partial(on_batch, segment=segment) if on_batch else collected[segment].extend
+            self._scan_range(query, key, low, high, deliver, batch_size=batch_size, read_only=read_only,
+                             timeout=timeout, callback=(yield gen.Callback(segment)))
+        totals = yield gen.WaitAll(range(len(ranges)))
+
+        if on_batch:
+            callback(sum(totals))
+        else:
+            callback(list(itertools.chain(*collected)))
+
+    @gen.engine
+    def _scan_range(self, query, key, low, high, deliver, callback, batch_size=1000, read_only=False,
+                    timeout=None):
+        bounds = {}
+        if low is not None:
+            bounds['$gte'] = low
+        if high is not None:
+            bounds['$lt'] = high
+        sort = [(key, 1)] if key == '_id' else [(key, 1), ('_id', 1)]
+        after = {}
+        total = 0
+        while True:
+            spec = _within(query, {key: bounds} if bounds else {})
+            if after:
+                spec = _within(spec, after)
+            items = yield gen.Task(self.find, spec, sort=sort, limit=batch_size, read_only=read_only,
+                                   timeout=timeout)
+            if items:
+                deliver(items)
+                total += len(items)
+            if len(items) < batch_size:
+                break
+            # page on (key, _id) so that documents sharing a key value are not skipped
+            last = _value(items[-1], key)
+            if key == '_id':
+                after = {'_id': {'$gt': last}}
+            else:
+                after = {'$or': [{key: {'$gt': last}}, {key: last, '_id': {'$gt': items[-1]._id}}]}
+        callback(total)
 
     @gen.engine
-    def get_or_create(self, query, callback, defaults=None, **kw):
-        result, error = yield gen.Task(Session(self.collection.__collection__).find_one, query, **kw)
+    def export(self, stream, callback=None, query=None, batch_size=1000, after=None, on_progress=None,
+               read_preference=None, timeout=None):
+        """Writes the documents matching `query` to `stream` as newline
+        delimited extended JSON, read `batch_size` at a time in ``_id``
+        order, and calls back with their number.
+
+        After each batch ``on_progress(count, last_id)`` is told how far
+        the export got; passing that ``_id`` as `after` resumes it.
+        `timeout` applies to each batch."""
+        count = 0
+        while True:
+            spec = query or {}
+            if after is not None:
+                spec = _within(spec, {'_id': {'$gt': after}})
+            operation = metrics.start(self.collection, 'export', spec, limit=batch_size)
+            find = self._read_method('export', 'find', read_preference=read_preference)
+            result, error = yield gen.Task(self._call, 'export', timeout, find, spec, sort=[('_id', 1)],
+                                           limit=batch_size)
+            operation.lap('wire')
+            operation.fail(error)
+            deadline.check(error, operation)
+
+            documents = result[0] if result and result[0] else []
+            for document in documents:
+                stream.write(bson_json.dumps(document, strict=True) + '\n')
+            operation.lap('serialization')
+            operation.finish(documents=len(documents))
+            if documents:
+                count += len(documents)
+                after = documents[-1]['_id']
+                if on_progress:
+                    on_progress(count, after)
+            if len(documents) < batch_size:
+                break
+
+        if callback:
+            callback(count)
+
+    @gen.engine
+    def import_(self, stream, callback=None, batch_size=1000, upsert=True, skip=0, on_progress=None,
+                concurrency=10, timeout=None):
+        """Loads the newline delimited extended JSON documents of `stream`,
+        as written by :meth:`export`, and calls back with their number.
+
+        Each batch of `batch_size` documents is a single insert or, with
+        `upsert`, replacements by ``_id`` that overwrite the documents
+        already there, each acknowledged on its own, `concurrency` at a
+        time. A failed write raises once its batch is answered.
+
+        After each batch ``on_progress(count, position)`` is told how many
+        lines of `stream` were loaded; passing that position as `skip`
+        resumes the import after them. A resumed upsert rewrites the
+        documents of the interrupted batch; a resumed insert fails on the
+        ones that made it in. A document without an ``_id`` gets one
+        derived from its line number and content, so loading a line again
+        does not duplicate it."""
+        count = 0
+        position = 0
+        batch = []
+        lines = iter(stream)
+        while True:
+            line = next(lines, None)
+            if line is not None:
+                position += 1
+                if position <= skip:
+                    continue
+                line = line.strip()
+                if not line:
+                    continue
+                document = bson_json.loads(line, tz_aware=False)
+                if '_id' not in document:
+                    document['_id'] = _line_id(position, line)
+                batch.append(document)
+                if len(batch) < batch_size:
+                    continue
+
+            if batch:
+                yield gen.Task(self._load, batch, upsert, concurrency, timeout)
+                count += len(batch)
+                if on_progress:
+                    on_progress(count, position)
+                batch = []
+            if line is None:
+                break
+
+        if callback:
+            callback(count)
+
+    @gen.engine
+    def _load(self, documents, upsert, concurrency, timeout, callback):
+        operation = metrics.start(self.collection, 'import', upsert=upsert)
+        session = self._session_for('import')
+        if upsert:
+            # each upsert is acknowledged on its own, so no failure goes unseen
+            errors = []
+            for start in range(0, len(documents), concurrency):
+                window = documents[start:start + concurrency]
+                for index, document in enumerate(window):
+                    self._call('import', timeout, session.update, {'_id': document['_id']}, document,
+                               upsert=True, safe=True, callback=(yield gen.Callback(index)))
+                replies = yield gen.WaitAll(range(len(window)))
+                errors.extend(error for _, error in replies if error.get('error'))
+            error = errors[0] if errors else None
+        else:
+            result, error = yield gen.Task(self._call, 'import', timeout, session.insert, documents, safe=True)
+        operation.lap('wire')
+        self.collection._handle_errors(error, operation)
+        operation.finish(documents=len(documents))
+        callback()
+
+    @gen.engine
+    def get_or_create(self, query, callback, defaults=None, timeout=None, **kw):
+        operation = metrics.start(self.collection, 'get_or_create', query, **kw)
+        session = self._session_for('get_or_create')
+        result, error = yield gen.Task(self._call, 'get_or_create', timeout, session.find_one, query, **kw)
+        operation.lap('wire')
+        operation.fail(error)
+        deadline.check(error, operation)
 
         if result and result[0]:
             instance = self.collection.create(result[0])
@@ -41,11 +419,13 @@ class Manager(object):
         else:
             created = True
             instance = self.collection.create(defaults)
+        operation.lap('hydration')
+        operation.finish(documents=int(not created))
 
         callback(instance, created)
 
     @gen.engine
-    def count(self, query=None, callback=None):
+    def count(self, query=None, callback=None, read_preference=None, timeout=None):
         command = {
             "count": self.collection.__collection__
         }
@@ -53,16 +433,23 @@ class Manager(object):
         if query:
             command["query"] = query
 
-        result, error = yield gen.Task(Session().command, command)
+        operation = metrics.start(self.collection, 'count', query)
+        deadline.limit(command, timeout)
+        run = self._read_method('count', 'command', collection=False, read_preference=read_preference)
+        result, error = yield gen.Task(self._call, 'count', timeout, run, command)
+        operation.lap('wire')
+        operation.fail(error)
+        deadline.check(error, operation)
         
         total = 0
         if result and len(result) > 0 and result[0].has_key('n'):
             total = int(result[0]['n'])
+        operation.finish()
         
         callback(total)
 
     @gen.engine
-    def distinct(self, key, callback, query=None):
+    def distinct(self, key, callback, query=None, read_preference=None, timeout=None):
         """Returns a list of distinct values for the given key across collection"""
         command = {
             "distinct": self.collection.__collection__,
@@ -71,15 +458,23 @@ class Manager(object):
         if query:
             command['query'] = query
 
-        result, error = yield gen.Task(Session().command, command)
+        operation = metrics.start(self.collection, 'distinct', query, key=key)
+        deadline.limit(command, timeout)
+        run = self._read_method('distinct', 'command', collection=False, read_preference=read_preference)
+        result, error = yield gen.Task(self._call, 'distinct', timeout, run, command)
+        operation.lap('wire')
+        operation.fail(error)
+        deadline.check(error, operation)
         if error['error'] or not result or not result[0]['ok']:
+            operation.finish()
             callback(None)
             return
 
+        operation.finish(documents=len(result[0]['values']))
         callback(result[0]['values'])
 
     @gen.engine
-    def sum(self, query, field, callback):
+    def sum(self, query, field, callback, read_preference=None, timeout=None):
         command = {
             "group": {
                 'ns': self.collection.__collection__,
@@ -89,17 +484,25 @@ class Manager(object):
             }
         }
 
-        result, error = yield gen.Task(Session().command, command)
+        operation = metrics.start(self.collection, 'sum', query, field=field)
+        deadline.limit(command, timeout)
+        session = self._session_for('sum', collection=False, read_preference=read_preference)
+        result, error = yield gen.Task(self._call, 'sum', timeout, session.command, command)
+        operation.lap('wire')
+        operation.fail(error)
+        deadline.check(error, operation)
         total = 0
         
         if result:
             if result[0]['retval']:
                 total = result[0]['retval'][0]['csum']
+        operation.finish()
 
         callback(total)
         
     @gen.engine
-    def geo_near(self, near, max_distance=None, num=None, spherical=None, unique_docs=None, query=None, callback=None, **kw):
+    def geo_near(self, near, max_distance=None, num=None, spherical=None, unique_docs=None, query=None, callback=None,
+                 read_preference=None, timeout=None, **kw):
 
         command = SON({"geoNear": self.collection.__collection__})
 
@@ -121,18 +524,42 @@ class Manager(object):
         if spherical != None:
             command.update({'spherical': spherical})
 
-        result, error = yield gen.Task(Session().command, command)
+        operation = metrics.start(self.collection, 'geo_near', query, near=near)
+        deadline.limit(command, timeout)
+        session = self._session_for('geo_near', collection=False, read_preference=read_preference)
+        result, error = yield gen.Task(self._call, 'geo_near', timeout, session.command, command)
+        operation.lap('wire')
+        operation.fail(error)
+        deadline.check(error, operation)
         items = []
 
         if result:
             if result[0]['ok']:
                 for item in result[0]['results']:
                     items.append(self.collection.create(item['obj']))
+        operation.lap('hydration')
+        operation.finish(documents=len(items))
         
         callback(items)
 
     @gen.engine
-    def map_reduce(self, map_, reduce_, callback, query=None, out=None):
+    def map_reduce(self, map_, reduce_, callback, query=None, out=None, timeout=None, finalize=None,
+                   incremental=None, output_model=None):
+        """Runs ``mapreduce`` over the documents matching `query`.
+
+        Without `out` the results are returned inline. With an output
+        collection, ``'name'`` or ``{'replace' | 'merge' | 'reduce': name}``
+        with an optional ``'db'``, `callback` gets a :class:`MapReduceResult`
+        that reads it, as instances of `output_model` if given.
+
+        `incremental` names a field that grows with new documents, such as
+        ``_id`` or a creation date: only the documents the previous runs did
+        not process are, and merged or reduced into the output. The highest
+        value reached, the ``_id`` of the documents processed at that value
+        and the counts of each run are kept in the ``map_reduce_watermarks``
+        collection, so documents added later with that same value are
+        picked up by the next run and none is reduced twice. The value
+        should be shared by few documents, as their ``_id`` are kept."""
         command = SON({'mapreduce': self.collection.__collection__})
 
         command.update({
@@ -140,25 +567,249 @@ class Manager(object):
             'reduce': reduce_,
         })
 
-        if query is not None:
-            command.update({'query': query})
+        if finalize is not None:
+            command['finalize'] = finalize
         if out is None:
             command.update({'out': {'inline': 1}})
+        else:
+            command['out'] = out
+        if incremental and not (isinstance(out, dict) and ('merge' in out or 'reduce' in out)):
+            raise ValueError("an incremental map_reduce merges or reduces into an output collection")
+
+        if incremental:
+            target = out.get('merge') or out.get('reduce')
+            job = '%s.%s' % (self.collection.__collection__, target)
+            watermarks = Session(WATERMARKS, **route(self.collection, 'map_reduce'))
+            result, error = yield gen.Task(deadline.call, timeout, watermarks.find_one, {'_id': job})
+            deadline.check(error)
+            stored = result[0] if result and result[0] else {}
+            previous, boundary = stored.get('value'), stored.get('boundary', [])
+            latest = yield gen.Task(self.find, query or {}, fields=[incremental], sort=[(incremental, -1)],
+                                    limit=1, read_only=True, timeout=timeout)
+            watermark = _value(latest[0], incremental) if latest else None
+            # the documents at the watermark are listed rather than bounded,
+            # those added later with the same value are left to the next run
+            at_watermark = []
+            if watermark is not None and (previous is None or watermark >= previous):
+                found = yield gen.Task(self.find, _within(query or {}, {incremental: watermark}), fields=['_id'],
+                                       read_only=True, timeout=timeout)
+                at_watermark = [item._id for item in found]
+            if watermark == previous:
+                at_watermark = [_id for _id in at_watermark if _id not in boundary]
+            if not at_watermark:
+                options = route(self.collection, 'map_reduce')
+                if out.get('db'):
+                    options['dbname'] = out['db']
+                callback(MapReduceResult(target, {'input': 0}, output_model, **options))
+                return
+
+            clauses = [{'_id': {'$in': at_watermark}}]
+            if watermark != previous:
+                bounds = {'$lt': watermark}
+                if previous is not None:
+                    bounds['$gte'] = previous
+                below = {incremental: bounds}
+                if boundary:
+                    below = _within(below, {'_id': {'$nin': boundary}})
+                clauses.insert(0, below)
+                boundary = []
+            boundary = boundary + at_watermark
+            query = _within(query or {}, {'$or': clauses})
+
+        if query is not None:
+            command.update({'query': query})
 
-        result, error = yield gen.Task(Session().command, command)
+        operation = metrics.start(self.collection, 'map_reduce', query)
+        deadline.limit(command, timeout)
+        session = self._session_for('map_reduce', collection=False)
+        result, error = yield gen.Task(self._call, 'map_reduce', timeout, session.command, command)
+        operation.lap('wire')
+        operation.fail(error)
+        deadline.check(error, operation)
         if not result or int(result[0]['ok']) != 1:
+            operation.finish()
             callback(None)
             return
 
-        callback(result[0]['results'])
+        if out is None:
+            operation.finish(documents=len(result[0]['results']))
+            callback(result[0]['results'])
+            return
+
+        counts = result[0].get('counts', {})
+        output = result[0]['result']
+        operation.finish(documents=counts.get('output'))
+        if incremental:
+            update = {'$set': {'value': watermark, 'boundary': boundary, 'counts': counts,
+                               'finished': datetime.utcnow()}}
+            result, error = yield gen.Task(deadline.call, timeout, watermarks.update, {'_id': job}, update,
+                                           upsert=True, safe=True)
+            self.collection._handle_errors(error)
+
+        options = route(self.collection, 'map_reduce')
+        if isinstance(output, dict):
+            options['dbname'] = output['db']
+            output = output['collection']
+        callback(MapReduceResult(output, counts, output_model, **options))
+
+    def aggregate(self):
+        """Starts an aggregation :class:`~asyncmongoorm.aggregation.Pipeline`
+        over the model's collection."""
+        return Pipeline(self)
+
+    @gen.engine
+    def run_pipeline(self, pipeline, callback, batch_size=None, allow_disk_use=False, model=None, on_batch=None,
+                     timeout=None):
+        """Runs the aggregation `pipeline`, a list of stages, and reads its
+        result cursor `batch_size` rows at a time; see
+        :meth:`Pipeline.run <asyncmongoorm.aggregation.Pipeline.run>`."""
+        name = self.collection.__collection__
+        command = SON([('aggregate', name), ('pipeline', pipeline),
+                       ('cursor', {'batchSize': batch_size} if batch_size else {})])
+        if allow_disk_use:
+            command['allowDiskUse'] = True
+        deadline.limit(command, timeout)
+
+        operation = metrics.start(self.collection, 'aggregate', pipeline[0].get('$match') if pipeline else None)
+        session = self._session_for('aggregate', collection=False)
+        rows = []
+        total = 0
+        cursor = None
+        while True:
+            result, error = yield gen.Task(self._call, 'aggregate', timeout, session.command, command)
+            operation.lap('wire')
+            operation.fail(error)
+            failure = error.get('error')
+            if failure is None and (not result or int(result[0]['ok']) != 1):
+                failure = DatabaseError(result[0].get('errmsg') if result else "aggregate failed")
+            if failure is not None:
+                if cursor is not None:
+                    # the rest of the result is not read, nor left open
+                    kill = SON([('killCursors', name), ('cursors', [long(cursor['id'])])])
+                    session.command(kill, callback=lambda *args, **kwargs: None)
+                deadline.check(error, operation)
+                operation.finish()
+                callback(total if on_batch else rows, error=failure)
+                return
+
+            cursor = result[0]['cursor']
+            batch = cursor['firstBatch'] if 'firstBatch' in cursor else cursor['nextBatch']
+            if model is not None:
+                batch = [model.create(row) for row in batch]
+            operation.lap('hydration')
+            total += len(batch)
+            if on_batch:
+                on_batch(batch)
+            else:
+                rows.extend(batch)
+            if not cursor['id']:
+                break
+            command = SON([('getMore', long(cursor['id'])), ('collection', name)])
+            if batch_size:
+                command['batchSize'] = batch_size
+
+        operation.finish(documents=total)
+        callback(total if on_batch else rows)
+
+    def update_later(self, _id, values=None, increments=None):
+        """Buffers a ``$set`` of `values` and an ``$inc`` of `increments`
+        on the document `_id` in the model's write-behind buffer."""
+        writebehind.buffer_for(self.collection).update(self.collection, _id, values, increments)
 
     @gen.engine
-    def drop(self, callback=None):
-        yield gen.Task(Session(self.collection.__collection__).remove)
+    def drop(self, callback=None, timeout=None):
+        operation = metrics.start(self.collection, 'drop')
+        session = self._session_for('drop')
+        result, error = yield gen.Task(self._call, 'drop', timeout, session.remove)
+        operation.lap('wire')
+        operation.fail(error)
+        deadline.check(error, operation)
+        operation.finish()
         if callback:
             callback()
           
             
+def _line_id(position, line):
+    """The same ObjectId for the same line at the same position."""
+    if isinstance(line, unicode):
+        line = line.encode('utf-8')
+    return ObjectId(hashlib.md5('%d:%s' % (position, line)).digest()[:12])
+
+
+def _within(query, clause):
+    """`query` narrowed by `clause`."""
+    if not clause:
+        return query
+    if any(name in query for name in clause):
+        return {'$and': [query, clause]}
+    return dict(query, **clause)
+
+def _value(instance, key):
+    if key in instance._data:
+        return instance._data[key]
+    return getattr(instance, key, None)
+
+
+@gen.engine
+def prefetch_related(instances, paths, callback, timeout=None):
+    """Loads the documents referenced by the ReferenceFields of
+    `instances` named in `paths`, with one ``$in`` query per target model.
+    A path like ``'author.company'`` goes on to prefetch the references of
+    the loaded documents."""
+    if isinstance(paths, basestring):
+        paths = (paths,)
+    if not instances:
+        callback(instances)
+        return
+
+    model = type(instances[0])
+    fields = dict((field.name, field) for field in model._fields)
+    nested = {}
+    for path in paths:
+        name, _, rest = path.partition('.')
+        if not isinstance(fields.get(name), ReferenceField):
+            raise ValueError("%s has no ReferenceField %s" % (model.__name__, name))
+        nested.setdefault(name, [])
+        if rest:
+            nested[name].append(rest)
+
+    wanted = {}
+    for name in nested:
+        ids = wanted.setdefault(fields[name].target_model, set())
+        ids.update(getattr(instance, name) for instance in instances)
+        ids.discard(None)
+
+    identity_map = identitymap.current()
+    loaded = {}
+    for target, ids in wanted.iteritems():
+        known = loaded[target] = {}
+        if identity_map is not None:
+            for _id in list(ids):
+                instance = identity_map.get(target, _id)
+                if instance is not None:
+                    known[_id] = instance
+                    ids.discard(_id)
+        if ids:
+            target.objects.find({'_id': {'$in': list(ids)}}, callback=(yield gen.Callback(target)), timeout=timeout)
+    pending = [target for target, ids in wanted.iteritems() if ids]
+    if pending:
+        results = yield gen.WaitAll(pending)
+        for target, documents in zip(pending, results):
+            loaded[target].update((document._id, document) for document in documents)
+
+    for name, rest in nested.iteritems():
+        known = loaded[fields[name].target_model]
+        related = {}
+        for instance in instances:
+            _id = getattr(instance, name)
+            if _id in known:
+                related[_id] = instance._related[name] = known[_id]
+        if rest:
+            yield gen.Task(prefetch_related, related.values(), rest, timeout=timeout)
+
+    callback(instances)
+
+
 def attach(model_cls):
     """
     Short-cut decorator that attaches manger to a model class
@@ -0,0 +1,1244 @@
+# coding: utf-8
+"""In-process stand-in for :class:`asyncmongo.Client`.
+
+The memory backend keeps every database in a python dict and answers the
+subset of the asyncmongo API the ORM relies on: ``find``, ``find_one``,
+``insert``, ``update``, ``remove`` and ``command``. Results are delivered on
+the IOLoop, exactly like asyncmongo does, so code (and benchmarks) written
+against it exercise the same callback paths as a live mongod::
+
+    from asyncmongoorm.memory import MemoryClient
+    Session.create('localhost', 27017, 'test', client_class=MemoryClient)
+
+JavaScript can not be evaluated in process, so ``group`` and ``mapreduce``
+accept python callables instead. ``aggregate`` understands the common
+stages and accumulators, and field paths as expressions. The ``prev.x += obj.y`` reducer generated
+by :meth:`Manager.sum` is recognized and translated.
+"""
+import copy
+import itertools
+import math
+import re
+import time
+from collections import OrderedDict
+from functools import partial
+
+from asyncmongo.errors import DataError, IntegrityError
+from bson.objectid import ObjectId
+from bson.son import SON
+from bson.timestamp import Timestamp
+from tornado.ioloop import IOLoop
+
+ASCENDING = 1
+DESCENDING = -1
+GEO2D = "2d"
+
+_RE_TYPE = type(re.compile("foo"))
+_JS_SUM = re.compile(r"prev\.(\w+)\s*\+=\s*obj\.([\w.]+)")
+
+
+class MemoryPool(object):
+    """Mimics the attributes of ``asyncmongo.pool.ConnectionPool`` that the
+    ORM touches, so ``Session.destroy`` works unchanged."""
+
+    def __init__(self, dbname=None, **kwargs):
+        self._dbname = dbname
+        self._connections = 0
+        self._idle_cache = []
+        self._maxconnections = kwargs.get('maxconnections', 0)
+
+    def close(self):
+        pass
+
+
+class MemoryClient(object):
+    """Drop-in replacement for :class:`asyncmongo.Client`.
+
+    Databases are shared by every client of the process, keyed by name, so
+    two sessions pointing to the same ``dbname`` see the same documents.
+    """
+
+    _databases = {}
+
+    def __init__(self, pool_id=None, host=None, port=None, dbname=None, io_loop=None, **kwargs):
+        self._pool = MemoryPool(dbname=dbname, **kwargs)
+        self._io_loop = io_loop
+
+    @classmethod
+    def reset(cls):
+        """Drops every in-memory database."""
+        cls._databases.clear()
+
+    @property
+    def io_loop(self):
+        return self._io_loop or IOLoop.instance()
+
+    def database(self, dbname=None):
+        dbname = dbname or self._pool._dbname
+        if dbname not in self._databases:
+            self._databases[dbname] = MemoryDatabase(dbname)
+        return self._databases[dbname]
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return self.connection(name)
+
+    def __getitem__(self, name):
+        return self.connection(name)
+
+    def connection(self, collectionname, dbname=None):
+        if not collectionname or ".." in collectionname:
+            raise DataError("collection names cannot be empty")
+        if "$" in collectionname and not collectionname.startswith("$cmd"):
+            raise DataError("collection names must not contain '$': %r" % collectionname)
+        return MemoryCursor(self, self.database(dbname), collectionname)
+
+    def collection_names(self, callback):
+        names = sorted(self.database().collections.keys())
+        self.deliver(callback, names)
+
+    def command(self, command, value=1, callback=None, check=True, allowable_errors=[], **kwargs):
+        if isinstance(command, basestring):
+            command = SON([(command, value)])
+        command.update(kwargs)
+        self.connection("$cmd").find_one(command, callback=callback, _is_command=True)
+
+    def deliver(self, callback, result, error=None):
+        if callback is None:
+            return
+        if error is not None:
+            self.io_loop.add_callback(partial(callback, None, error=error))
+        else:
+            self.io_loop.add_callback(partial(callback, result, error=None))
+
+
+class MemoryDatabase(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.collections = {}
+        self.cursors = {}
+        self.cursor_ids = itertools.count(1)
+
+    def collection(self, name, create=True):
+        if name not in self.collections:
+            if not create:
+                return None
+            self.collections[name] = MemoryCollection(self.name, name)
+        return self.collections[name]
+
+    def drop(self, name):
+        return self.collections.pop(name, None) is not None
+
+
+class Index(object):
+    """Hash index over one or more document keys."""
+
+    def __init__(self, key, unique=False, sparse=False, name=None):
+        self.key = list(key)
+        self.unique = unique
+        self.sparse = sparse
+        self.name = name or "_".join("%s_%s" % (k, d) for k, d in self.key)
+        self.entries = {}
+
+    @property
+    def fields(self):
+        return [k for k, d in self.key]
+
+    @property
+    def is_geo(self):
+        return any(d == GEO2D for k, d in self.key)
+
+    def keys_for(self, document):
+        """Returns the hashable index keys of a document (several for
+        multikey indexes over arrays), or an empty list for sparse misses."""
+        if self.is_geo:
+            return []
+        parts = []
+        for field in self.fields:
+            values = _lookup(document, field)
+            if not values:
+                if self.sparse:
+                    return []
+                values = [None]
+            expanded = []
+            for value in values:
+                if isinstance(value, list) and value:
+                    expanded.extend(value)
+                else:
+                    expanded.append(value)
+            parts.append([_hashable(v) for v in expanded])
+        keys = [()]
+        for part in parts:
+            keys = [k + (v,) for k in keys for v in part]
+        return list(set(keys))
+
+    def check(self, document, _id):
+        if not self.unique:
+            return
+        for key in self.keys_for(document):
+            owners = self.entries.get(key)
+            if owners and (len(owners) > 1 or _id not in owners):
+                raise IntegrityError("E11000 duplicate key error index: %s dup key: %r" % (self.name, key),
+                                     code=11000)
+
+    def add(self, document, _id):
+        for key in self.keys_for(document):
+            self.entries.setdefault(key, set()).add(_id)
+
+    def discard(self, document, _id):
+        for key in self.keys_for(document):
+            owners = self.entries.get(key)
+            if owners:
+                owners.discard(_id)
+                if not owners:
+                    del self.entries[key]
+
+    def lookup(self, values):
+        ids = set()
+        for value in values:
+            ids.update(self.entries.get((_hashable(value),), ()))
+        return ids
+
+
+class MemoryCollection(object):
+    """Documents of a single collection, stored by ``_id`` in insertion
+    order, plus their secondary indexes."""
+
+    def __init__(self, dbname, name):
+        self.dbname = dbname
+        self.name = name
+        self.documents = OrderedDict()
+        self.sequence = {}
+        self.counter = itertools.count()
+        self.indexes = {}
+
+    def create_index(self, key, unique=False, sparse=False, name=None):
+        index = Index(key, unique=unique, sparse=sparse, name=name)
+        if index.name in self.indexes:
+            return self.indexes[index.name]
+        for _id, document in self.documents.iteritems():
+            index.check(document, _id)
+            index.add(document, _id)
+        self.indexes[index.name] = index
+        return index
+
+    def geo_index(self):
+        for index in self.indexes.values():
+            if index.is_geo:
+                return index
+
+    def insert(self, document):
+        document = copy.deepcopy(document)
+        if '_id' not in document:
+            document['_id'] = ObjectId()
+        _id = _hashable(document['_id'])
+        if _id in self.documents:
+            raise IntegrityError("E11000 duplicate key error index: %s.%s.$_id_  dup key: { : %r }" %
+                                 (self.dbname, self.name, document['_id']), code=11000)
+        for index in self.indexes.values():
+            index.check(document, _id)
+        self.documents[_id] = document
+        self.sequence[_id] = next(self.counter)
+        for index in self.indexes.values():
+            index.add(document, _id)
+        return document
+
+    def replace(self, old, new):
+        _id = _hashable(old['_id'])
+        for index in self.indexes.values():
+            index.discard(old, _id)
+        try:
+            for index in self.indexes.values():
+                index.check(new, _id)
+        except IntegrityError:
+            for index in self.indexes.values():
+                index.add(old, _id)
+            raise
+        self.documents[_id] = new
+        for index in self.indexes.values():
+            index.add(new, _id)
+
+    def delete(self, document):
+        _id = _hashable(document['_id'])
+        for index in self.indexes.values():
+            index.discard(document, _id)
+        del self.documents[_id]
+        del self.sequence[_id]
+
+    def candidates(self, spec):
+        """Narrows the scan to the documents an index says can match."""
+        ids = None
+        if '_id' in spec:
+            values = _index_values(spec['_id'])
+            if values is not None:
+                ids = set(_hashable(v) for v in values if _hashable(v) in self.documents)
+        if ids is None:
+            for index in self.indexes.values():
+                if len(index.key) != 1 or index.is_geo or index.fields[0] not in spec:
+                    continue
+                values = _index_values(spec[index.fields[0]])
+                if values is not None:
+                    ids = index.lookup(values)
+                    break
+        if ids is None:
+            return self.documents.values()
+        return [self.documents[_id] for _id in sorted(ids, key=self.sequence.get)]
+
+    def query(self, spec):
+        return [document for document in self.candidates(spec) if match(document, spec)]
+
+
+class MemoryCursor(object):
+    """Counterpart of ``asyncmongo.cursor.Cursor``; argument checking and
+    callback signatures follow it closely."""
+
+    def __init__(self, client, database, collection):
+        self._client = client
+        self._database = database
+        self._collection_name = collection
+
+    @property
+    def full_collection_name(self):
+        return u'%s.%s' % (self._database.name, self._collection_name)
+
+    @property
+    def _collection(self):
+        return self._database.collection(self._collection_name)
+
+    def _check_callback(self, safe, callback):
+        if not isinstance(safe, bool):
+            raise TypeError("safe must be an instance of bool")
+        if safe and not callable(callback):
+            raise TypeError("callback must be callable")
+        if not safe and callback is not None:
+            raise TypeError("callback can not be used with safe=False")
+
+    def create_index(self, key_or_list, unique=False, sparse=False, name=None, callback=None):
+        if isinstance(key_or_list, basestring):
+            key_or_list = [(key_or_list, ASCENDING)]
+        error = None
+        try:
+            self._collection.create_index(key_or_list, unique=unique, sparse=sparse, name=name)
+        except IntegrityError, e:
+            error = e
+        self._client.deliver(callback, [{'ok': 1.0, 'err': None}], error)
+
+    def insert(self, doc_or_docs, manipulate=True, safe=True, check_keys=True, callback=None, **kwargs):
+        if kwargs:
+            safe = True
+        self._check_callback(safe, callback)
+
+        docs = doc_or_docs
+        if isinstance(docs, dict):
+            docs = [docs]
+
+        error = None
+        try:
+            for doc in docs:
+                if self._collection_name == 'system.indexes':
+                    collection = self._database.collection(doc['ns'].split('.', 1)[1])
+                    collection.create_index(doc['key'].items(), unique=doc.get('unique', False),
+                                            sparse=doc.get('sparse', False), name=doc.get('name'))
+                    continue
+                if check_keys:
+                    _check_keys(doc)
+                self._collection.insert(doc)
+        except IntegrityError, e:
+            error = e
+        self._client.deliver(callback, [{'ok': 1.0, 'err': None, 'n': 0}], error)
+
+    def update(self, spec, document, upsert=False, manipulate=False, safe=True, multi=False,
+               callback=None, **kwargs):
+        if not isinstance(spec, dict):
+            raise TypeError("spec must be an instance of dict")
+        if not isinstance(document, dict):
+            raise TypeError("document must be an instance of dict")
+        if not isinstance(upsert, bool):
+            raise TypeError("upsert must be an instance of bool")
+        if kwargs:
+            safe = True
+        self._check_callback(safe, callback)
+
+        collection = self._collection
+        matches = collection.query(spec)
+        if not multi:
+            matches = matches[:1]
+
+        error = None
+        status = {'ok': 1.0, 'err': None, 'n': 0, 'updatedExisting': bool(matches)}
+        try:
+            for old in matches:
+                collection.replace(old, apply_update(old, document))
+                status['n'] += 1
+            if not matches and upsert:
+                new = apply_update(_upsert_seed(spec), document)
+                status['upserted'] = collection.insert(new)['_id']
+                status['n'] = 1
+        except (IntegrityError, ValueError), e:
+            error = e if isinstance(e, IntegrityError) else IntegrityError(str(e))
+        self._client.deliver(callback, [status], error)
+
+    def remove(self, spec_or_id=None, safe=True, callback=None, **kwargs):
+        if spec_or_id is None:
+            spec_or_id = {}
+        if not isinstance(spec_or_id, dict):
+            spec_or_id = {"_id": spec_or_id}
+        if kwargs:
+            safe = True
+        self._check_callback(safe, callback)
+
+        collection = self._collection
+        matches = collection.query(spec_or_id)
+        for document in matches:
+            collection.delete(document)
+        self._client.deliver(callback, [{'ok': 1.0, 'err': None, 'n': len(matches)}])
+
+    def find_one(self, spec_or_id, **kwargs):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {"_id": spec_or_id}
+        kwargs['limit'] = -1
+        self.find(spec_or_id, **kwargs)
+
+    def find(self, spec=None, fields=None, skip=0, limit=0, timeout=True, snapshot=False,
+             tailable=False, sort=None, max_scan=None, slave_okay=False, _must_use_master=False,
+             _is_command=False, hint=None, debug=False, comment=None, callback=None):
+        if spec is None:
+            spec = {}
+        if limit is None:
+            limit = 0
+        if not isinstance(spec, dict):
+            raise TypeError("spec must be an instance of dict")
+        if not isinstance(skip, int):
+            raise TypeError("skip must be an instance of int")
+        if not isinstance(limit, (int, long)):
+            raise TypeError("limit must be an instance of int or None")
+        if not callable(callback):
+            raise TypeError("callback must be callable")
+
+        if self._collection_name == '$cmd':
+            response = run_command(self._database, spec)
+            tail = self._database.cursors.get(spec.get('getMore'))
+            if isinstance(tail, Tail) and tail.await_data and not response['cursor']['nextBatch']:
+                # an awaitData cursor holds an empty batch back for maxTimeMS
+                wait = spec.get('maxTimeMS', 1000) / 1000.0
+                self._client.io_loop.add_timeout(time.time() + wait,
+                                                 partial(self._client.deliver, callback, response))
+                return
+            self._client.deliver(callback, response)
+            return
+
+        if "$query" in spec:
+            if sort is None and "$orderby" in spec:
+                sort = spec["$orderby"].items()
+            spec = spec["$query"]
+
+        collection = self._database.collection(self._collection_name, create=False)
+        documents = collection.query(spec) if collection else []
+        if sort:
+            documents = sort_documents(documents, sort)
+        if skip:
+            documents = documents[skip:]
+        if limit:
+            documents = documents[:abs(limit)]
+        documents = [project(document, fields) for document in documents]
+
+        if limit == -1 and len(documents) == 1:
+            self._client.deliver(callback, documents[0])
+        else:
+            self._client.deliver(callback, documents)
+
+
+def _check_keys(document):
+    for key, value in document.iteritems():
+        if key.startswith('$') or '.' in key:
+            raise DataError("key %r must not start with '$' or contain '.'" % key)
+        if isinstance(value, dict):
+            _check_keys(value)
+
+
+def _hashable(value):
+    if isinstance(value, dict):
+        return tuple((k, _hashable(v)) for k, v in sorted(value.items()))
+    if isinstance(value, list):
+        return tuple(_hashable(v) for v in value)
+    return value
+
+
+def _index_values(condition):
+    """Returns the equality values an index can answer, or None."""
+    if isinstance(condition, dict):
+        if condition.keys() == ['$in'] and not any(isinstance(v, _RE_TYPE) for v in condition['$in']):
+            return list(condition['$in'])
+        if any(k.startswith('$') for k in condition):
+            return None
+        return [condition]
+    if isinstance(condition, (list, _RE_TYPE)):
+        return None
+    return [condition]
+
+
+def _lookup(document, path):
+    """Resolves a dotted path, fanning out over arrays. Returns the list of
+    values found, which is empty when the path does not exist."""
+    values = [document]
+    for part in path.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, dict):
+                if part in value:
+                    found.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit():
+                    if int(part) < len(value):
+                        found.append(value[int(part)])
+                else:
+                    for item in value:
+                        if isinstance(item, dict) and part in item:
+                            found.append(item[part])
+        values = found
+    return values
+
+
+def _expand(values):
+    for value in values:
+        yield value
+        if isinstance(value, list):
+            for item in value:
+                yield item
+
+
+def _type_order(value):
+    if value is None:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, long, float)):
+        return 2
+    if isinstance(value, basestring):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, list):
+        return 5
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, Timestamp):
+        return 10
+    return 9
+
+
+def _comparable(value):
+    # bson's Timestamp does not define an order
+    if isinstance(value, Timestamp):
+        return (value.time, value.inc)
+    return value
+
+
+def _equals(values, expected):
+    if isinstance(expected, _RE_TYPE):
+        return any(isinstance(v, basestring) and expected.search(v) for v in _expand(values))
+    if expected is None and not values:
+        return True
+    return any(v == expected for v in _expand(values))
+
+
+def _compare(values, expected, test):
+    order = _type_order(expected)
+    expected = _comparable(expected)
+    return any(_type_order(v) == order and test(_comparable(v), expected) for v in _expand(values))
+
+
+def _match_operators(values, conditions):
+    for operator, argument in conditions.iteritems():
+        if operator == '$eq':
+            ok = _equals(values, argument)
+        elif operator == '$ne':
+            ok = not _equals(values, argument)
+        elif operator == '$gt':
+            ok = _compare(values, argument, lambda a, b: a > b)
+        elif operator == '$gte':
+            ok = _compare(values, argument, lambda a, b: a >= b)
+        elif operator == '$lt':
+            ok = _compare(values, argument, lambda a, b: a < b)
+        elif operator == '$lte':
+            ok = _compare(values, argument, lambda a, b: a <= b)
+        elif operator == '$in':
+            ok = any(_equals(values, v) for v in argument)
+        elif operator == '$nin':
+            ok = not any(_equals(values, v) for v in argument)
+        elif operator == '$all':
+            ok = any(isinstance(v, list) and all(_equals([v], a) for a in argument) for v in values)
+        elif operator == '$exists':
+            ok = bool(values) == bool(argument)
+        elif operator == '$size':
+            ok = any(isinstance(v, list) and len(v) == argument for v in values)
+        elif operator == '$mod':
+            divisor, remainder = argument
+            ok = any(isinstance(v, (int, long, float)) and not isinstance(v, bool) and
+                     v % divisor == remainder for v in _expand(values))
+        elif operator == '$regex':
+            flags = 0
+            options = conditions.get('$options', '')
+            if 'i' in options:
+                flags |= re.IGNORECASE
+            if 'm' in options:
+                flags |= re.MULTILINE
+            pattern = argument if isinstance(argument, _RE_TYPE) else re.compile(argument, flags)
+            ok = _equals(values, pattern)
+        elif operator == '$options':
+            ok = True
+        elif operator == '$not':
+            if isinstance(argument, _RE_TYPE):
+                ok = not _equals(values, argument)
+            else:
+                ok = not _match_operators(values, argument)
+        elif operator == '$elemMatch':
+            ok = any(isinstance(v, list) and any(_match_element(item, argument) for item in v)
+                     for v in values)
+        elif operator in ('$near', '$within', '$maxDistance'):
+            ok = True
+        else:
+            raise ValueError("unsupported query operator %s" % operator)
+        if not ok:
+            return False
+    return True
+
+
+def _match_element(element, condition):
+    if any(k.startswith('$') for k in condition):
+        return _match_operators([element], condition)
+    return isinstance(element, dict) and match(element, condition)
+
+
+def _is_operator_dict(value):
+    return isinstance(value, dict) and value and all(k.startswith('$') for k in value)
+
+
+def match(document, spec):
+    """Returns True when ``document`` satisfies the query ``spec``."""
+    for key, condition in spec.iteritems():
+        if key == '$or':
+            if not any(match(document, sub) for sub in condition):
+                return False
+        elif key == '$and':
+            if not all(match(document, sub) for sub in condition):
+                return False
+        elif key == '$nor':
+            if any(match(document, sub) for sub in condition):
+                return False
+        elif key == '$where':
+            if not callable(condition):
+                raise ValueError("memory backend can not evaluate JavaScript $where")
+            if not condition(document):
+                return False
+        else:
+            values = _lookup(document, key)
+            if _is_operator_dict(condition):
+                if not _match_operators(values, condition):
+                    return False
+            elif not _equals(values, condition):
+                return False
+    return True
+
+
+def _sort_key(value):
+    return (_type_order(value), _comparable(value))
+
+
+def sort_documents(documents, sort):
+    if isinstance(sort, basestring):
+        sort = [(sort, ASCENDING)]
+    elif isinstance(sort, dict):
+        sort = sort.items()
+    documents = list(documents)
+    for key, direction in reversed(list(sort)):
+        if key == '$natural':
+            # documents come in insertion order
+            if direction == DESCENDING:
+                documents.reverse()
+            continue
+        documents.sort(key=lambda d: _sort_key((_lookup(d, key) or [None])[0]),
+                       reverse=direction == DESCENDING)
+    return documents
+
+
+def project(document, fields):
+    document = copy.deepcopy(document)
+    if fields is None:
+        return document
+    if isinstance(fields, (list, tuple)):
+        fields = dict((f, 1) for f in fields)
+    if not fields:
+        fields = {'_id': 1}
+    include = [f for f, v in fields.items() if v and f != '_id']
+    if include or fields.get('_id') and len(fields) == 1:
+        projected = {}
+        for field in include:
+            _copy_path(document, projected, field)
+        if fields.get('_id', 1) and '_id' in document:
+            projected['_id'] = document['_id']
+        return projected
+    for field, value in fields.items():
+        if not value:
+            _unset_path(document, field)
+    return document
+
+
+def _copy_path(source, target, path):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        if not isinstance(source, dict) or part not in source:
+            return
+        source = source[part]
+        target = target.setdefault(part, {})
+    if isinstance(source, dict) and parts[-1] in source:
+        target[parts[-1]] = source[parts[-1]]
+
+
+def _parent(document, path, create=True):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        if isinstance(document, list) and part.isdigit():
+            document = document[int(part)]
+            continue
+        if part not in document:
+            if not create:
+                return None, parts[-1]
+            document[part] = {}
+        document = document[part]
+    return document, parts[-1]
+
+
+def _unset_path(document, path):
+    parent, key = _parent(document, path, create=False)
+    if isinstance(parent, dict):
+        parent.pop(key, None)
+
+
+def _upsert_seed(spec):
+    seed = {}
+    for key, value in spec.iteritems():
+        if key.startswith('$') or _is_operator_dict(value) or isinstance(value, _RE_TYPE):
+            continue
+        parent, name = _parent(seed, key)
+        parent[name] = copy.deepcopy(value)
+    return seed
+
+
+def apply_update(document, update):
+    """Returns a copy of ``document`` with the update applied, either a
+    whole-document replacement or a set of modifier operators."""
+    if not any(k.startswith('$') for k in update):
+        new = copy.deepcopy(update)
+        if '_id' in document:
+            new['_id'] = document['_id']
+        return new
+
+    paths = [path for changes in update.itervalues() for path in changes]
+    if len(paths) != len(set(paths)):
+        raise ValueError("Cannot update a field with two operators at the same time")
+    new = copy.deepcopy(document)
+    for operator, changes in update.iteritems():
+        for path, value in changes.iteritems():
+            if path == '_id' and (operator != '$set' or value != new.get('_id')):
+                raise ValueError("Mod on _id not allowed")
+            parent, key = _parent(new, path)
+            if operator == '$set':
+                parent[key] = copy.deepcopy(value)
+            elif operator == '$unset':
+                parent.pop(key, None)
+            elif operator == '$inc':
+                parent[key] = parent.get(key, 0) + value
+            elif operator == '$push':
+                parent.setdefault(key, [])
+                if isinstance(value, dict) and '$each' in value:
+                    parent[key].extend(copy.deepcopy(value['$each']))
+                else:
+                    parent[key].append(copy.deepcopy(value))
+            elif operator == '$pushAll':
+                parent.setdefault(key, []).extend(copy.deepcopy(value))
+            elif operator == '$addToSet':
+                items = value['$each'] if isinstance(value, dict) and '$each' in value else [value]
+                current = parent.setdefault(key, [])
+                for item in items:
+                    if item not in current:
+                        current.append(copy.deepcopy(item))
+            elif operator == '$pop':
+                if parent.get(key):
+                    parent[key].pop(0 if value == -1 else -1)
+            elif operator == '$pull':
+                if isinstance(value, dict):
+                    parent[key] = [i for i in parent.get(key, []) if not _match_element(i, value)]
+                else:
+                    parent[key] = [i for i in parent.get(key, []) if i != value]
+            elif operator == '$pullAll':
+                parent[key] = [i for i in parent.get(key, []) if i not in value]
+            elif operator == '$rename':
+                if key in parent:
+                    target, target_key = _parent(new, value)
+                    target[target_key] = parent.pop(key)
+            else:
+                raise ValueError("unsupported update operator %s" % operator)
+    return new
+
+
+_commands = {}
+
+
+def command(name):
+    def _decorator(handler):
+        _commands[name.lower()] = handler
+        return handler
+    return _decorator
+
+
+def run_command(database, spec):
+    for key in spec:
+        handler = _commands.get(key.lower())
+        if handler:
+            try:
+                return handler(database, spec[key], spec)
+            except (ValueError, TypeError, KeyError), e:
+                return {'ok': 0.0, 'errmsg': "%s failed: %s" % (key, e)}
+    return {'ok': 0.0, 'errmsg': "no such cmd: %s" % (spec.keys() or [None])[0]}
+
+
+def _documents(database, name, query=None):
+    collection = database.collection(name, create=False)
+    if collection is None:
+        return []
+    return collection.query(query or {})
+
+
+@command('ping')
+def _ping(database, value, spec):
+    return {'ok': 1.0}
+
+
+@command('isMaster')
+def _is_master(database, value, spec):
+    return {'ismaster': True, 'maxBsonObjectSize': 16 * 1024 * 1024, 'ok': 1.0}
+
+
+@command('getLastError')
+def _get_last_error(database, value, spec):
+    return {'err': None, 'n': 0, 'ok': 1.0}
+
+
+@command('drop')
+def _drop(database, name, spec):
+    if not database.drop(name):
+        return {'ok': 0.0, 'errmsg': 'ns not found'}
+    return {'ok': 1.0, 'ns': '%s.%s' % (database.name, name)}
+
+
+@command('count')
+def _count(database, name, spec):
+    documents = _documents(database, name, spec.get('query'))
+    total = len(documents[spec.get('skip', 0):])
+    if spec.get('limit'):
+        total = min(total, abs(spec['limit']))
+    return {'n': float(total), 'ok': 1.0}
+
+
+@command('distinct')
+def _distinct(database, name, spec):
+    values = []
+    for document in _documents(database, name, spec.get('query')):
+        for value in _lookup(document, spec['key']):
+            for item in (value if isinstance(value, list) else [value]):
+                if item not in values:
+                    values.append(item)
+    return {'values': values, 'ok': 1.0}
+
+
+def _reducer(function):
+    """Returns a python reducer for a group command. Callables are used as
+    they are; javascript is only understood for ``prev.x += obj.y``."""
+    if callable(function):
+        return function
+    statements = _JS_SUM.findall(function)
+    if not statements:
+        raise ValueError("memory backend can not evaluate JavaScript, pass a python callable")
+
+    def reduce_(obj, prev):
+        for target, source in statements:
+            prev[target] += (_lookup(obj, source) or [0])[0]
+    return reduce_
+
+
+@command('group')
+def _group(database, group, spec):
+    reduce_ = _reducer(group['$reduce'])
+    keys = group.get('key') or {}
+    groups = []
+    by_key = {}
+    for document in _documents(database, group['ns'], group.get('cond')):
+        key = dict((k, (_lookup(document, k) or [None])[0]) for k in keys)
+        hashed = _hashable(key)
+        if hashed not in by_key:
+            by_key[hashed] = dict(key, **copy.deepcopy(group.get('initial', {})))
+            groups.append(by_key[hashed])
+        reduce_(document, by_key[hashed])
+    if group.get('finalize'):
+        for result in groups:
+            group['finalize'](result)
+    return {'retval': groups, 'count': float(sum(1 for g in groups)), 'keys': len(groups), 'ok': 1.0}
+
+
+def _distance(a, b, spherical):
+    if spherical:
+        lon1, lat1, lon2, lat2 = a[0], a[1], b[0], b[1]
+        value = (math.sin((lat2 - lat1) / 2) ** 2 +
+                 math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+        return 2 * math.asin(min(1.0, math.sqrt(value)))
+    return math.sqrt((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2)
+
+
+def _point(value):
+    if isinstance(value, dict):
+        value = value.values()
+    return [float(value[0]), float(value[1])]
+
+
+@command('geoNear')
+def _geo_near(database, name, spec):
+    collection = database.collection(name, create=False)
+    index = collection and collection.geo_index()
+    if index is None:
+        return {'ok': 0.0, 'errmsg': 'no geo index :('}
+    field = [k for k, d in index.key if d == GEO2D][0]
+    near = _point(spec['near'])
+    spherical = bool(spec.get('spherical'))
+    multiplier = spec.get('distanceMultiplier', 1)
+    results = []
+    for document in collection.query(spec.get('query') or {}):
+        locations = _lookup(document, field)
+        if not locations:
+            continue
+        distance = _distance(near, _point(locations[0]), spherical)
+        if spec.get('maxDistance') is not None and distance > spec['maxDistance']:
+            continue
+        results.append({'dis': distance * multiplier, 'obj': copy.deepcopy(document)})
+    results.sort(key=lambda r: r['dis'])
+    results = results[:spec.get('num', 100)]
+    return {'ns': '%s.%s' % (database.name, name), 'near': spec['near'], 'results': results, 'ok': 1.0}
+
+
+@command('splitVector')
+def _split_vector(database, namespace, spec):
+    (key, _), = spec['keyPattern'].items()
+    per_chunk = spec.get('maxChunkObjects')
+    if not per_chunk:
+        raise ValueError("memory backend only splits by maxChunkObjects")
+    documents = sort_documents(_documents(database, namespace.split('.', 1)[1]), [(key, 1)])
+    split_keys = []
+    for document in documents[per_chunk::per_chunk]:
+        values = _lookup(document, key)
+        split_keys.append({key: values[0] if values else None})
+    return {'splitKeys': split_keys, 'ok': 1.0}
+
+
+@command('mapreduce')
+def _map_reduce(database, name, spec):
+    map_, reduce_ = spec['map'], spec['reduce']
+    if not (callable(map_) and callable(reduce_)):
+        raise ValueError("memory backend can not evaluate JavaScript, pass python callables")
+    documents = _documents(database, name, spec.get('query'))
+    if spec.get('sort'):
+        documents = sort_documents(documents, spec['sort'])
+    if spec.get('limit'):
+        documents = documents[:spec['limit']]
+
+    emitted = {}
+    order = []
+    emits = 0
+    for document in documents:
+        for key, value in map_(copy.deepcopy(document)):
+            hashed = _hashable(key)
+            if hashed not in emitted:
+                emitted[hashed] = (key, [])
+                order.append(hashed)
+            emitted[hashed][1].append(value)
+            emits += 1
+
+    results = []
+    reduces = 0
+    for hashed in order:
+        key, values = emitted[hashed]
+        if len(values) > 1:
+            value = reduce_(key, values)
+            reduces += 1
+        else:
+            value = values[0]
+        results.append({'_id': key, 'value': value})
+
+    counts = {'input': len(documents), 'emit': emits, 'reduce': reduces, 'output': len(results)}
+    out = spec.get('out') or {'inline': 1}
+    if isinstance(out, basestring):
+        out = {'replace': out}
+    if out.get('inline'):
+        if spec.get('finalize'):
+            for result in results:
+                result['value'] = spec['finalize'](result['_id'], result['value'])
+        return {'results': results, 'timeMillis': 0, 'counts': counts, 'ok': 1.0}
+    output = database
+    if out.get('db') not in (None, database.name):
+        output = MemoryClient._databases.setdefault(out['db'], MemoryDatabase(out['db']))
+
+    (action, target), = [(a, t) for a, t in out.items() if a in ('replace', 'merge', 'reduce')]
+    if action == 'replace':
+        output.drop(target)
+    collection = output.collection(target)
+    for result in results:
+        existing = collection.documents.get(_hashable(result['_id']))
+        if existing is not None and action == 'reduce':
+            result['value'] = reduce_(result['_id'], [existing['value'], result['value']])
+        if spec.get('finalize'):
+            result['value'] = spec['finalize'](result['_id'], result['value'])
+        if existing is None:
+            collection.insert(result)
+        else:
+            collection.replace(existing, copy.deepcopy(result))
+    counts['output'] = len(collection.documents)
+    if out.get('db'):
+        target = {'db': out['db'], 'collection': target}
+    return {'result': target, 'timeMillis': 0, 'counts': counts, 'ok': 1.0}
+
+
+def _evaluate(document, expression):
+    """Value of an aggregation expression: a ``$field`` path, a document of
+    expressions or a literal."""
+    if isinstance(expression, basestring) and expression.startswith('$'):
+        value = document
+        for part in expression[1:].split('.'):
+            # a path through an array yields the array of its values
+            if isinstance(value, list):
+                value = [item[part] for item in value if isinstance(item, dict) and part in item]
+            elif isinstance(value, dict):
+                value = value.get(part)
+            else:
+                return None
+        return value
+    if isinstance(expression, dict):
+        return dict((key, _evaluate(document, value)) for key, value in expression.items())
+    return expression
+
+
+def _accumulate(operator, values):
+    numbers = [v for v in values if isinstance(v, (int, long, float)) and not isinstance(v, bool)]
+    present = [v for v in values if v is not None]
+    if operator == '$sum':
+        return sum(numbers)
+    if operator == '$avg':
+        return float(sum(numbers)) / len(numbers) if numbers else None
+    if operator == '$min':
+        return min(present, key=_sort_key) if present else None
+    if operator == '$max':
+        return max(present, key=_sort_key) if present else None
+    if operator == '$first':
+        return values[0] if values else None
+    if operator == '$last':
+        return values[-1] if values else None
+    if operator == '$push':
+        return list(values)
+    if operator == '$addToSet':
+        unique = []
+        for value in values:
+            if value not in unique:
+                unique.append(value)
+        return unique
+    raise ValueError("unsupported accumulator %s" % operator)
+
+
+def _group_stage(documents, spec):
+    groups = OrderedDict()
+    for document in documents:
+        key = _evaluate(document, spec['_id'])
+        groups.setdefault(_hashable(key), (key, []))[1].append(document)
+    results = []
+    for key, members in groups.values():
+        result = {'_id': key}
+        for name, accumulator in spec.items():
+            if name == '_id':
+                continue
+            (operator, expression), = accumulator.items()
+            result[name] = _accumulate(operator, [_evaluate(member, expression) for member in members])
+        results.append(result)
+    return results
+
+
+def _project_stage(documents, spec):
+    if all(value in (0, False) for value in spec.values()):
+        return [project(document, spec) for document in documents]
+    results = []
+    for document in documents:
+        projected = {}
+        if spec.get('_id', 1) and '_id' in document:
+            projected['_id'] = document['_id']
+        for name, value in spec.items():
+            if name == '_id' or value in (0, False):
+                continue
+            if value in (1, True):
+                _copy_path(document, projected, name)
+            else:
+                projected[name] = _evaluate(document, value)
+        results.append(projected)
+    return results
+
+
+def _unwind_stage(documents, spec):
+    if isinstance(spec, basestring):
+        spec = {'path': spec}
+    path = spec['path'][1:]
+    results = []
+    for document in documents:
+        values = _lookup(document, path)
+        items = values[0] if values and isinstance(values[0], list) else values
+        if not items:
+            if spec.get('preserveNullAndEmptyArrays'):
+                results.append(document)
+            continue
+        for item in items:
+            unwound = copy.deepcopy(document)
+            _unset_path(unwound, path)
+            _set_path(unwound, path, item)
+            results.append(unwound)
+    return results
+
+
+def _set_path(document, path, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        document = document.setdefault(part, {})
+    document[parts[-1]] = value
+
+
+def _lookup_stage(database, documents, spec):
+    foreign = _documents(database, spec['from'])
+    results = []
+    for document in documents:
+        local = _lookup(document, spec['localField']) or [None]
+        joined = [copy.deepcopy(other) for other in foreign
+                  if any(_equals(_lookup(other, spec['foreignField']), value) for value in _expand(local))]
+        document = copy.deepcopy(document)
+        _set_path(document, spec['as'], joined)
+        results.append(document)
+    return results
+
+
+def _run_stages(database, name, pipeline):
+    documents = [copy.deepcopy(document) for document in _documents(database, name)]
+    for stage in pipeline:
+        (operator, spec), = stage.items()
+        if operator == '$match':
+            documents = [document for document in documents if match(document, spec)]
+        elif operator == '$project':
+            documents = _project_stage(documents, spec)
+        elif operator == '$group':
+            documents = _group_stage(documents, spec)
+        elif operator == '$sort':
+            documents = sort_documents(documents, spec.items())
+        elif operator == '$skip':
+            documents = documents[spec:]
+        elif operator == '$limit':
+            documents = documents[:spec]
+        elif operator == '$unwind':
+            documents = _unwind_stage(documents, spec)
+        elif operator == '$lookup':
+            documents = _lookup_stage(database, documents, spec)
+        else:
+            raise ValueError("unsupported stage %s" % operator)
+    return documents
+
+
+class Tail(object):
+    """Tailable cursor left open at the end of a collection; each
+    ``getMore`` reads the matching documents inserted since."""
+
+    def __init__(self, database, name, spec, await_data=False):
+        self.database = database
+        self.namespace = '%s.%s' % (database.name, name)
+        self.name = name
+        self.spec = spec
+        self.await_data = await_data
+        self.seen = -1
+
+    def read(self, size=None):
+        collection = self.database.collection(self.name, create=False)
+        batch = []
+        if collection is None:
+            return batch
+        for _id, document in collection.documents.iteritems():
+            sequence = collection.sequence[_id]
+            if sequence <= self.seen:
+                continue
+            if size and len(batch) >= size:
+                break
+            self.seen = sequence
+            if match(document, self.spec):
+                batch.append(copy.deepcopy(document))
+        return batch
+
+
+def _batch(database, cursor_id, namespace, documents, size, field):
+    if size is None or len(documents) <= size:
+        database.cursors.pop(cursor_id, None)
+        return {'cursor': {'id': 0L, 'ns': namespace, field: documents}, 'ok': 1.0}
+    database.cursors[cursor_id] = (namespace, documents[size:])
+    return {'cursor': {'id': cursor_id, 'ns': namespace, field: documents[:size]}, 'ok': 1.0}
+
+
+@command('aggregate')
+def _aggregate(database, name, spec):
+    documents = _run_stages(database, name, spec['pipeline'])
+    if 'cursor' not in spec:
+        return {'result': documents, 'ok': 1.0}
+    namespace = '%s.%s' % (database.name, name)
+    return _batch(database, long(next(database.cursor_ids)), namespace, documents,
+                  spec['cursor'].get('batchSize'), 'firstBatch')
+
+
+@command('find')
+def _find(database, name, spec):
+    query = spec.get('filter') or {}
+    namespace = '%s.%s' % (database.name, name)
+    if spec.get('tailable'):
+        tail = Tail(database, name, query, spec.get('awaitData', False))
+        batch = tail.read(spec.get('batchSize'))
+        if not batch:
+            # like mongod, a tailable cursor finding nothing at first is dead
+            return {'cursor': {'id': 0L, 'ns': namespace, 'firstBatch': []}, 'ok': 1.0}
+        cursor_id = long(next(database.cursor_ids))
+        database.cursors[cursor_id] = tail
+        return {'cursor': {'id': cursor_id, 'ns': namespace, 'firstBatch': batch}, 'ok': 1.0}
+
+    documents = _documents(database, name, query)
+    if spec.get('sort'):
+        documents = sort_documents(documents, spec['sort'].items())
+    documents = documents[spec.get('skip', 0):]
+    if spec.get('limit'):
+        documents = documents[:spec['limit']]
+    documents = [project(document, spec.get('projection')) for document in documents]
+    return _batch(database, long(next(database.cursor_ids)), namespace, documents,
+                  spec.get('batchSize'), 'firstBatch')
+
+
+@command('getMore')
+def _get_more(database, cursor_id, spec):
+    if cursor_id not in database.cursors:
+        return {'ok': 0.0, 'errmsg': 'cursor id %s not found' % cursor_id, 'code': 43}
+    if isinstance(database.cursors[cursor_id], Tail):
+        tail = database.cursors[cursor_id]
+        return {'cursor': {'id': cursor_id, 'ns': tail.namespace, 'nextBatch': tail.read(spec.get('batchSize'))},
+                'ok': 1.0}
+    namespace, documents = database.cursors[cursor_id]
+    return _batch(database, cursor_id, namespace, documents, spec.get('batchSize'), 'nextBatch')
+
+
+@command('killCursors')
+def _kill_cursors(database, name, spec):
+    killed = [cursor_id for cursor_id in spec['cursors'] if database.cursors.pop(cursor_id, None) is not None]
+    return {'cursorsKilled': killed, 'ok': 1.0}
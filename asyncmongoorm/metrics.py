@@ -0,0 +1,274 @@
+# coding: utf-8
+"""Per-operation instrumentation of the database calls made by
+:class:`~asyncmongoorm.manager.Manager` and
+:class:`~asyncmongoorm.collection.Collection`.
+
+Every call is described by an :class:`Operation` that splits its elapsed
+time in phases: ``wire`` (the round trip through the session),
+``hydration`` (building instances from the reply), ``serialization``
+(building the document to write) and ``signal`` (running receivers).
+Finished operations are handed to the attached sinks::
+
+    from asyncmongoorm import metrics
+    histograms = metrics.HistogramSink()
+    metrics.add_sink(histograms)
+
+Sinks can also be attached to a scope with :func:`scope`, a tornado
+``StackContext`` that follows the callbacks of the code run inside it, so
+a sink only sees the operations of one request.
+
+While no sink is attached :func:`start` returns a shared no-op operation,
+so the instrumented code paths only pay for one function call.
+"""
+import bisect
+import logging
+import socket
+import threading
+import time
+from functools import partial
+
+from tornado.stack_context import StackContext
+
+_sinks = []
+
+class _ScopeState(threading.local):
+    def __init__(self):
+        self.sinks = ()
+_scope = _ScopeState()
+
+def add_sink(sink):
+    _sinks.append(sink)
+
+def remove_sink(sink):
+    _sinks.remove(sink)
+
+def clear_sinks():
+    del _sinks[:]
+
+class _SinkScope(object):
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def __enter__(self):
+        self.previous = _scope.sinks
+        _scope.sinks = self.sinks
+
+    def __exit__(self, type, value, traceback):
+        _scope.sinks = self.previous
+
+def scope(sink):
+    """Returns a StackContext that hands the operations started inside it,
+    and inside the callbacks it spawns, to `sink`."""
+    # tornado re-enters the scopes of a callback on top of whatever state
+    # it finds, so each scope restores the whole tuple it was opened with
+    return StackContext(partial(_SinkScope, _scope.sinks + (sink,)))
+
+def active_sinks():
+    return tuple(_sinks) + _scope.sinks
+
+def model_name(model):
+    return getattr(model, '__collection__', None) or getattr(model, '__name__', repr(model))
+
+
+class Operation(object):
+
+    __slots__ = ('model', 'name', 'query', 'options', 'started', 'finished', 'phases', 'documents', 'error',
+                 'sinks', '_mark')
+
+    def __init__(self, model, name, query=None, options=None, sinks=None):
+        self.sinks = sinks if sinks is not None else active_sinks()
+        self.model = model
+        self.name = name
+        self.query = query
+        self.options = options or {}
+        self.phases = {}
+        self.documents = 0
+        self.error = None
+        self.finished = None
+        self.started = self._mark = time.time()
+
+    @property
+    def model_name(self):
+        return model_name(self.model)
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    def lap(self, phase):
+        """Charges the time since the previous lap to `phase`."""
+        now = time.time()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self._mark
+        self._mark = now
+
+    def fail(self, error):
+        if isinstance(error, dict):
+            error = error.get('error')
+        if error:
+            self.error = error
+
+    def finish(self, documents=None):
+        self.finished = time.time()
+        if documents is not None:
+            self.documents = documents
+        for sink in self.sinks:
+            try:
+                sink.record(self)
+            except Exception:
+                logging.exception("metrics sink %r failed", sink)
+
+
+class _NullOperation(object):
+    """Stand-in returned by :func:`start` while no sink is attached."""
+
+    __slots__ = ()
+
+    def lap(self, phase):
+        pass
+
+    def fail(self, error):
+        pass
+
+    def finish(self, documents=None):
+        pass
+
+_null_operation = _NullOperation()
+
+def start(model, name, query=None, **options):
+    if not _sinks and not _scope.sinks:
+        return _null_operation
+    operation = Operation(model, name, query, options)
+    for sink in operation.sinks:
+        sink.begin(operation)
+    return operation
+
+
+class Sink(object):
+    """Base class of metric sinks; `record` receives each finished
+    :class:`Operation`. `begin` is called before the database call is
+    made and, unlike `record`, may raise to prevent it."""
+
+    def begin(self, operation):
+        pass
+
+    def record(self, operation):
+        raise NotImplementedError
+
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram(object):
+    """Cumulative histogram with fixed upper bounds, Prometheus style."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+    def percentile(self, ratio):
+        """Upper bound of the bucket holding the `ratio` percentile."""
+        if not self.count:
+            return None
+        wanted = ratio * self.count
+        for bound, total in self.cumulative():
+            if total >= wanted:
+                return bound
+
+
+class HistogramSink(Sink):
+    """Keeps per model, per operation histograms of every phase plus call,
+    error and document counters in memory."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}
+        self.calls = {}
+        self.errors = {}
+        self.documents = {}
+
+    def histogram(self, model, operation, phase):
+        key = (model, operation, phase)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram(self.buckets)
+        return self.histograms[key]
+
+    def record(self, operation):
+        key = (operation.model_name, operation.name)
+        self.calls[key] = self.calls.get(key, 0) + 1
+        self.documents[key] = self.documents.get(key, 0) + operation.documents
+        if operation.error:
+            self.errors[key] = self.errors.get(key, 0) + 1
+        self.histogram(key[0], key[1], 'total').observe(operation.elapsed)
+        for phase, elapsed in operation.phases.iteritems():
+            self.histogram(key[0], key[1], phase).observe(elapsed)
+
+    def snapshot(self):
+        snapshot = {}
+        for (model, name), calls in self.calls.iteritems():
+            entry = snapshot.setdefault(model, {}).setdefault(name, {})
+            entry['calls'] = calls
+            entry['errors'] = self.errors.get((model, name), 0)
+            entry['documents'] = self.documents.get((model, name), 0)
+        for (model, name, phase), histogram in self.histograms.iteritems():
+            snapshot[model][name][phase] = {
+                'count': histogram.count,
+                'sum': histogram.sum,
+                'p50': histogram.percentile(0.5),
+                'p99': histogram.percentile(0.99),
+            }
+        return snapshot
+
+    def prometheus(self, prefix='asyncmongoorm'):
+        """Renders the histograms in the Prometheus text exposition format."""
+        lines = ['# TYPE %s_operation_seconds histogram' % prefix]
+        for (model, name, phase), histogram in sorted(self.histograms.iteritems()):
+            labels = 'model="%s",operation="%s",phase="%s"' % (model, name, phase)
+            for bound, total in histogram.cumulative():
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s_operation_seconds_bucket{%s,le="%s"} %d' % (prefix, labels, le, total))
+            lines.append('%s_operation_seconds_sum{%s} %r' % (prefix, labels, histogram.sum))
+            lines.append('%s_operation_seconds_count{%s} %d' % (prefix, labels, histogram.count))
+        lines.append('# TYPE %s_documents_total counter' % prefix)
+        for (model, name), documents in sorted(self.documents.iteritems()):
+            lines.append('%s_documents_total{model="%s",operation="%s"} %d' % (prefix, model, name, documents))
+        return '\n'.join(lines) + '\n'
+
+
+class StatsdSink(Sink):
+    """Sends timings (in milliseconds) and counters to a StatsD daemon
+    over UDP. Send failures are dropped, metrics never break a request."""
+
+    def __init__(self, host='localhost', port=8125, prefix='asyncmongoorm'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(0)
+
+    def lines(self, operation):
+        name = '%s.%s.%s' % (self.prefix, operation.model_name, operation.name)
+        yield '%s.calls:1|c' % name
+        yield '%s.documents:%d|c' % (name, operation.documents)
+        if operation.error:
+            yield '%s.errors:1|c' % name
+        yield '%s.total:%.3f|ms' % (name, operation.elapsed * 1000)
+        for phase, elapsed in operation.phases.iteritems():
+            yield '%s.%s:%.3f|ms' % (name, phase, elapsed * 1000)
+
+    def record(self, operation):
+        try:
+            self.socket.sendto('\n'.join(self.lines(operation)), self.address)
+        except socket.error:
+            pass
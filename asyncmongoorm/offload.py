@@ -0,0 +1,144 @@
+# coding: utf-8
+"""Hydration of large results off the IOLoop thread.
+
+Coercing every field of thousands of documents in :meth:`Collection.create
+<asyncmongoorm.collection.Collection.create>` blocks the IOLoop, and with it
+every other request of the worker. Once offloading is enabled, the results
+of :meth:`Manager.find <asyncmongoorm.manager.Manager.find>` with at least
+`threshold` documents are hydrated by an executor and the instances are
+handed back to the IOLoop when they are ready::
+
+    from concurrent.futures import ProcessPoolExecutor
+    from asyncmongoorm import offload
+    offload.enable(ProcessPoolExecutor(2), threshold=5000)
+
+The executor is either a ``concurrent.futures`` executor or a
+``multiprocessing`` pool. A process pool keeps the CPU work away from the
+interpreter lock of the IOLoop, at the cost of pickling the documents
+there and the instances back; models must then be importable by name.
+Read-only results are not offloaded, their instances are built without
+coercion. The identity map, if any, is consulted on the IOLoop once the
+instances are back.
+
+Only the hydration moves: asyncmongo still decodes the BSON of the reply
+on the IOLoop. `threshold` counts documents, not their size nor the
+number of fields to coerce, so results of large documents want a lower
+one.
+"""
+import Queue
+import threading
+from functools import partial
+
+from tornado import stack_context
+from tornado.ioloop import IOLoop
+
+from asyncmongoorm import identitymap
+
+
+def _hydrate(model, documents):
+    # runs in the pool, where no identity map is scoped
+    return [model.create(document) for document in documents]
+
+
+def _wait(waiting):
+    # hands over the results of a multiprocessing pool in submission order
+    while True:
+        result, done = waiting.get()
+        try:
+            outcome = result.get(), None
+        except Exception, e:
+            outcome = None, e
+        done(outcome)
+
+
+class Offload(object):
+
+    def __init__(self, executor, threshold=1000, io_loop=None):
+        self.executor = executor
+        self.threshold = threshold
+        self.io_loop = io_loop
+        self.batches = 0
+        self.documents = 0
+        self.errors = 0
+        self._waiting = None
+
+    def wanted(self, count):
+        return count >= self.threshold
+
+    def hydrate(self, model, documents, callback):
+        """Calls back on the IOLoop with the instances of `model` created
+        from `documents` by the executor, or with ``callback(None,
+        error=error)`` when the executor failed to create them."""
+        io_loop = self.io_loop or IOLoop.instance()
+        callback = stack_context.wrap(callback)
+        self.batches += 1
+        self.documents += len(documents)
+
+        def deliver(items, error):
+            if error is not None:
+                self.errors += 1
+                callback(None, error=error)
+                return
+            identity_map = identitymap.current()
+            if identity_map is not None:
+                items = [_mapped(identity_map, model, item) for item in items]
+            callback(items, error=None)
+
+        def done(outcome):
+            io_loop.add_callback(partial(deliver, *outcome))
+
+        def finished(future):
+            try:
+                outcome = future.result(), None
+            except Exception, e:
+                outcome = None, e
+            done(outcome)
+
+        try:
+            if hasattr(self.executor, 'submit'):
+                self.executor.submit(_hydrate, model, documents).add_done_callback(finished)
+            else:
+                # a multiprocessing pool only calls back on success, so a
+                # thread waits for the results, or the errors
+                result = self.executor.apply_async(_hydrate, (model, documents))
+                self._waiter().put((result, done))
+        except Exception, e:
+            # a closed or broken executor
+            done((None, e))
+
+    def _waiter(self):
+        if self._waiting is None:
+            self._waiting = Queue.Queue()
+            waiter = threading.Thread(target=_wait, args=(self._waiting,))
+            waiter.daemon = True
+            waiter.start()
+        return self._waiting
+
+    def stats(self):
+        return {'batches': self.batches, 'documents': self.documents, 'errors': self.errors}
+
+
+def _mapped(identity_map, model, instance):
+    if instance.is_new():
+        return instance
+    known = identity_map.get(model, instance._id)
+    if known is not None:
+        return known
+    identity_map.add(instance)
+    return instance
+
+
+_offload = None
+
+def enable(executor, **kwargs):
+    """Hydrates the large results of every model with `executor`."""
+    global _offload
+    _offload = Offload(executor, **kwargs)
+    return _offload
+
+def disable():
+    global _offload
+    _offload = None
+
+def current():
+    return _offload
@@ -0,0 +1,190 @@
+# coding: utf-8
+"""Connection pool statistics, warm-up and adaptive sizing.
+
+asyncmongo dials a new connection whenever its idle cache is empty and
+raises ``TooManyConnections`` instead of queueing once `maxconnections`
+are in use. The time spent dialing is the wait a request pays for an
+undersized pool, and the rejections are its saturation, so those are what
+:class:`MonitoredConnectionPool` measures::
+
+    from asyncmongoorm.pool import MonitoredClient
+    Session.create('localhost', 27017, 'app', client_class=MonitoredClient,
+                   maxconnections=50, warm_up=4)
+    Session.pool_stats()
+
+With ``adaptive=(low, high)`` the number of idle connections the pool keeps
+starts at `low` and doubles, up to `high`, while acquiring a connection is
+slower than `target_wait` on average. It halves again, closing the surplus
+idle connections, once the pool is mostly idle.
+"""
+import logging
+import time
+
+from asyncmongo import Client
+from asyncmongo.errors import TooManyConnections
+from asyncmongo.pool import ConnectionPool, ConnectionPools
+
+from asyncmongoorm.metrics import Histogram
+
+ACQUIRE_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0)
+
+def pool_stats(pool):
+    """Statistics of any asyncmongo or memory pool; only the pools of
+    :class:`MonitoredClient` know more than the connection counts."""
+    if isinstance(pool, MonitoredConnectionPool):
+        return pool.stats()
+    return {
+        'in_use': pool._connections,
+        'idle': len(pool._idle_cache),
+        'max_connections': pool._maxconnections,
+    }
+
+
+class MonitoredConnectionPool(ConnectionPool):
+
+    def __init__(self, adaptive=None, target_wait=0.002, adapt_every=100, **kwargs):
+        self.logger = logging.getLogger('asyncmongoorm.pool')
+        self.acquire_time = Histogram(ACQUIRE_BUCKETS)
+        self.acquired = 0
+        self.opened = 0
+        self.closed = 0
+        self.rejected = 0
+        self.peak_in_use = 0
+
+        self.adaptive = adaptive
+        self.target_wait = target_wait
+        self.adapt_every = adapt_every
+        self._window = [0, 0.0, 0]   # acquisitions, wait, peak in use
+        if adaptive:
+            low, high = adaptive
+            # a maxcached of 0 means unlimited to asyncmongo
+            assert 0 < low <= high
+            kwargs['maxcached'] = low
+            kwargs['maxconnections'] = high
+            kwargs['mincached'] = min(kwargs.get('mincached', 0), low)
+        super(MonitoredConnectionPool, self).__init__(**kwargs)
+
+    def new_connection(self):
+        self.opened += 1
+        return super(MonitoredConnectionPool, self).new_connection()
+
+    def connection(self):
+        started = time.time()
+        try:
+            con = super(MonitoredConnectionPool, self).connection()
+        except TooManyConnections:
+            self.rejected += 1
+            raise
+        wait = time.time() - started
+        self.acquired += 1
+        self.acquire_time.observe(wait)
+        self.peak_in_use = max(self.peak_in_use, self._connections)
+        if self.adaptive:
+            self._observe(wait)
+        return con
+
+    def cache(self, con):
+        super(MonitoredConnectionPool, self).cache(con)
+        if con not in self._idle_cache:
+            self.closed += 1
+
+    def warm_up(self, count):
+        """Opens idle connections until `count` of them are ready, without
+        going over the number of idle connections the pool keeps."""
+        if self._maxcached:
+            count = min(count, self._maxcached)
+        self._condition.acquire()
+        try:
+            while len(self._idle_cache) < count:
+                self._idle_cache.append(self.new_connection())
+        finally:
+            self._condition.release()
+
+    @property
+    def size(self):
+        """Idle connections the pool keeps, 0 for unlimited."""
+        return self._maxcached
+
+    def _observe(self, wait):
+        window = self._window
+        window[0] += 1
+        window[1] += wait
+        window[2] = max(window[2], self._connections)
+        if window[0] >= self.adapt_every:
+            acquisitions, total_wait, peak = window
+            self._window = [0, 0.0, 0]
+            self.resize(total_wait / acquisitions, peak)
+
+    def resize(self, mean_wait, peak_in_use):
+        """Grows the pool when acquiring waited longer than `target_wait`,
+        shrinks it when no more than half of it was in use."""
+        low, high = self.adaptive
+        size = self._maxcached
+        if mean_wait > self.target_wait and size < high:
+            size = min(high, max(size * 2, 1))
+        elif mean_wait <= self.target_wait and peak_in_use <= size // 2 and size > low:
+            size = max(low, size // 2)
+        if size == self._maxcached:
+            return
+        self.logger.info("resizing connection pool from %d to %d idle connections (wait %.2fms, peak %d)",
+                         self._maxcached, size, mean_wait * 1000, peak_in_use)
+        self._maxcached = size
+        self._condition.acquire()
+        try:
+            while len(self._idle_cache) > size:
+                con = self._idle_cache.pop()
+                self.closed += 1
+                try:
+                    con._close()
+                except Exception:
+                    pass
+        finally:
+            self._condition.release()
+
+    def stats(self):
+        count = self.acquire_time.count
+        return {
+            'in_use': self._connections,
+            'idle': len(self._idle_cache),
+            'peak_in_use': self.peak_in_use,
+            'size': self._maxcached,
+            'max_connections': self._maxconnections,
+            'acquired': self.acquired,
+            'opened': self.opened,
+            'closed': self.closed,
+            'rejected': self.rejected,
+            'acquire_time': {
+                'count': count,
+                'mean': self.acquire_time.sum / count if count else 0.0,
+                'p50': self.acquire_time.percentile(0.5),
+                'p99': self.acquire_time.percentile(0.99),
+            },
+        }
+
+
+class MonitoredClient(Client):
+    """:class:`asyncmongo.Client` on a :class:`MonitoredConnectionPool`.
+
+    `warm_up` is a number of connections to open before the first request,
+    so the requests after a deploy don't pay for dialing. They are opened
+    by :meth:`start`, on first use at the latest, so the client can be
+    created before the process forks. The other keyword arguments go to
+    the pool."""
+
+    def __init__(self, pool_id=None, warm_up=0, **kwargs):
+        if not hasattr(ConnectionPools, '_pools'):
+            ConnectionPools._pools = {}
+        if pool_id not in ConnectionPools._pools:
+            ConnectionPools._pools[pool_id] = MonitoredConnectionPool(**kwargs)
+        self._pool = ConnectionPools._pools[pool_id]
+        self._warm_up = warm_up
+
+    def start(self):
+        """Opens the `warm_up` connections, once."""
+        if self._warm_up:
+            count, self._warm_up = self._warm_up, 0
+            self._pool.warm_up(count)
+
+    def connection(self, collectionname, dbname=None):
+        self.start()
+        return super(MonitoredClient, self).connection(collectionname, dbname)
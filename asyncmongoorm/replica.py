@@ -0,0 +1,255 @@
+# coding: utf-8
+"""In-process replicas of small reference collections.
+
+A replicated model keeps every document of its collection in memory, with
+a hash index on ``_id`` and on each field declared with an ``index``.
+:meth:`Manager.find_one <asyncmongoorm.manager.Manager.find_one>` and
+:meth:`~asyncmongoorm.manager.Manager.find` are answered from the replica,
+without a query, when they have no other arguments and every condition is
+an equality on a field, one of them indexed::
+
+    class Country(Collection):
+        __collection__ = 'country'
+        code = StringField(index='unique')
+
+    replica.replicate(Country, interval=300)
+    replica.load_all(callback=start_server)
+
+    Country.objects.find_one({'code': 'CL'}, callback=self.on_country)
+
+The replica is reloaded every `interval` seconds and follows the
+``post_save``, ``post_update`` and ``post_remove`` signals of the process,
+including the ones sent while a reload is reading the collection; the
+writes of other processes show up at the next reload. Until it is
+loaded, or when a reload fails, reads go to the database as usual.
+"""
+import copy
+import logging
+from collections import OrderedDict
+
+from tornado import gen
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from asyncmongoorm import deadline
+from asyncmongoorm import metrics
+from asyncmongoorm.session import Session, route
+from asyncmongoorm.signal import post_save, post_update, post_remove
+
+
+def _keys(value):
+    # an equality on an array field matches any of its elements
+    if isinstance(value, list):
+        return [item for item in value if _hashable(item)]
+    return [value] if _hashable(value) else []
+
+def _hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+def _matches(document, query):
+    for name, value in query.iteritems():
+        stored = document.get(name)
+        if stored != value and not (isinstance(stored, list) and value in stored):
+            return False
+    return True
+
+
+class Replica(object):
+
+    def __init__(self, model, interval=300.0, indexes=(), batch_size=1000, timeout=None, io_loop=None):
+        self.model = model
+        self.interval = interval
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.io_loop = io_loop
+        self.indexes = ('_id',) + tuple(field.name for field in model._fields
+                                        if field.index and field.name != '_id') + tuple(indexes)
+        self.loaded = False
+        self.loads = 0
+        self.hits = 0
+        self.misses = 0
+        self._documents = OrderedDict()
+        self._index = dict((name, {}) for name in self.indexes)
+        self._loading = 0
+        self._journal = []
+        self._timer = None
+        for signal in (post_save, post_update):
+            signal.connect(model, self._saved)
+        post_remove.connect(model, self._removed)
+
+    def __len__(self):
+        return len(self._documents)
+
+    def start(self, callback=None):
+        """Loads the collection and reloads it every `interval` seconds."""
+        if self._timer is None and self.interval:
+            self._timer = PeriodicCallback(self.load, self.interval * 1000, io_loop=self.io_loop or IOLoop.instance())
+            self._timer.start()
+        self.load(callback=callback)
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.stop()
+            self._timer = None
+        for signal in (post_save, post_update):
+            signal.disconnect(self.model, self._saved)
+        post_remove.disconnect(self.model, self._removed)
+
+    @gen.engine
+    def load(self, callback=None):
+        """Reads the whole collection, in ``_id`` order, and swaps it in
+        once every batch has arrived."""
+        documents = []
+        operation = metrics.start(self.model, 'replicate')
+        session = Session(self.model.__collection__, **route(self.model, 'replicate'))
+        # the signals sent until the swap are applied to the new documents
+        self._loading += 1
+        while True:
+            spec = {'_id': {'$gt': documents[-1]['_id']}} if documents else {}
+            result, error = yield gen.Task(deadline.call, self.timeout, session.find, spec, sort=[('_id', 1)],
+                                           limit=self.batch_size)
+            if error.get('error'):
+                operation.fail(error)
+                operation.finish()
+                logging.error("replica of %s was not reloaded: %s", metrics.model_name(self.model),
+                              error['error'])
+                self._loaded()
+                if callback:
+                    callback(False)
+                return
+            batch = result[0] or []
+            documents.extend(batch)
+            if len(batch) < self.batch_size:
+                break
+        operation.lap('wire')
+
+        self._documents = OrderedDict()
+        self._index = dict((name, {}) for name in self.indexes)
+        for document in documents:
+            self._add(document)
+        for _id, data in self._journal:
+            self._apply(_id, data)
+        self._loaded()
+        self.loaded = True
+        self.loads += 1
+        operation.finish(documents=len(documents))
+        if callback:
+            callback(True)
+
+    def _add(self, document):
+        self._documents[document['_id']] = document
+        for name in self.indexes:
+            for key in _keys(document.get(name)):
+                self._index[name].setdefault(key, []).append(document)
+
+    def _discard(self, _id):
+        document = self._documents.pop(_id, None)
+        if document is None:
+            return
+        for name in self.indexes:
+            for key in _keys(document.get(name)):
+                bucket = self._index[name].get(key, [])
+                bucket[:] = [indexed for indexed in bucket if indexed is not document]
+                if not bucket:
+                    self._index[name].pop(key, None)
+
+    def _loaded(self):
+        self._loading -= 1
+        if not self._loading:
+            self._journal = []
+
+    def _apply(self, _id, data):
+        if data is None:
+            self._discard(_id)
+            return
+        document = dict(self._documents.get(_id) or {})
+        document.update(data)
+        self._discard(_id)
+        self._add(document)
+
+    def _changed(self, _id, data):
+        if self._loading:
+            self._journal.append((_id, data))
+        if self.loaded:
+            self._apply(_id, data)
+
+    def _saved(self, sender, instance):
+        if instance._id is not None:
+            self._changed(instance._id, copy.deepcopy(instance._data))
+
+    def _removed(self, sender, instance):
+        self._changed(instance._id, None)
+
+    def lookup(self, query):
+        """The documents matching `query`, or None when it can not be
+        answered from memory: only an empty query and equalities on plain
+        fields, at least one of them indexed, are."""
+        if not self.loaded or not isinstance(query, dict):
+            return None
+        if not query:
+            self.hits += 1
+            return self._documents.values()
+        indexed = None
+        for name, value in query.iteritems():
+            if name.startswith('$') or '.' in name or isinstance(value, (dict, list)) or not _hashable(value):
+                self.misses += 1
+                return None
+            if indexed is None and name in self._index:
+                indexed = name
+        if indexed is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        candidates = self._index[indexed].get(query[indexed], ())
+        return [document for document in candidates if _matches(document, query)]
+
+    def stats(self):
+        return {
+            'documents': len(self._documents),
+            'loads': self.loads,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+_replicas = {}
+
+def replicate(model, **kwargs):
+    """Keeps a :class:`Replica` of `model`; it answers reads once loaded
+    with :meth:`Replica.start` or :func:`load_all`."""
+    remove(model)
+    _replicas[model] = Replica(model, **kwargs)
+    return _replicas[model]
+
+def remove(model):
+    replica = _replicas.pop(model, None)
+    if replica is not None:
+        replica.stop()
+
+def clear():
+    for model in list(_replicas):
+        remove(model)
+
+def replica_for(model):
+    return _replicas.get(model)
+
+def load_all(callback=None):
+    """Starts every replica, calling `callback` once all of them are
+    loaded."""
+    replicas = _replicas.values()
+    left = [len(replicas)]
+
+    def loaded(success):
+        left[0] -= 1
+        if not left[0] and callback:
+            callback()
+
+    if not replicas:
+        if callback:
+            callback()
+        return
+    for replica in replicas:
+        replica.start(callback=loaded)
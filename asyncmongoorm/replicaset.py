@@ -0,0 +1,232 @@
+# coding: utf-8
+"""Replica set aware client with read preferences.
+
+:class:`ReplicaSetClient` takes a list of seed members, discovers the rest
+of the set with ``isMaster`` and keeps one asyncmongo pool per member.
+Writes and commands issued on the client itself go to the primary; reads
+are sent to another member by passing a read preference to
+:class:`~asyncmongoorm.session.Session`, which
+:class:`~asyncmongoorm.manager.Manager` does from the model's
+``__read_preference__`` or the ``read_preference`` argument of a query::
+
+    Session.create_replica_set([('db1', 27017), ('db2', 27017)], 'app')
+
+    class Report(Collection):
+        __collection__ = 'report'
+        __read_preference__ = replicaset.SECONDARY
+
+    Report.objects.find({}, callback=..., read_preference=replicaset.NEAREST)
+
+Members are probed on first use, then every `heartbeat` seconds to follow
+elections and to keep the latency average used by :data:`NEAREST` up to
+date.
+"""
+import logging
+import random
+import time
+from functools import partial
+
+from asyncmongo import Client
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+PRIMARY = 'primary'
+SECONDARY = 'secondary'
+NEAREST = 'nearest'
+
+READ_PREFERENCES = (PRIMARY, SECONDARY, NEAREST)
+
+def parse_address(address, default_port=27017):
+    """Returns ``(host, port)`` from ``'host:port'``, ``'host'`` or a tuple."""
+    if isinstance(address, (tuple, list)):
+        return address[0], int(address[1])
+    host, _, port = address.partition(':')
+    return host, int(port or default_port)
+
+
+class Member(object):
+
+    def __init__(self, host, port, client):
+        self.host = host
+        self.port = port
+        self.client = client
+        self.up = False
+        self.is_primary = False
+        self.is_secondary = False
+        self.latency = None
+
+    @property
+    def address(self):
+        return '%s:%d' % (self.host, self.port)
+
+    def observe(self, latency, smoothing=0.2):
+        """Folds a round trip time into the moving average of the member."""
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += smoothing * (latency - self.latency)
+
+    def __repr__(self):
+        role = 'primary' if self.is_primary else 'secondary' if self.is_secondary else 'other'
+        return '<Member %s %s%s>' % (self.address, role, '' if self.up else ' down')
+
+
+class ReplicaSetClient(object):
+    """Stands in for :class:`asyncmongo.Client` in front of a replica set.
+
+    `seeds` is a list of ``'host:port'`` strings or ``(host, port)``
+    tuples; `host` and `port` are added to it when given. Every member gets
+    a `member_class` instance, asyncmongo's `Client` by default, created
+    with the remaining keyword arguments.
+    Until the first probe answers, the first seed is used as the primary.
+    """
+
+    def __init__(self, pool_id=None, host=None, port=None, dbname=None, seeds=(), member_class=None,
+                 heartbeat=30, latency_window=0.015, **kwargs):
+        self._pool_id = pool_id
+        self._dbname = dbname
+        self._member_class = member_class or Client
+        self._kwargs = kwargs
+        self.latency_window = latency_window
+        self.logger = logging.getLogger('asyncmongoorm.replicaset')
+        self.members = []
+
+        addresses = [parse_address(seed) for seed in seeds]
+        if host:
+            addresses.insert(0, parse_address((host, port or 27017)))
+        if not addresses:
+            raise ValueError("a replica set needs at least one seed")
+        for address in addresses:
+            self.add_member(*address)
+
+        self._heartbeat_interval = heartbeat
+        self._heartbeat = None
+        self._started = False
+
+    def start(self):
+        """Probes the members, then every `heartbeat` seconds. The client
+        starts on first use, so it can be created before the process
+        forks without touching the IOLoop."""
+        if not self._started:
+            self.refresh()
+
+    def add_member(self, host, port):
+        for member in self.members:
+            if (member.host, member.port) == (host, port):
+                return member
+        client = self._member_class(pool_id='%s_%s:%d' % (self._pool_id, host, port), host=host, port=port,
+                                     dbname=self._dbname, slave_okay=True, **self._kwargs)
+        member = Member(host, port, client)
+        self.members.append(member)
+        return member
+
+    def refresh(self, callback=None):
+        """Probes every known member, adding the ones they report. The
+        callback runs once all of them answered."""
+        if not self._started:
+            self._started = True
+            if self._heartbeat_interval:
+                self._heartbeat = PeriodicCallback(self.refresh, self._heartbeat_interval * 1000,
+                                                   io_loop=self._kwargs.get('io_loop'))
+                self._heartbeat.start()
+        pending = set()
+        seen = set()
+
+        def probe(member):
+            seen.add(member)
+            pending.add(member)
+            started = time.time()
+            try:
+                member.client.command('isMaster', callback=partial(probed, member, started))
+            except Exception, e:
+                # asyncmongo connects before sending: an unreachable member
+                # raises here instead of answering with an error
+                io_loop = self._kwargs.get('io_loop') or IOLoop.instance()
+                io_loop.add_callback(partial(probed, member, started, None, error=e))
+
+        def probed(member, started, result, error=None):
+            pending.discard(member)
+            if error or not result:
+                if member.up:
+                    self.logger.warning("replica set member %s is down: %s", member.address, error)
+                member.up = member.is_primary = member.is_secondary = False
+            else:
+                member.observe(time.time() - started)
+                member.up = True
+                member.is_primary = bool(result.get('ismaster'))
+                member.is_secondary = bool(result.get('secondary'))
+                for address in result.get('hosts', []) + result.get('passives', []):
+                    found = self.add_member(*parse_address(address))
+                    if found not in seen:
+                        probe(found)
+            if not pending and callback:
+                callback()
+
+        for member in list(self.members):
+            probe(member)
+
+    @property
+    def primary(self):
+        for member in self.members:
+            if member.up and member.is_primary:
+                return member
+        return self.members[0]
+
+    def _within_window(self, members):
+        fastest = min(member.latency for member in members)
+        return [member for member in members if member.latency <= fastest + self.latency_window]
+
+    def select(self, read_preference=PRIMARY):
+        """Returns the member a read with `read_preference` goes to.
+
+        :data:`SECONDARY` picks a secondary within the latency window of the
+        fastest one and falls back to the primary when none is up.
+        :data:`NEAREST` picks among every member within the window."""
+        if read_preference not in READ_PREFERENCES:
+            raise ValueError("unknown read preference %r" % read_preference)
+        self.start()
+        if read_preference == SECONDARY:
+            candidates = [member for member in self.members if member.up and member.is_secondary]
+        elif read_preference == NEAREST:
+            candidates = [member for member in self.members
+                          if member.up and (member.is_primary or member.is_secondary)]
+        else:
+            candidates = []
+        if not candidates:
+            return self.primary
+        return random.choice(self._within_window(candidates))
+
+    def member(self, read_preference=PRIMARY):
+        """Client of the member selected for `read_preference`."""
+        return self.select(read_preference).client
+
+    @property
+    def _pool(self):
+        # Session.destroy closes the client through its pool
+        return self
+
+    def abandon(self):
+        """Stops probing the members without touching their connections,
+        which belong to the parent process after a fork."""
+        if self._heartbeat:
+            self._heartbeat.stop()
+
+    def close(self):
+        self.abandon()
+        for member in self.members:
+            member.client._pool.close()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self.connection(name)
+
+    def __getitem__(self, name):
+        return self.connection(name)
+
+    def connection(self, collectionname, dbname=None):
+        self.start()
+        return self.primary.client.connection(collectionname, dbname)
+
+    def command(self, command, value=1, callback=None, **kwargs):
+        self.start()
+        return self.primary.client.command(command, value, callback=callback, **kwargs)
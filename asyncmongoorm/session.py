@@ -1,24 +1,184 @@
+import os
+
 from asyncmongo import Client
+from asyncmongo.pool import ConnectionPools
+from bson.son import SON
+from asyncmongoorm.pool import MonitoredClient, pool_stats
+from asyncmongoorm.replicaset import ReplicaSetClient
+
+DEFAULT_ALIAS = 'default'
+
+READ_OPERATIONS = ('find', 'find_one', 'find_columns', 'export', 'count', 'distinct', 'sum', 'geo_near')
+
+class Database(object):
+    """A database other than the session default, reached through the
+    connection pool of a session."""
+
+    def __init__(self, client, dbname):
+        self._client = client
+        self._dbname = dbname
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return self._client.connection(name, self._dbname)
+
+    def command(self, command, value=1, callback=None, **kwargs):
+        if isinstance(command, basestring):
+            command = SON([(command, value)])
+        command.update(kwargs)
+        self._client.connection("$cmd", self._dbname).find_one(command, callback=callback,
+                                                               _must_use_master=True, _is_command=True)
 
 class Session(object):
-    
+
     _session = None
+    _sessions = {}
+    _settings = {}
+    _pid = None
     _pool_id = "mydb"
-    def __new__(cls, collection_name=None):
+    _router = None
 
-        if not cls._session:
-            raise ValueError("Session is not created")
+    def __new__(cls, collection_name=None, alias=None, dbname=None, read_preference=None):
+
+        client = cls.client(alias)
+        if read_preference and isinstance(client, ReplicaSetClient):
+            client = client.member(read_preference)
+        if dbname:
+            client = Database(client, dbname)
         if collection_name:
-            return getattr(cls._session, collection_name)
-            
-        return cls._session
-        
-    @classmethod
-    def create(cls, host, port, dbname, **kwargs):
-        if not cls._session:
-            cls._session = Client(pool_id=cls._pool_id, host=host, port=port, dbname=dbname, **kwargs)
-    
-    @classmethod
-    def destroy(cls):
-        cls._session._pool.close()
-        cls._session = None
\ No newline at end of file
+            return getattr(client, collection_name)
+
+        return client
+
+    @classmethod
+    def client(cls, alias=None):
+        if cls._pid is not None and cls._pid != os.getpid():
+            cls.after_fork()
+        if alias in (None, DEFAULT_ALIAS):
+            if not cls._session:
+                raise ValueError("Session is not created")
+            return cls._session
+        if alias not in cls._sessions:
+            raise ValueError("Session %r is not created" % alias)
+        return cls._sessions[alias]
+
+    @classmethod
+    def create(cls, host, port, dbname, client_class=None, alias=None, **kwargs):
+        """Creates the session for `alias`, the default one when omitted.
+        Each alias gets its own connection pool and settings. `client_class`
+        selects the backend, asyncmongo's `Client` by default; pass
+        `asyncmongoorm.memory.MemoryClient` to run without a mongod."""
+        if alias in (None, DEFAULT_ALIAS):
+            if not cls._session:
+                cls._session = cls._connect(DEFAULT_ALIAS, host, port, dbname, client_class, kwargs)
+        elif alias not in cls._sessions:
+            cls._sessions[alias] = cls._connect(alias, host, port, dbname, client_class, kwargs)
+
+    @classmethod
+    def _connect(cls, alias, host, port, dbname, client_class, kwargs):
+        cls._settings[alias] = (host, port, dbname, client_class, kwargs)
+        cls._pid = os.getpid()
+        pool_id = cls._pool_id if alias == DEFAULT_ALIAS else "%s_%s" % (cls._pool_id, alias)
+        client_class = client_class or Client
+        return client_class(pool_id=pool_id, host=host, port=port, dbname=dbname, **kwargs)
+
+    @classmethod
+    def create_replica_set(cls, seeds, dbname, client_class=None, alias=None, **kwargs):
+        """Creates a session on the replica set reached through `seeds`, a
+        list of ``'host:port'`` strings. `client_class` is used for the
+        connection to each member. See
+        :class:`~asyncmongoorm.replicaset.ReplicaSetClient`."""
+        cls.create(None, None, dbname, client_class=ReplicaSetClient, alias=alias,
+                   seeds=seeds, member_class=client_class, **kwargs)
+
+    @classmethod
+    def after_fork(cls):
+        """Rebuilds every session of a child process with the settings they
+        were created with. The pools of these sessions inherited from the
+        parent share their sockets with it, so they are dropped without being
+        closed; pools created outside `Session` are left alone.
+
+        Sessions notice on first use that they run in another process and
+        call it themselves; calling it right after
+        ``tornado.process.fork_processes`` also starts the clients up front,
+        probing replica set members and warming up pools."""
+        inherited = set(id(pool) for pool in cls.pools())
+        for client in [cls._session] + cls._sessions.values():
+            if isinstance(client, ReplicaSetClient):
+                client.abandon()
+        for pool_id, pool in getattr(ConnectionPools, '_pools', {}).items():
+            if id(pool) in inherited:
+                del ConnectionPools._pools[pool_id]
+        cls._session = None
+        cls._sessions = {}
+        cls._pid = os.getpid()
+        for alias, (host, port, dbname, client_class, kwargs) in cls._settings.items():
+            cls.create(host, port, dbname, client_class=client_class, alias=alias, **kwargs)
+            client = cls.client(alias)
+            if isinstance(client, (ReplicaSetClient, MonitoredClient)):
+                client.start()
+
+    @classmethod
+    def destroy(cls, alias=None):
+        cls._settings.pop(alias or DEFAULT_ALIAS, None)
+        if alias in (None, DEFAULT_ALIAS):
+            cls._session._pool.close()
+            cls._session = None
+        else:
+            cls._sessions.pop(alias)._pool.close()
+
+    @classmethod
+    def aliases(cls):
+        aliases = sorted(cls._sessions)
+        if cls._session:
+            aliases.insert(0, DEFAULT_ALIAS)
+        return aliases
+
+    @classmethod
+    def pool_stats(cls, alias=None):
+        """Connection pool statistics of the session, per member address
+        for a replica set. See :mod:`asyncmongoorm.pool`."""
+        client = cls.client(alias)
+        if isinstance(client, ReplicaSetClient):
+            return dict((member.address, pool_stats(member.client._pool)) for member in client.members)
+        return pool_stats(client._pool)
+
+    @classmethod
+    def pools(cls):
+        """The connection pools of every session of the process, one per
+        member for a replica set."""
+        pools = []
+        for client in [cls._session] + cls._sessions.values():
+            if isinstance(client, ReplicaSetClient):
+                pools.extend(member.client._pool for member in client.members)
+            elif client is not None:
+                pools.append(client._pool)
+        return pools
+
+    @classmethod
+    def set_router(cls, router):
+        """Installs `router(model, operation)`, called before every database
+        operation of a model to pick the session alias. Returning None falls
+        back to the model's `__session__` attribute, then to the default."""
+        cls._router = staticmethod(router) if router else None
+
+def route(model, operation, read_preference=None):
+    """Returns the `Session` keyword arguments for an operation of `model`,
+    from the router or the model's `__session__` and `__database__`. Reads
+    also get `read_preference`, or the model's `__read_preference__`."""
+    options = {}
+    alias = None
+    if Session._router:
+        alias = Session._router(model, operation)
+    alias = alias or getattr(model, '__session__', None)
+    if alias:
+        options['alias'] = alias
+    dbname = getattr(model, '__database__', None)
+    if dbname:
+        options['dbname'] = dbname
+    if operation in READ_OPERATIONS:
+        read_preference = read_preference or getattr(model, '__read_preference__', None)
+        if read_preference:
+            options['read_preference'] = read_preference
+    return options
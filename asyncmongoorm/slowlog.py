@@ -0,0 +1,119 @@
+# coding: utf-8
+"""Opt-in slow query log.
+
+The log is a :mod:`~asyncmongoorm.metrics` sink. Every query it sees is
+reduced to its shape, the query with values replaced by placeholders, and
+counted per model, operation and shape. Queries slower than the threshold
+are written to the ``asyncmongoorm.slowlog`` logger, sampled at
+`sample_rate`::
+
+    from asyncmongoorm import slowlog
+    slowlog.enable(threshold=0.05, sample_rate=0.1)
+    ...
+    for entry in slowlog.current().shapes()[:10]:
+        print entry['model'], entry['shape'], entry['total_time']
+"""
+import json
+import logging
+import random
+
+from asyncmongoorm import metrics
+
+PLACEHOLDER = '?'
+
+READ_OPERATIONS = ('find', 'find_one', 'find_columns', 'export', 'get_or_create', 'count', 'distinct', 'sum', 'geo_near', 'map_reduce', 'aggregate')
+
+def shape(query):
+    """Returns `query` with every value replaced by a placeholder. Operator
+    and field names are kept, as are the clauses of `$and`, `$or` and
+    `$nor`, so queries that need the same index share one shape."""
+    if isinstance(query, dict):
+        normalized = {}
+        for key, value in query.iteritems():
+            if key in ('$and', '$or', '$nor') and isinstance(value, (list, tuple)):
+                normalized[key] = [shape(clause) for clause in value]
+            elif isinstance(value, dict) and any(k.startswith('$') for k in value):
+                normalized[key] = shape(value)
+            else:
+                normalized[key] = PLACEHOLDER
+        return normalized
+    if query is None:
+        return {}
+    # find_one accepts a bare _id
+    return {'_id': PLACEHOLDER}
+
+def shape_key(query):
+    return json.dumps(shape(query), sort_keys=True)
+
+
+class SlowQueryLog(metrics.Sink):
+
+    def __init__(self, threshold=0.1, sample_rate=1.0, operations=READ_OPERATIONS,
+                 logger=None):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.operations = operations
+        self.logger = logger or logging.getLogger('asyncmongoorm.slowlog')
+        self.aggregates = {}
+
+    def record(self, operation):
+        if self.operations and operation.name not in self.operations:
+            return
+        key = (operation.model_name, operation.name, shape_key(operation.query))
+        elapsed = operation.elapsed
+        slow = elapsed >= self.threshold
+
+        aggregate = self.aggregates.get(key)
+        if aggregate is None:
+            aggregate = self.aggregates[key] = {
+                'model': key[0], 'operation': key[1], 'shape': key[2],
+                'count': 0, 'slow': 0, 'total_time': 0.0, 'max_time': 0.0, 'documents': 0,
+            }
+        aggregate['count'] += 1
+        aggregate['total_time'] += elapsed
+        aggregate['max_time'] = max(aggregate['max_time'], elapsed)
+        aggregate['documents'] += operation.documents
+        if slow:
+            aggregate['slow'] += 1
+            if self.sample_rate >= 1 or random.random() < self.sample_rate:
+                self.log(operation, key[2])
+
+    def log(self, operation, query_shape):
+        options = operation.options
+        self.logger.warning(
+            "slow query: model=%s operation=%s shape=%s fields=%s sort=%s limit=%s "
+            "time=%.1fms wire=%.1fms documents=%d",
+            operation.model_name, operation.name, query_shape, options.get('fields'),
+            options.get('sort'), options.get('limit'), operation.elapsed * 1000,
+            operation.phases.get('wire', 0.0) * 1000, operation.documents)
+
+    def shapes(self, model=None, order_by='total_time'):
+        """Returns the aggregates per shape, most expensive first."""
+        entries = [dict(entry) for entry in self.aggregates.itervalues()
+                   if model is None or entry['model'] == model]
+        for entry in entries:
+            entry['mean_time'] = entry['total_time'] / entry['count']
+        return sorted(entries, key=lambda entry: entry[order_by], reverse=True)
+
+    def reset(self):
+        self.aggregates.clear()
+
+
+_log = None
+
+def enable(threshold=0.1, sample_rate=1.0, **kwargs):
+    """Attaches a process wide slow query log, replacing a previous one."""
+    global _log
+    disable()
+    _log = SlowQueryLog(threshold=threshold, sample_rate=sample_rate, **kwargs)
+    metrics.add_sink(_log)
+    return _log
+
+def disable():
+    global _log
+    if _log is not None:
+        metrics.remove_sink(_log)
+        _log = None
+
+def current():
+    return _log
@@ -0,0 +1,127 @@
+# coding: utf-8
+"""Per-request query budget and N+1 detection.
+
+A :class:`QueryTracker` counts the operations issued through
+:class:`~asyncmongoorm.manager.Manager` and
+:class:`~asyncmongoorm.collection.Collection` while its scope is active,
+including those started from callbacks of the scoped code::
+
+    tracker = QueryTracker(budget=30, raise_on_budget=True)
+    with tracker.scope():
+        User.objects.find({'active': True}, callback=self.on_users)
+
+Repeated ``find_one`` calls with the same query apart from the ``_id``
+are reported as likely N+1 patterns. :class:`QueryTrackingMixin` does the
+wiring for a tornado ``RequestHandler``.
+"""
+import logging
+
+from asyncmongoorm import metrics
+from asyncmongoorm.slowlog import PLACEHOLDER, shape_key
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def _without_id(query):
+    """Signature of a find_one query with its `_id` taken out, or None when
+    the query does not select by `_id`."""
+    if not isinstance(query, dict):
+        return repr({'_id': PLACEHOLDER})
+    if '_id' not in query:
+        return None
+    rest = dict(query, _id=PLACEHOLDER)
+    return repr(sorted(rest.items()))
+
+
+class QueryTracker(metrics.Sink):
+
+    def __init__(self, budget=None, raise_on_budget=False, n_plus_one_threshold=5, name=None,
+                 logger=None):
+        self.budget = budget
+        self.raise_on_budget = raise_on_budget
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.name = name
+        self.logger = logger or logging.getLogger('asyncmongoorm.tracker')
+        self.count = 0
+        self.operations = {}
+        self.shapes = {}
+        self.suspects = {}
+        self._ids = {}
+
+    def scope(self):
+        return metrics.scope(self)
+
+    @property
+    def over_budget(self):
+        return self.budget is not None and self.count > self.budget
+
+    def begin(self, operation):
+        self.count += 1
+        key = (operation.model_name, operation.name)
+        self.operations[key] = self.operations.get(key, 0) + 1
+
+        shape = (operation.model_name, operation.name, shape_key(operation.query))
+        self.shapes[shape] = self.shapes.get(shape, 0) + 1
+
+        if operation.name == 'find_one':
+            self._check_n_plus_one(operation)
+
+        if self.over_budget and self.raise_on_budget:
+            raise QueryBudgetExceeded("%s issued %d queries, budget is %d" %
+                                      (self.name or 'scope', self.count, self.budget))
+
+    def _check_n_plus_one(self, operation):
+        signature = _without_id(operation.query)
+        if signature is None:
+            return
+        key = (operation.model_name, signature)
+        _id = operation.query.get('_id') if isinstance(operation.query, dict) else operation.query
+        ids = self._ids.setdefault(key, set())
+        ids.add(repr(_id))
+        if len(ids) >= self.n_plus_one_threshold:
+            if key not in self.suspects:
+                self.logger.warning("possible N+1 queries in %s: find_one on %s by _id %s",
+                                    self.name or 'scope', operation.model_name, signature)
+            self.suspects[key] = len(ids)
+
+    def record(self, operation):
+        pass
+
+    def report(self):
+        """Summary of the scope, logged when over budget or N+1 suspects
+        were found."""
+        summary = {
+            'name': self.name,
+            'queries': self.count,
+            'budget': self.budget,
+            'operations': dict(('%s.%s' % key, count) for key, count in self.operations.iteritems()),
+            'n_plus_one': [{'model': model, 'query': signature, 'calls': calls}
+                           for (model, signature), calls in self.suspects.iteritems()],
+        }
+        if self.over_budget:
+            self.logger.warning("%s issued %d queries, budget is %d",
+                                self.name or 'scope', self.count, self.budget)
+        return summary
+
+
+class QueryTrackingMixin(object):
+    """Tracks the queries of each request of a tornado ``RequestHandler``.
+
+    The budget comes from the `query_budget` attribute or application
+    setting, and is enforced by raising when the application runs in debug
+    mode. The summary is logged when the request finishes."""
+
+    query_budget = None
+
+    def _execute(self, transforms, *args, **kwargs):
+        budget = self.query_budget or self.settings.get('query_budget')
+        self.query_tracker = QueryTracker(budget=budget, raise_on_budget=self.settings.get('debug', False),
+                                          name="%s %s" % (self.request.method, self.request.path))
+        with self.query_tracker.scope():
+            return super(QueryTrackingMixin, self)._execute(transforms, *args, **kwargs)
+
+    def finish(self, chunk=None):
+        result = super(QueryTrackingMixin, self).finish(chunk)
+        self.query_tracker.report()
+        return result
@@ -0,0 +1,216 @@
+# coding: utf-8
+"""Write-behind buffering of frequent updates.
+
+A :class:`WriteBehind` buffer keeps the ``$set`` and ``$inc`` of each
+document in memory, coalescing the updates made to the same ``_id``
+until it is flushed, `interval` seconds after the first pending update or
+as soon as `max_pending` documents are waiting::
+
+    from asyncmongoorm import writebehind
+    writebehind.enable(interval=1.0)
+
+    User.objects.update_later(user_id, values={'last_seen': now})
+    Article.objects.update_later(article_id, increments={'views': 1})
+
+A model can use its own buffer, or opt out, with ``__write_behind__``.
+Buffered updates are lost if the process dies before they are flushed,
+so call :func:`shutdown` when stopping gracefully. Each flushed update is
+reported to the :mod:`~asyncmongoorm.metrics` sinks as an ``update``
+operation and a failed one is handed to `on_error`.
+"""
+import logging
+import time
+import weakref
+from functools import partial
+
+from tornado.ioloop import IOLoop
+
+from asyncmongoorm import metrics
+from asyncmongoorm.session import Session, route
+from asyncmongoorm.writeconcern import ACKNOWLEDGED
+
+_buffers = weakref.WeakSet()
+
+
+def log_error(model, _id, update, error):
+    logging.error("write-behind update of %s %r failed: %s (%r)", metrics.model_name(model), _id, error, update)
+
+
+def _is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
+class WriteBehind(object):
+
+    def __init__(self, interval=1.0, max_pending=1000, upsert=False, write_concern=None, on_error=log_error,
+                 io_loop=None):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.upsert = upsert
+        self.write_concern = write_concern or ACKNOWLEDGED
+        self.on_error = on_error
+        self.io_loop = io_loop
+        self.writes = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.flushed = 0
+        self.errors = 0
+        self._pending = {}
+        self._in_flight = {}
+        self._timer = None
+        _buffers.add(self)
+
+    def update(self, model, _id, values=None, increments=None):
+        """Buffers a ``$set`` of `values` and an ``$inc`` of `increments`
+        on the document `_id` of `model`. Incrementing a field set to a
+        value that is not a number is left to a second update, sent after
+        the first one is answered."""
+        for field, amount in (increments or {}).iteritems():
+            if not _is_number(amount):
+                raise ValueError("increment of %s must be a number, not %r" % (field, amount))
+        key = (model, _id)
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = [({}, {})]
+        else:
+            self.coalesced += 1
+        self.writes += 1
+
+        changes, increased = pending[-1]
+        for field, value in (values or {}).iteritems():
+            changes[field] = value
+            increased.pop(field, None)
+        for field, amount in (increments or {}).iteritems():
+            if field not in changes:
+                increased[field] = increased.get(field, 0) + amount
+            elif _is_number(changes[field]):
+                # a field already set is set to its incremented value
+                changes[field] += amount
+            else:
+                # one update can not both $set and $inc a field, the
+                # increment follows in an update of its own
+                changes, increased = {}, {field: amount}
+                pending.append((changes, increased))
+
+        if len(self._pending) >= self.max_pending:
+            self.flush()
+        elif self._timer is None:
+            io_loop = self.io_loop or IOLoop.instance()
+            self._timer = io_loop.add_timeout(time.time() + self.interval, self._expired)
+
+    def _expired(self):
+        self._timer = None
+        self.flush()
+
+    def flush(self, callback=None):
+        """Sends the pending updates, calling `callback` once every one of
+        them has been answered. The updates of a document still waiting
+        for the answer to a previous flush are sent after it."""
+        if self._timer is not None:
+            (self.io_loop or IOLoop.instance()).remove_timeout(self._timer)
+            self._timer = None
+        pending, self._pending = self._pending, {}
+        if not pending:
+            if callback:
+                callback()
+            return
+        self.flushes += 1
+        left = [len(pending)]
+
+        def send(key, updates):
+            model, _id = key
+            changes, increased = updates.pop(0)
+            update = {}
+            if changes:
+                update['$set'] = changes
+            if increased:
+                update['$inc'] = increased
+            self.flushed += 1
+            operation = metrics.start(model, 'update', {'_id': _id}, write_behind=True)
+            reply = partial(done, key, update, operation, updates)
+            try:
+                session = Session(model.__collection__, **route(model, 'update'))
+                self.write_concern.write(session.update, {'_id': _id}, update, upsert=self.upsert, safe=True,
+                                         callback=reply)
+            except Exception, e:
+                reply(None, error=e)
+
+        def done(key, update, operation, updates, result, error=None):
+            model, _id = key
+            operation.lap('wire')
+            if error is not None:
+                self.errors += 1
+                operation.fail(error)
+                self.on_error(model, _id, update, error)
+            operation.finish(documents=int(error is None))
+            if updates:
+                # the updates of a document are sent one after the other
+                send(key, updates)
+                return
+            waiting = self._in_flight[key]
+            if waiting:
+                waiting.pop(0)()
+            else:
+                del self._in_flight[key]
+            left[0] -= 1
+            if not left[0] and callback:
+                callback()
+
+        for key, updates in pending.iteritems():
+            if key in self._in_flight:
+                self._in_flight[key].append(partial(send, key, updates))
+            else:
+                self._in_flight[key] = []
+                send(key, updates)
+
+    def stats(self):
+        return {
+            'pending': len(self._pending) + sum(len(waiting) for waiting in self._in_flight.values()),
+            'writes': self.writes,
+            'coalesced': self.coalesced,
+            'flushes': self.flushes,
+            'flushed': self.flushed,
+            'errors': self.errors,
+        }
+
+
+_buffer = None
+
+def enable(**kwargs):
+    """Buffers the updates of every model without a ``__write_behind__``
+    of its own."""
+    global _buffer
+    _buffer = WriteBehind(**kwargs)
+    return _buffer
+
+def disable():
+    global _buffer
+    _buffer = None
+
+def current():
+    return _buffer
+
+def buffer_for(model):
+    buffer = getattr(model, '__write_behind__', None)
+    if buffer is None:
+        buffer = _buffer
+    if not buffer:
+        raise ValueError("write-behind is not enabled for %s" % metrics.model_name(model))
+    return buffer
+
+def shutdown(callback=None):
+    """Flushes every buffer, calling `callback` once all of them are."""
+    buffers = list(_buffers)
+    left = [len(buffers)]
+
+    def flushed():
+        left[0] -= 1
+        if not left[0] and callback:
+            callback()
+
+    if not buffers:
+        if callback:
+            callback()
+        return
+    for buffer in buffers:
+        buffer.flush(callback=flushed)
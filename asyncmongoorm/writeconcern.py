@@ -0,0 +1,182 @@
+# coding: utf-8
+"""Write concerns of :meth:`Collection.save
+<asyncmongoorm.collection.Collection.save>` and
+:meth:`~asyncmongoorm.collection.Collection.remove`.
+
+A model picks one with ``__write_concern__`` and a call can override it
+with its `write_concern` argument::
+
+    class PageView(Collection):
+        __collection__ = 'page_view'
+        __write_concern__ = writeconcern.UNACKNOWLEDGED
+
+    entry.save(callback=..., write_concern=WriteConcern(w=2, wtimeout=500))
+
+Unacknowledged writes call back as soon as they are written to the
+socket. :class:`GroupCommit` sends the writes made during one IOLoop
+iteration as ``insert``, ``update`` and ``delete`` write commands, one per
+run of consecutive writes of the same kind to the same collection, and
+calls every writer back with the outcome of its own write.
+"""
+from functools import partial
+
+from asyncmongo import message
+from asyncmongo.cursor import Cursor
+from asyncmongo.errors import DatabaseError, IntegrityError
+from bson.son import SON
+from tornado.ioloop import IOLoop
+
+class WriteConcern(object):
+
+    def __init__(self, w=1, j=False, wtimeout=None):
+        self.w = w
+        self.j = j
+        self.wtimeout = wtimeout
+
+    @property
+    def acknowledged(self):
+        return self.w != 0 or self.j
+
+    def options(self):
+        """``getLastError`` arguments, none for a plain acknowledged write."""
+        options = {}
+        if self.w not in (0, 1):
+            options['w'] = self.w
+        if self.j:
+            options['j'] = True
+        if self.wtimeout is not None:
+            options['wtimeout'] = self.wtimeout
+        return options
+
+    def write(self, method, *args, **kwargs):
+        """Runs the asyncmongo write `method` with this concern."""
+        callback = kwargs.pop('callback')
+        if not self.acknowledged:
+            kwargs['safe'] = False
+            method(*args, **kwargs)
+            callback(None, error=None)
+            return
+        kwargs.update(self.options())
+        method(*args, callback=callback, **kwargs)
+
+    def __repr__(self):
+        return '<%s w=%r j=%r wtimeout=%r>' % (self.__class__.__name__, self.w, self.j, self.wtimeout)
+
+
+UNACKNOWLEDGED = WriteConcern(w=0)
+ACKNOWLEDGED = WriteConcern()
+JOURNALED = WriteConcern(j=True)
+MAJORITY = WriteConcern(w='majority')
+
+
+def _statements(cursor, name, args, kwargs):
+    """Write command name, statements key and statements of an asyncmongo
+    cursor write."""
+    if name == 'insert':
+        docs = args[0] if isinstance(args[0], list) else [args[0]]
+        return 'insert', 'documents', docs
+    if name == 'update':
+        return 'update', 'updates', [{'q': args[0], 'u': args[1], 'upsert': kwargs.get('upsert', False),
+                                      'multi': kwargs.get('multi', False)}]
+    if name == 'remove':
+        spec = args[0] if args else {}
+        if not isinstance(spec, dict):
+            spec = {'_id': spec}
+        return 'delete', 'deletes', [{'q': spec, 'limit': 0}]
+    raise ValueError("%s can not be group committed" % name)
+
+
+class GroupCommit(WriteConcern):
+    """Sends the writes of an IOLoop iteration, or `max_batch` of them,
+    together.
+
+    Consecutive writes of the same kind to the same collection go in a
+    single unordered write command, and the commands of a batch are sent
+    one after the other on a pooled connection, so a batch of updates
+    of one model costs one round trip. The ``writeErrors`` of the reply
+    tell each writer whether its own write failed. When a command can
+    not be sent, for instance on ``TooManyConnections``, each of its
+    writers gets the error. Write commands need MongoDB 2.6; backends
+    other than asyncmongo's write one acknowledged call at a time."""
+
+    def __init__(self, w=1, j=False, wtimeout=None, max_batch=100, io_loop=None):
+        super(GroupCommit, self).__init__(w or 1, j, wtimeout)
+        self.max_batch = max_batch
+        self.io_loop = io_loop
+        self.writes = 0
+        self.batches = 0
+        self._batches = {}
+
+    def write(self, method, *args, **kwargs):
+        cursor = getattr(method, 'im_self', None)
+        if not isinstance(cursor, Cursor):
+            return super(GroupCommit, self).write(method, *args, **kwargs)
+
+        callback = kwargs.pop('callback')
+        kwargs.pop('safe', None)
+        pool = cursor.__dict__['_Cursor__pool']
+        name, key, statements = _statements(cursor, method.__name__, args, kwargs)
+        batch = self._batches.get(pool)
+        if batch is None:
+            batch = self._batches[pool] = []
+            (self.io_loop or IOLoop.instance()).add_callback(partial(self.flush, pool))
+        batch.append(((cursor.full_collection_name, name, key), statements, callback))
+        self.writes += 1
+        if len(batch) >= self.max_batch:
+            self.flush(pool)
+
+    def flush(self, pool):
+        """Sends the pending writes of `pool`."""
+        batch = self._batches.pop(pool, None)
+        if not batch:
+            return
+        self.batches += 1
+        runs = []
+        for kind, statements, callback in batch:
+            if not runs or runs[-1][0] != kind:
+                runs.append((kind, []))
+            runs[-1][1].append((statements, callback))
+        self._send(pool, runs)
+
+    def _send(self, pool, runs):
+        """Sends the first of `runs` as a write command, and the others
+        once it is acknowledged."""
+        (namespace, name, key), writes = runs[0]
+        dbname, collection = namespace.split('.', 1)
+        command = SON([(name, collection), (key, [statement for statements, _ in writes for statement in statements]),
+                       ('ordered', False)])
+        if self.options():
+            command['writeConcern'] = self.options()
+        request_id, data = message.query(0, '%s.$cmd' % dbname, 0, -1, command)
+
+        # flush runs as an IOLoop callback, out of the writers' stack, so a
+        # failure is handed to each of them instead of being raised
+        connection = None
+        try:
+            connection = pool.connection()
+            connection.send_message((request_id, data), callback=partial(self._acknowledged, pool, runs))
+        except Exception, error:
+            if connection is not None:
+                connection.close()
+            self._acknowledged(pool, runs, None, error=error)
+
+    def _acknowledged(self, pool, runs, response, error=None):
+        writes = runs[0][1]
+        status = response['data'][0] if error is None and response and response['data'] else {}
+        if error is None and int(status.get('ok', 0)) != 1:
+            error = DatabaseError(status.get('errmsg', 'write command failed'))
+        if error is None and status.get('writeConcernError'):
+            error = DatabaseError(status['writeConcernError'].get('errmsg'))
+        failed = dict((failure['index'], IntegrityError(failure['errmsg'], code=failure.get('code')))
+                      for failure in status.get('writeErrors', []))
+
+        index = 0
+        for statements, callback in writes:
+            errors = [failed[i] for i in range(index, index + len(statements)) if i in failed]
+            index += len(statements)
+            if error is not None or errors:
+                callback(None, error=error or errors[0])
+            else:
+                callback([{'ok': 1.0, 'err': None, 'n': len(statements)}], error=None)
+        if len(runs) > 1:
+            self._send(pool, runs[1:])
@@ -0,0 +1,56 @@
+# coding: utf-8
+"""Model hot paths: hydration, dirty tracking, save-path documents and JSON."""
+from asyncmongoorm import bson_json
+from benchmarks.harness import benchmark
+from benchmarks.models import SIZES, model, document
+
+@benchmark('model.hydrate', SIZES)
+def hydrate(size):
+    cls, data = model(size), document(size)
+    return lambda: cls.create(data)
+
+@benchmark('model.field_set', SIZES)
+def field_set(size):
+    instance = model(size).create(document(size))
+    assignments = document(size, seed=1).items()
+
+    def operation():
+        for name, value in assignments:
+            setattr(instance, name, value)
+    return operation
+
+@benchmark('model.field_get', SIZES)
+def field_get(size):
+    instance = model(size).create(document(size))
+    names = instance._field_names
+
+    def operation():
+        for name in names:
+            getattr(instance, name)
+    return operation
+
+@benchmark('model.as_dict', SIZES)
+def as_dict(size):
+    instance = model(size).create(document(size))
+    return instance.as_dict
+
+@benchmark('model.changed_data_dict', SIZES)
+def changed_data_dict(size):
+    instance = model(size).create(document(size))
+    instance._changed_fields = set(list(instance._changed_fields)[:size // 4 or 1])
+    return instance.changed_data_dict
+
+@benchmark('json.normalize', SIZES)
+def normalize(size):
+    data = model(size).create(document(size)).as_dict()
+    return lambda: bson_json.normalize(data)
+
+@benchmark('json.dumps', SIZES)
+def dumps(size):
+    data = model(size).create(document(size)).as_dict()
+    return lambda: bson_json.dumps(data)
+
+@benchmark('json.as_dict_compat', SIZES)
+def as_dict_json_compat(size):
+    instance = model(size).create(document(size))
+    return lambda: instance.as_dict(json_compat=True)
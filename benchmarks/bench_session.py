@@ -0,0 +1,107 @@
+# coding: utf-8
+"""End-to-end Manager and Collection calls against the memory backend."""
+from bson import ObjectId
+from tornado.ioloop import IOLoop
+from tornado.stack_context import ExceptionStackContext
+
+from asyncmongoorm import metrics
+from asyncmongoorm.memory import MemoryClient
+from asyncmongoorm.session import Session
+from benchmarks.harness import benchmark
+from benchmarks.models import model, document
+
+def setup_session():
+    if Session._session is None:
+        Session.create('localhost', 27017, 'asyncmongoorm_bench', client_class=MemoryClient)
+    MemoryClient.reset()
+
+def run_sync(function, *args, **kwargs):
+    """Runs an asynchronous ORM call to completion on the IOLoop."""
+    io_loop = IOLoop.instance()
+    result = []
+    failure = []
+
+    def callback(*values):
+        result.append(values)
+        io_loop.stop()
+
+    def handle_exception(type, value, traceback):
+        failure.append((type, value, traceback))
+        io_loop.stop()
+        return True
+
+    with ExceptionStackContext(handle_exception):
+        function(*args, callback=callback, **kwargs)
+    if not result and not failure:
+        io_loop.start()
+    if failure:
+        raise failure[0][0], failure[0][1], failure[0][2]
+    return result[0]
+
+def new_instance(cls, data):
+    instance = cls()
+    instance.update_attrs(data)
+    return instance
+
+def populate(cls, size, count):
+    for seed in xrange(count):
+        run_sync(new_instance(cls, document(size, seed=seed)).save)
+
+@benchmark('session.find_one', (5, 80))
+def find_one(size):
+    setup_session()
+    cls = model(size)
+    populate(cls, size, 100)
+    _id = ObjectId('%024x' % 50)
+    return lambda: run_sync(cls.objects.find_one, {'_id': _id})
+
+@benchmark('session.find', (5, 80))
+def find(size):
+    setup_session()
+    cls = model(size)
+    populate(cls, size, 100)
+    return lambda: run_sync(cls.objects.find, {}, limit=50)
+
+@benchmark('session.insert', (5, 80))
+def insert(size):
+    setup_session()
+    cls = model(size)
+    data = document(size)
+
+    def operation():
+        data['_id'] = ObjectId()
+        run_sync(new_instance(cls, data).save)
+    return operation
+
+@benchmark('session.update', (5, 80))
+def update(size):
+    setup_session()
+    cls = model(size)
+    populate(cls, size, 1)
+    instance = run_sync(cls.objects.find_one, {})[0]
+    values = document(size, seed=7)
+
+    def operation():
+        instance.field_1 = values['field_1']
+        run_sync(instance.save)
+    return operation
+
+@benchmark('session.count', (5,))
+def count(size):
+    setup_session()
+    cls = model(size)
+    populate(cls, size, 100)
+    return lambda: run_sync(cls.objects.count, {'field_3': True})
+
+@benchmark('session.find_one_instrumented', (5,))
+def find_one_instrumented(size):
+    operation = find_one(size)
+    sink = metrics.HistogramSink()
+
+    def instrumented():
+        metrics.add_sink(sink)
+        try:
+            return operation()
+        finally:
+            metrics.remove_sink(sink)
+    return instrumented
@@ -0,0 +1,20 @@
+# coding: utf-8
+"""Signal dispatch with a growing number of connected receivers."""
+from asyncmongoorm.signal import Signal
+from benchmarks.harness import benchmark
+from benchmarks.models import model, document
+
+@benchmark('signal.send', (0, 1, 10))
+def send(receivers):
+    cls = model(5)
+    instance = cls.create(document(5))
+    signal = Signal()
+
+    class Other(object):
+        pass
+
+    for i in xrange(receivers):
+        signal.connect(cls, lambda sender, instance: None)
+        signal.connect(Other, lambda sender, instance: None)
+
+    return lambda: signal.send(instance=instance)
@@ -0,0 +1,125 @@
+# coding: utf-8
+"""Minimal benchmark harness.
+
+Benchmarks are registered with the :func:`benchmark` decorator. The
+decorated function receives one parameter (usually a model size), does its
+setup and returns the zero-argument callable to measure. For every
+parameter the harness calibrates an iteration count, keeps the best of
+several timed rounds and counts the gc-tracked objects an operation leaves
+alive, which is what hydration and dirty tracking cost in memory.
+"""
+import gc
+import json
+import platform
+import sys
+import time
+from datetime import datetime
+
+from asyncmongoorm import __version__
+
+_benchmarks = []
+
+def benchmark(name, params=(None,)):
+
+    def _decorator(setup):
+        _benchmarks.append((name, params, setup))
+        return setup
+
+    return _decorator
+
+def registered(only=None):
+    for name, params, setup in _benchmarks:
+        if only and not any(name.startswith(prefix) for prefix in only):
+            continue
+        yield name, params, setup
+
+def _key(name, param):
+    if param is None:
+        return name
+    return "%s[%s]" % (name, param)
+
+def _loop(operation, iterations):
+    started = time.time()
+    for _ in xrange(iterations):
+        operation()
+    return time.time() - started
+
+def calibrate(operation, min_time):
+    iterations = 1
+    while True:
+        elapsed = _loop(operation, iterations)
+        if elapsed >= min_time or iterations >= 10 ** 7:
+            return iterations
+        iterations *= max(2, min(10, int(min_time / max(elapsed, 1e-6))))
+
+def count_objects(operation, iterations):
+    """Net gc-tracked objects created per operation."""
+    kept = []
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        for _ in xrange(iterations):
+            kept.append(operation())
+        after = gc.get_count()[0]
+    finally:
+        gc.enable()
+    return float(after - before) / iterations
+
+def measure(operation, rounds=5, min_time=0.1):
+    iterations = calibrate(operation, min_time)
+    timings = sorted(_loop(operation, iterations) / iterations for _ in xrange(rounds))
+    return {
+        'iterations': iterations,
+        'best': timings[0],
+        'median': timings[len(timings) // 2],
+        'ops_per_sec': 1.0 / timings[0] if timings[0] else None,
+        'objects_per_op': count_objects(operation, min(iterations, 1000)),
+    }
+
+def run(only=None, rounds=5, min_time=0.1, out=sys.stdout):
+    results = {}
+    for name, params, setup in registered(only):
+        for param in params:
+            key = _key(name, param)
+            result = measure(setup(param), rounds=rounds, min_time=min_time)
+            results[key] = result
+            out.write("%-45s %12.0f ops/s %10.2f us/op %8.1f objects/op\n" % (
+                key, result['ops_per_sec'] or 0, result['best'] * 1e6, result['objects_per_op']))
+    return {
+        'meta': {
+            'version': __version__,
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'date': datetime.utcnow().isoformat(),
+            'rounds': rounds,
+            'min_time': min_time,
+        },
+        'results': results,
+    }
+
+def save(report, path):
+    with open(path, 'w') as fd:
+        json.dump(report, fd, indent=2, sort_keys=True)
+
+def load(path):
+    with open(path) as fd:
+        return json.load(fd)
+
+def compare(report, baseline, tolerance=0.1, out=sys.stdout):
+    """Prints the change of every benchmark against a baseline report and
+    returns the keys that got slower by more than `tolerance`."""
+    regressions = []
+    for key in sorted(report['results']):
+        if key not in baseline['results']:
+            continue
+        current = report['results'][key]['best']
+        previous = baseline['results'][key]['best']
+        change = (current - previous) / previous if previous else 0.0
+        flag = ''
+        if change > tolerance:
+            flag = ' REGRESSION'
+            regressions.append(key)
+        out.write("%-45s %+8.1f%%%s\n" % (key, change * 100, flag))
+    return regressions
@@ -0,0 +1,48 @@
+# coding: utf-8
+"""Deterministic models and documents of different sizes for benchmarks."""
+import random
+from datetime import datetime
+
+from bson import ObjectId
+
+from asyncmongoorm.collection import Collection
+from asyncmongoorm.field import (ObjectIdField, StringField, IntegerField, FloatField,
+                                 BooleanField, DateTimeField, ListField, ObjectField)
+
+SIZES = (5, 20, 80)
+
+_FIELD_TYPES = (StringField, IntegerField, FloatField, BooleanField, DateTimeField, ListField, ObjectField)
+
+_models = {}
+
+def model(size):
+    """Returns a Collection subclass with `size` fields besides `_id`."""
+    if size not in _models:
+        attrs = {'__collection__': 'bench_model_%d' % size, '_id': ObjectIdField()}
+        for i in xrange(size):
+            attrs['field_%d' % i] = _FIELD_TYPES[i % len(_FIELD_TYPES)]()
+        _models[size] = type('BenchModel%d' % size, (Collection,), attrs)
+    return _models[size]
+
+def _value(field_type, rnd):
+    if field_type is StringField:
+        return u'value %d' % rnd.randint(0, 10 ** 6)
+    if field_type is IntegerField:
+        return rnd.randint(0, 10 ** 6)
+    if field_type is FloatField:
+        return rnd.random() * 1000
+    if field_type is BooleanField:
+        return rnd.random() > 0.5
+    if field_type is DateTimeField:
+        return datetime(2012, 1, 1, rnd.randint(0, 23), rnd.randint(0, 59))
+    if field_type is ListField:
+        return [rnd.randint(0, 100) for _ in xrange(5)]
+    return {'key': rnd.randint(0, 100), 'nested': {'value': u'x'}}
+
+def document(size, seed=0):
+    """Returns a decoded document matching `model(size)`."""
+    rnd = random.Random(seed)
+    data = {'_id': ObjectId('%024x' % (seed + 1))}
+    for i in xrange(size):
+        data['field_%d' % i] = _value(_FIELD_TYPES[i % len(_FIELD_TYPES)], rnd)
+    return data
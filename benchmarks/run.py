@@ -0,0 +1,40 @@
+# coding: utf-8
+"""Runs the benchmark suite and stores the results as JSON.
+
+    python benchmarks/run.py --output results.json --baseline baseline.json
+"""
+import optparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import harness
+from benchmarks import bench_model, bench_signal, bench_session
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options] [benchmark prefix ...]")
+    parser.add_option('-o', '--output', default='bench_output.json',
+                      help="file to store the results in [%default]")
+    parser.add_option('-b', '--baseline', help="results file to compare against")
+    parser.add_option('-t', '--tolerance', type='float', default=0.1,
+                      help="slowdown ratio reported as a regression [%default]")
+    parser.add_option('-r', '--rounds', type='int', default=5, help="timed rounds [%default]")
+    parser.add_option('--min-time', type='float', default=0.1,
+                      help="minimum seconds per round [%default]")
+    options, only = parser.parse_args(argv)
+    baseline = options.baseline and harness.load(options.baseline)
+
+    report = harness.run(only=only, rounds=options.rounds, min_time=options.min_time)
+    harness.save(report, options.output)
+    print "results written to %s" % options.output
+
+    if options.baseline:
+        print "compared with %s:" % options.baseline
+        regressions = harness.compare(report, baseline, tolerance=options.tolerance)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+import unittest2
+from asyncmongo.errors import DatabaseError
+from bson import ObjectId
+from tornado import testing
+from asyncmongoorm import memory
+from asyncmongoorm.collection import Collection
+from asyncmongoorm.field import Field, IntegerField, ObjectIdField, StringField
+from asyncmongoorm.session import Session
+from asyncmongoorm.tracker import QueryTracker
+
+class Store(Collection):
+    __collection__ = 'store'
+    _id = ObjectIdField()
+    name = StringField()
+    city = StringField()
+
+
+class Order(Collection):
+    __collection__ = 'order'
+    _id = ObjectIdField()
+    store = ObjectIdField()
+    amount = IntegerField()
+    tags = Field(field_type=list)
+
+
+class PipelineTestCase(unittest2.TestCase):
+
+    def test_stages_are_built_in_order(self):
+        pipeline = Order.objects.aggregate().match({'amount': {'$gt': 5}}).unwind('tags') \
+            .group('$tags', total={'$sum': '$amount'}).sort('-total', '_id').skip(1).limit(2)
+        self.assertEqual([{'$match': {'amount': {'$gt': 5}}},
+                          {'$unwind': '$tags'},
+                          {'$group': {'_id': '$tags', 'total': {'$sum': '$amount'}}},
+                          {'$sort': {'total': -1, '_id': 1}},
+                          {'$skip': 1},
+                          {'$limit': 2}], pipeline.stages)
+        self.assertEqual(['total', '_id'], pipeline.stages[3]['$sort'].keys())
+
+    def test_field_names_are_checked(self):
+        with self.assertRaises(ValueError):
+            Order.objects.aggregate().match({'$or': [{'amount': 1}, {'amonut': 2}]})
+        with self.assertRaises(ValueError):
+            Order.objects.aggregate().group('$store', total={'$sum': '$price'})
+        with self.assertRaises(ValueError):
+            Order.objects.aggregate().group('$store', total={'$sum': '$amount'}).sort('amount')
+        with self.assertRaises(ValueError):
+            Order.objects.aggregate().project('amount').unwind('tags')
+        with self.assertRaises(ValueError):
+            Order.objects.aggregate().lookup(Store, 'store', 'store_id', 'shop')
+
+        pipeline = Order.objects.aggregate().project('amount', doubled={'$add': ['$amount', '$amount']})
+        self.assertEqual(set(['_id', 'amount', 'doubled']), pipeline.fields)
+        pipeline = Order.objects.aggregate().lookup(Store, 'store', '_id', 'shop').match({'shop.city': 'Rio'})
+        self.assertIn('shop', pipeline.fields)
+
+
+class RunPipelineTestCase(testing.AsyncTestCase, unittest2.TestCase):
+
+    def setUp(self):
+        super(RunPipelineTestCase, self).setUp()
+        memory.MemoryClient.reset()
+        Session._session = None
+        Session.create('localhost', 27017, 'test', client_class=memory.MemoryClient, io_loop=self.io_loop)
+        self.stores = [self.save(Store(), name=name, city=city) for name, city in ((u'a', u'Rio'), (u'b', u'Lima'))]
+        for index, amount in enumerate((10, 20, 5, 40)):
+            self.save(Order(), store=self.stores[index % 2]._id, amount=amount, tags=[u'x', u'y'][:index % 2 + 1])
+
+    def tearDown(self):
+        Session.destroy()
+        super(RunPipelineTestCase, self).tearDown()
+
+    def save(self, instance, **values):
+        instance._id = ObjectId()
+        for name, value in values.iteritems():
+            setattr(instance, name, value)
+        instance.save(callback=self.stop)
+        self.wait()
+        return instance
+
+    def test_rows_are_read_through_the_cursor(self):
+        tracker = QueryTracker()
+        with tracker.scope():
+            Order.objects.aggregate().unwind('tags').group('$tags', total={'$sum': '$amount'}, orders={'$sum': 1}) \
+                .sort('_id').run(callback=self.stop, batch_size=1)
+            rows = self.wait()
+        self.assertEqual([{'_id': u'x', 'total': 75, 'orders': 4}, {'_id': u'y', 'total': 60, 'orders': 2}], rows)
+        self.assertEqual({('order', 'aggregate'): 1}, tracker.operations)
+
+    def test_batches_can_be_streamed(self):
+        batches = []
+        Order.objects.aggregate().match({'amount': {'$gte': 10}}).run(callback=self.stop, batch_size=2,
+                                                                       allow_disk_use=True, on_batch=batches.append)
+        self.assertEqual(3, self.wait())
+        self.assertEqual([2, 1], [len(batch) for batch in batches])
+
+    def test_a_failed_batch_kills_the_cursor_and_reports_the_rows_read(self):
+        def expired(database, cursor_id, spec):
+            return {'ok': 0.0, 'errmsg': 'operation exceeded time limit', 'code': 50}
+        get_more = memory._commands['getmore']
+        memory._commands['getmore'] = expired
+        batches = []
+        try:
+            Order.objects.aggregate().sort('amount').run(callback=lambda count, error: self.stop((count, error)),
+                                                          batch_size=1, on_batch=batches.append)
+            count, error = self.wait()
+        finally:
+            memory._commands['getmore'] = get_more
+        self.assertEqual(1, count)
+        self.assertEqual([[5]], [[order['amount'] for order in batch] for batch in batches])
+        self.assertIsInstance(error, DatabaseError)
+        self.assertIn('time limit', str(error))
+        self.io_loop.add_callback(self.stop)
+        self.wait()
+        self.assertEqual({}, memory.MemoryClient._databases['test'].cursors)
+
+        memory._commands['getmore'] = expired
+        try:
+            Order.objects.aggregate().sort('amount').run(callback=lambda rows, error: self.stop((rows, error)),
+                                                          batch_size=3)
+            rows, error = self.wait()
+        finally:
+            memory._commands['getmore'] = get_more
+        self.assertEqual([5, 10, 20], [row['amount'] for row in rows])
+        self.assertIsInstance(error, DatabaseError)
+
+    def test_lookup_and_hydration(self):
+        Order.objects.aggregate().match({'amount': 40}).lookup(Store, 'store', '_id', 'shop') \
+            .project('amount', city='$shop.city').run(callback=self.stop)
+        row, = self.wait()
+        self.assertEqual({'amount': 40, 'city': [u'Lima']}, dict((k, v) for k, v in row.items() if k != '_id'))
+
+        Order.objects.aggregate().sort('-amount').limit(2).run(callback=self.stop, hydrate=True)
+        orders = self.wait()
+        self.assertIsInstance(orders[0], Order)
+        self.assertEqual([40, 20], [order.amount for order in orders])
@@ -0,0 +1,121 @@
+import time
+import unittest2
+from functools import partial
+from tornado import testing
+from tornado.ioloop import IOLoop
+from asyncmongoorm import bulkhead
+from asyncmongoorm import memory
+from asyncmongoorm.collection import Collection
+from asyncmongoorm.field import ObjectIdField, StringField
+from asyncmongoorm.session import Session
+
+class SlowClient(memory.MemoryClient):
+    """Memory client taking `delay` seconds to answer."""
+
+    delay = 0.02
+
+    def deliver(self, callback, result, error=None):
+        deliver = super(SlowClient, self).deliver
+        self.io_loop.add_timeout(time.time() + self.delay, partial(deliver, callback, result, error))
+
+
+class Report(Collection):
+    __collection__ = 'report'
+    _id = ObjectIdField()
+    name = StringField()
+
+
+class Lookup(Collection):
+    __collection__ = 'lookup'
+    _id = ObjectIdField()
+
+
+class BulkheadTestCase(testing.AsyncTestCase, unittest2.TestCase):
+
+    def get_new_ioloop(self):
+        return IOLoop.instance()
+
+    def tearDown(self):
+        bulkhead.clear()
+        super(BulkheadTestCase, self).tearDown()
+
+    def test_most_specific_bulkhead_applies(self):
+        default = bulkhead.limit(10)
+        model = bulkhead.limit(5, model=Report)
+        scan = bulkhead.limit(1, model=Report, operation='find')
+        self.assertIs(scan, bulkhead.bulkhead_for(Report, 'find'))
+        self.assertIs(model, bulkhead.bulkhead_for(Report, 'count'))
+        self.assertIs(default, bulkhead.bulkhead_for(Lookup, 'find'))
+        self.assertEqual(set(['default', 'report', 'report.find']), set(bulkhead.stats()))
+
+    def test_full_queue_rejects(self):
+        compartment = bulkhead.Bulkhead(1, queue=1)
+        compartment.acquire(lambda: None)
+        compartment.acquire(lambda: None)
+        with self.assertRaises(bulkhead.Rejected):
+            compartment.acquire(lambda: None)
+        self.assertEqual((1, 1, 1), (compartment.active, len(compartment._waiting), compartment.rejected))
+
+    def test_queued_calls_are_admitted_by_priority(self):
+        compartment = bulkhead.Bulkhead(1)
+        admitted = []
+        compartment.acquire(lambda: admitted.append('running'))
+        with bulkhead.priority(bulkhead.BACKGROUND):
+            compartment.acquire(lambda: admitted.append('background'))
+        compartment.acquire(lambda: admitted.append('first'))
+        compartment.acquire(lambda: admitted.append('second'))
+
+        for _ in range(3):
+            compartment.release()
+            self.io_loop.add_callback(self.stop)
+            self.wait()
+        self.assertEqual(['running', 'first', 'second', 'background'], admitted)
+
+    def test_wait_in_queue_is_bounded(self):
+        compartment = bulkhead.Bulkhead(1, queue_timeout=0.01)
+        compartment.acquire(lambda: None)
+        compartment.acquire(self.stop)
+        self.assertIsInstance(self.wait()['error'], bulkhead.QueueTimeout)
+        self.assertEqual((0, 1), (len(compartment._waiting), compartment.timed_out))
+
+
+class ManagerBulkheadTestCase(testing.AsyncTestCase, unittest2.TestCase):
+
+    def get_new_ioloop(self):
+        return IOLoop.instance()
+
+    def setUp(self):
+        super(ManagerBulkheadTestCase, self).setUp()
+        memory.MemoryClient.reset()
+        Session._session = None
+        Session.create('localhost', 27017, 'test', client_class=SlowClient, io_loop=self.io_loop)
+
+    def tearDown(self):
+        bulkhead.clear()
+        Session.destroy()
+        super(ManagerBulkheadTestCase, self).tearDown()
+
+    def test_calls_over_the_limit_wait_for_a_slot(self):
+        compartment = bulkhead.limit(1, model=Report, operation='find')
+        replies = []
+        def reply(items):
+            replies.append(items)
+            if len(replies) == 3:
+                self.stop()
+        for _ in range(3):
+            Report.objects.find({}, callback=reply)
+        self.assertEqual((1, 2), (compartment.active, len(compartment._waiting)))
+        Lookup.objects.find({}, callback=self.stop)
+        self.assertEqual([], self.wait())
+        self.assertLess(len(replies), 3)
+
+        self.wait()
+        self.assertEqual(0, compartment.active)
+        self.assertEqual((3, 2), (compartment.admitted, compartment.queued))
+
+    def test_queued_call_fails_when_its_deadline_passes(self):
+        bulkhead.limit(1, model=Report)
+        Report.objects.count(callback=lambda total: None)
+        Report.objects.count(callback=self.stop, timeout=0.005)
+        with self.assertRaises(bulkhead.QueueTimeout):
+            self.wait()
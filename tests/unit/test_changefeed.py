@@ -0,0 +1,180 @@
+import time
+import unittest2
+from bson import ObjectId
+from bson.timestamp import Timestamp
+from tornado import testing
+from asyncmongoorm import changefeed
+from asyncmongoorm import memory
+from asyncmongoorm import replica
+from asyncmongoorm.collection import Collection
+from asyncmongoorm.field import IntegerField, ObjectIdField, StringField
+from asyncmongoorm.session import Session
+from asyncmongoorm.signal import post_save, post_update, post_remove
+
+class Flag(Collection):
+    __collection__ = 'flag'
+    _id = ObjectIdField()
+    name = StringField(index='unique')
+    percent = IntegerField()
+
+
+class ChangeFeedTestCase(testing.AsyncTestCase, unittest2.TestCase):
+
+    def setUp(self):
+        super(ChangeFeedTestCase, self).setUp()
+        memory.MemoryClient.reset()
+        Session._session = None
+        Session.create('localhost', 27017, 'test', client_class=memory.MemoryClient, io_loop=self.io_loop)
+        self.feed = changefeed.ChangeFeed(database='test', collection='changes', since=Timestamp(100, 0),
+                                          interval=0.05, batch_size=10, io_loop=self.io_loop)
+        self.received = []
+        self.receivers = [(signal, lambda sender, instance, name=name: self.received.append((name, instance)))
+                          for signal, name in ((post_save, 'save'), (post_update, 'update'), (post_remove, 'remove'))]
+        for signal, receiver in self.receivers:
+            signal.connect(Flag, receiver)
+        self.time = 100
+
+    def tearDown(self):
+        self.feed.stop()
+        for signal, receiver in self.receivers:
+            signal.disconnect(Flag, receiver)
+        replica.clear()
+        Session.destroy()
+        super(ChangeFeedTestCase, self).tearDown()
+
+    def entry(self, op, o, o2=None, ns='test.flag'):
+        self.time += 1
+        entry = {'ts': Timestamp(self.time, 0), 'op': op, 'ns': ns, 'o': o}
+        if o2 is not None:
+            entry['o2'] = o2
+        Session('changes', dbname='test').insert(entry, check_keys=False,
+                                                 callback=lambda response, error: self.stop())
+        self.wait()
+        return entry
+
+    def test_entries_are_dispatched_as_signals(self):
+        _id = ObjectId()
+        self.entry('i', {'_id': _id, 'name': u'beta', 'percent': 5})
+        self.entry('u', {'$set': {'percent': 50}, '$unset': {'name': 1}}, {'_id': _id})
+        self.entry('n', {'msg': 'noop'})
+        self.entry('i', {'_id': ObjectId()}, ns='test.other')
+        self.entry('d', {'_id': _id})
+
+        self.feed.poll(callback=self.stop)
+        # the entry of another collection is not even read
+        self.assertEqual(4, self.wait())
+        self.assertEqual(['save', 'update', 'remove'], [name for name, _ in self.received])
+        saved, updated, removed = [instance for _, instance in self.received]
+        self.assertEqual(u'beta', saved.name)
+        self.assertEqual({'_id': _id, 'percent': 50, 'name': None}, updated._data)
+        self.assertEqual(_id, removed._id)
+        self.assertFalse(removed.is_new())
+        self.assertEqual(Timestamp(105, 0), self.feed.stats()['last'])
+
+    def test_polls_resume_after_the_last_entry(self):
+        self.entry('i', {'_id': ObjectId(), 'name': u'one'})
+        self.feed.poll(callback=self.stop)
+        self.assertEqual(1, self.wait())
+        self.feed.poll(callback=self.stop)
+        self.assertEqual(0, self.wait())
+        self.entry('i', {'_id': ObjectId(), 'name': u'two'})
+        self.feed.poll(callback=self.stop)
+        self.assertEqual(1, self.wait())
+        self.assertEqual([u'one', u'two'], [instance.name for _, instance in self.received])
+
+    def test_the_cursor_stays_open_and_waits_for_entries(self):
+        self.entry('i', {'_id': ObjectId(), 'name': u'one'})
+        self.feed.poll(callback=self.stop)
+        self.assertEqual(1, self.wait())
+        cursor_id = self.feed.cursor_id
+        self.assertTrue(cursor_id)
+
+        self.feed.start()
+        self.entry('i', {'_id': ObjectId(), 'name': u'two'})
+        post_save.connect(Flag, self.on_save)
+        try:
+            self.wait()
+        finally:
+            post_save.disconnect(Flag, self.on_save)
+        self.assertEqual(cursor_id, self.feed.cursor_id)
+        self.assertEqual([u'one', u'two'], [instance.name for _, instance in self.received])
+
+        self.feed.stop()
+        self.assertIsNone(self.feed.cursor_id)
+        self.assertNotIn(cursor_id, memory.MemoryClient._databases['test'].cursors)
+
+    def on_save(self, sender, instance):
+        self.stop()
+
+    def test_the_feed_starts_after_the_newest_entry(self):
+        # the clock of the database is decades behind the one of the process
+        self.entry('i', {'_id': ObjectId(), 'name': u'old'})
+        self.entry('i', {'_id': ObjectId(), 'name': u'older'})
+        feed = changefeed.ChangeFeed(database='test', collection='changes', interval=0.05, io_loop=self.io_loop)
+        feed.poll(callback=self.stop)
+        self.assertEqual(0, self.wait())
+        self.assertEqual(Timestamp(102, 0), feed.stats()['last'])
+        self.entry('i', {'_id': ObjectId(), 'name': u'new'})
+        feed.poll(callback=self.stop)
+        self.assertEqual(1, self.wait())
+        self.assertEqual([u'new'], [instance.name for _, instance in self.received])
+
+    def test_a_failed_seed_is_retried(self):
+        errors = []
+        feed = changefeed.ChangeFeed(database='test', collection='changes', interval=0.05,
+                                     on_error=lambda feed, error: errors.append(error) or self.stop(),
+                                     io_loop=self.io_loop)
+        failing = [True]
+        find_one = memory.MemoryCursor.find_one
+        def fail_once(cursor, spec, **kwargs):
+            if failing.pop() if failing else False:
+                raise IOError('connection reset')
+            return find_one(cursor, spec, **kwargs)
+        memory.MemoryCursor.find_one = fail_once
+        self.entry('i', {'_id': ObjectId(), 'name': u'before'})
+        try:
+            feed.start()
+            self.wait()
+            self.assertIsInstance(errors[0], IOError)
+            self.assertIsNotNone(feed._timer)
+            self.io_loop.add_timeout(time.time() + 0.2, self.stop)
+            self.wait()
+            self.assertEqual(Timestamp(101, 0), feed.stats()['last'])
+            self.entry('i', {'_id': ObjectId(), 'name': u'after'})
+            post_save.connect(Flag, self.on_save)
+            try:
+                self.wait()
+            finally:
+                post_save.disconnect(Flag, self.on_save)
+        finally:
+            memory.MemoryCursor.find_one = find_one
+            feed.stop()
+        self.assertEqual([u'after'], [instance.name for _, instance in self.received])
+        self.assertEqual(1, feed.stats()['errors'])
+
+    def test_a_replica_follows_the_writes_of_other_processes(self):
+        flag = Flag()
+        flag._id = ObjectId()
+        flag.name = u'dark'
+        flag.percent = 0
+        flag.save(callback=self.stop)
+        self.wait()
+        replica.replicate(Flag, interval=None, io_loop=self.io_loop).start(callback=self.stop)
+        self.wait()
+
+        self.entry('u', {'$set': {'percent': 100}}, {'_id': flag._id})
+        self.feed.poll(callback=self.stop)
+        self.wait()
+        Flag.objects.find_one({'name': 'dark'}, callback=self.stop)
+        self.assertEqual(100, self.wait().percent)
+
+    def test_errors_are_reported(self):
+        errors = []
+        self.feed.on_error = lambda feed, error: errors.append(error)
+        self.receivers.append((post_save, lambda sender, instance: 1 / 0))
+        post_save.connect(Flag, self.receivers[-1][1])
+        self.entry('i', {'_id': ObjectId()})
+        self.feed.poll(callback=self.stop)
+        self.wait()
+        self.assertIsInstance(errors[0], ZeroDivisionError)
+        self.assertEqual(1, self.feed.stats()['errors'])
@@ -0,0 +1,82 @@
+import array
+import unittest2
+from datetime import datetime
+from bson import ObjectId
+from tornado import testing
+from asyncmongoorm import columnar
+from asyncmongoorm import memory
+from asyncmongoorm.collection import Collection
+from asyncmongoorm.field import DateTimeField, FloatField, IntegerField, ObjectIdField, StringField
+from asyncmongoorm.session import Session
+from asyncmongoorm.tracker import QueryTracker
+
+class Sample(Collection):
+    __collection__ = 'sample'
+    _id = ObjectIdField()
+    sensor = StringField()
+    reading = FloatField()
+    count = IntegerField()
+    taken = DateTimeField()
+
+
+class ColumnsTestCase(unittest2.TestCase):
+
+    def test_values_and_null_mask(self):
+        columns = columnar.Columns(Sample, ('reading', 'taken'))
+        columns.extend([{'reading': 1.5, 'taken': datetime(1970, 1, 2)}, {'reading': None}])
+        self.assertEqual(2, len(columns))
+        reading = columns['reading']
+        self.assertEqual(array.array('d', [1.5, 0.0]), reading.values)
+        self.assertEqual(array.array('b', [0, 1]), reading.mask)
+        self.assertEqual(1, reading.null_count)
+        self.assertEqual(array.array('d', [1.5]), reading.compressed())
+        self.assertEqual(86400.0, columns['taken'].values[0])
+
+    def test_only_numeric_and_date_fields(self):
+        with self.assertRaises(ValueError):
+            columnar.Columns(Sample, ('sensor',))
+
+    @unittest2.skipIf(columnar.numpy is None, "numpy is not installed")
+    def test_numpy_arrays(self):
+        columns = columnar.Columns(Sample, ('count',))
+        columns.extend([{'count': 3}, {}, {'count': 4}])
+        columns.finish(as_numpy=True)
+        self.assertEqual(7, columns['count'].compressed().sum())
+        self.assertEqual([False, True, False], list(columns['count'].mask))
+
+
+class FindColumnsTestCase(testing.AsyncTestCase, unittest2.TestCase):
+
+    def setUp(self):
+        super(FindColumnsTestCase, self).setUp()
+        memory.MemoryClient.reset()
+        Session._session = None
+        Session.create('localhost', 27017, 'test', client_class=memory.MemoryClient, io_loop=self.io_loop)
+        for index in range(5):
+            sample = Sample()
+            sample._id = ObjectId()
+            sample.sensor = u'north' if index % 2 else u'south'
+            sample.count = index
+            if index != 3:
+                sample.reading = index / 2.0
+            sample.save(callback=self.stop)
+            self.wait()
+
+    def tearDown(self):
+        Session.destroy()
+        super(FindColumnsTestCase, self).tearDown()
+
+    def test_columns_are_read_in_batches(self):
+        tracker = QueryTracker()
+        with tracker.scope():
+            Sample.objects.find_columns({}, ('count', 'reading'), callback=self.stop, batch_size=2, as_numpy=False)
+            columns = self.wait()
+        self.assertEqual(5, len(columns))
+        self.assertEqual(array.array('l', [0, 1, 2, 3, 4]), columns['count'].values)
+        self.assertEqual(array.array('b', [0, 0, 0, 1, 0]), columns['reading'].mask)
+        self.assertEqual({('sample', 'find_columns'): 3}, tracker.operations)
+
+    def test_query_selects_the_rows(self):
+        Sample.objects.find_columns({'sensor': 'north'}, ('count',), callback=self.stop, batch_size=1,
+                                    as_numpy=False)
+        self.assertEqual(array.array('l', [1, 3]), self.wait()['count'].values)
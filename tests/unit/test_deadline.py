@@ -0,0 +1,137 @@
+import time
+import unittest2
+from functools import partial
+from tornado import testing
+from tornado.ioloop import IOLoop
+from asyncmongo.pool import ConnectionPool
+from asyncmongoorm import deadline
+from asyncmongoorm import memory
+from asyncmongoorm.collection import Collection
+from asyncmongoorm.field import ObjectIdField, StringField
+from asyncmongoorm.session import Database, Session
+
+class SlowClient(memory.MemoryClient):
+    """Memory client taking `delay` seconds to answer."""
+
+    delay = 0.05
+    commands = []
+
+    def command(self, command, value=1, callback=None, **kwargs):
+        self.commands.append(command)
+        return super(SlowClient, self).command(command, value, callback=callback, **kwargs)
+
+    def deliver(self, callback, result, error=None):
+        deliver = super(SlowClient, self).deliver
+        self.io_loop.add_timeout(time.time() + self.delay, partial(deliver, callback, result, error))
+
+
+class DeadlineModel(Collection):
+    __collection__ = 'deadline_model'
+    _id = ObjectIdField()
+    name = StringField()
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakePool(ConnectionPool):
+
+    def new_connection(self):
+        return FakeConnection()
+
+
+class NeverAnswers(object):
+    """Client whose reads take a connection and never answer."""
+
+    def __init__(self, pool_id=None, **kwargs):
+        self._pool = FakePool()
+        self.taken = []
+
+    def connection(self, collectionname, dbname=None):
+        return self
+
+    def find(self, spec, callback, **kwargs):
+        self.taken.append(self._pool.connection())
+    find_one = find
+
+
+class DeadlineTestCase(testing.AsyncTestCase, unittest2.TestCase):
+
+    def get_new_ioloop(self):
+        return IOLoop.instance()
+
+    def setUp(self):
+        super(DeadlineTestCase, self).setUp()
+        memory.MemoryClient.reset()
+        SlowClient.commands = []
+        Session._session = None
+        Session.create('localhost', 27017, 'test', client_class=SlowClient, io_loop=self.io_loop)
+
+    def tearDown(self):
+        Session.destroy()
+        super(DeadlineTestCase, self).tearDown()
+
+    def test_remaining_takes_the_closest_deadline(self):
+        self.assertIsNone(deadline.remaining())
+        self.assertAlmostEqual(2, deadline.remaining(2), places=2)
+        with deadline.scope(1):
+            self.assertAlmostEqual(1, deadline.remaining(), places=2)
+            self.assertAlmostEqual(1, deadline.remaining(2), places=2)
+            with deadline.scope(5):
+                self.assertAlmostEqual(1, deadline.remaining(), places=2)
+            with deadline.scope(0.5):
+                self.assertAlmostEqual(0.5, deadline.remaining(), places=2)
+        self.assertIsNone(deadline.remaining())
+
+    def test_call_completes_within_timeout(self):
+        DeadlineModel.objects.find({}, callback=self.stop, timeout=1)
+        self.assertEqual([], self.wait())
+
+    def test_find_fails_when_timeout_expires(self):
+        DeadlineModel.objects.find({}, callback=self.stop, timeout=0.01)
+        with self.assertRaises(deadline.DeadlineExceeded):
+            self.wait()
+
+    def test_save_fails_when_timeout_expires(self):
+        instance = DeadlineModel()
+        instance.name = u'slow'
+        instance.save(callback=self.stop, timeout=0.01)
+        with self.assertRaises(deadline.DeadlineExceeded):
+            self.wait()
+
+    def test_nested_calls_inherit_the_scoped_deadline(self):
+        with deadline.scope(0.01):
+            DeadlineModel.objects.count(callback=self.stop)
+        with self.assertRaises(deadline.DeadlineExceeded):
+            self.wait()
+
+    def test_commands_carry_max_time_ms(self):
+        DeadlineModel.objects.count(callback=self.stop, timeout=1)
+        self.wait()
+        self.assertTrue(900 < SlowClient.commands[-1]['maxTimeMS'] <= 1000)
+
+    def test_expired_deadline_fails_without_sending(self):
+        with deadline.scope(-1):
+            with self.assertRaises(deadline.DeadlineExceeded):
+                DeadlineModel.objects.count(callback=self.stop)
+        self.assertEqual([], SlowClient.commands)
+
+    def test_connection_of_an_expired_call_is_closed(self):
+        Session.create('localhost', 27017, 'test', client_class=NeverAnswers, alias='stuck')
+        client = Session(alias='stuck')
+        try:
+            # a bound method, a hedge's partial and a command of another database
+            for method in (client.find, partial(client.find), Database(client, 'other').command):
+                deadline.call(0.01, method, {}, callback=self.stop)
+                self.assertIsInstance(self.wait()['error'], deadline.DeadlineExceeded)
+                self.assertTrue(client.taken[-1].closed)
+                self.assertNotIn('connection', client._pool.__dict__)
+            self.assertEqual(3, len(client.taken))
+        finally:
+            Session.destroy('stuck')
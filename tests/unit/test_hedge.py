@@ -0,0 +1,101 @@
+import time
+import unittest2
+from functools import partial
+from tornado import testing
+from tornado.ioloop import IOLoop
+from asyncmongoorm import hedge
+from asyncmongoorm import memory
+from asyncmongoorm.collection import Collection
+from asyncmongoorm.field import ObjectIdField, StringField
+from asyncmongoorm.session import Session
+
+class DelayedClient(memory.MemoryClient):
+    """Memory client answering each call after the next delay of `delays`."""
+
+    delays = []
+
+    def deliver(self, callback, result, error=None):
+        delay = self.delays.pop(0) if self.delays else 0
+        deliver = super(DelayedClient, self).deliver
+        self.io_loop.add_timeout(time.time() + delay, partial(deliver, callback, result, error))
+
+
+class HedgedModel(Collection):
+    __collection__ = 'hedged_model'
+    _id = ObjectIdField()
+    name = StringField()
+
+
+class HedgePolicyTestCase(unittest2.TestCase):
+
+    def tearDown(self):
+        hedge.disable()
+
+    def test_delay_is_a_percentile_of_recent_latency(self):
+        policy = hedge.HedgePolicy(percentile=0.9, min_samples=10, min_delay=0.001)
+        for latency in range(9):
+            policy.observe('key', latency / 100.0)
+        self.assertIsNone(policy.delay('key'))
+        policy.observe('key', 0.09)
+        self.assertEqual(0.09, policy.delay('key'))
+
+    def test_delay_has_a_floor(self):
+        policy = hedge.HedgePolicy(min_samples=1, min_delay=0.01)
+        policy.observe('key', 0.0001)
+        self.assertEqual(0.01, policy.delay('key'))
+
+    def test_policy_for_model(self):
+        class OptedOut(object):
+            __hedge__ = False
+        own = hedge.HedgePolicy()
+        class OwnPolicy(object):
+            __hedge__ = own
+
+        global_policy = hedge.enable()
+        self.assertIs(global_policy, hedge.policy_for(HedgedModel, 'find_one'))
+        self.assertIsNone(hedge.policy_for(HedgedModel, 'map_reduce'))
+        self.assertIsNone(hedge.policy_for(OptedOut, 'find_one'))
+        self.assertIs(own, hedge.policy_for(OwnPolicy, 'find'))
+
+
+class HedgedReadTestCase(testing.AsyncTestCase, unittest2.TestCase):
+
+    def get_new_ioloop(self):
+        return IOLoop.instance()
+
+    def setUp(self):
+        super(HedgedReadTestCase, self).setUp()
+        memory.MemoryClient.reset()
+        DelayedClient.delays = []
+        Session._session = None
+        Session.create('localhost', 27017, 'test', client_class=DelayedClient, io_loop=self.io_loop)
+        self.policy = hedge.enable(min_samples=1, min_delay=0.005, budget=1.0)
+        self.policy.observe(hedge.key(HedgedModel, 'find_one'), 0.005)
+
+    def tearDown(self):
+        hedge.disable()
+        Session.destroy()
+        super(HedgedReadTestCase, self).tearDown()
+
+    def test_slow_read_is_hedged_and_first_reply_wins(self):
+        DelayedClient.delays = [0.1, 0]
+        started = time.time()
+        HedgedModel.objects.find_one({'name': 'a'}, callback=self.stop)
+        self.assertIsNone(self.wait())
+        self.assertLess(time.time() - started, 0.1)
+        self.assertEqual(1, self.policy.hedged)
+        self.assertEqual(1, self.policy.won)
+
+    def test_fast_read_is_not_hedged(self):
+        HedgedModel.objects.find_one({'name': 'a'}, callback=self.stop)
+        self.wait()
+        self.assertEqual(0, self.policy.hedged)
+        self.assertEqual(1, self.policy.stats()['reads'])
+
+    def test_budget_caps_hedges(self):
+        self.policy.budget = 0
+        DelayedClient.delays = [0.02]
+        HedgedModel.objects.find_one({'name': 'a'}, callback=self.stop)
+        self.wait()
+        self.assertEqual(0, self.policy.hedged)
+        self.assertEqual(1, self.policy.over_budget)
@@ -0,0 +1,144 @@
+import unittest2
+from asyncmongo.errors import IntegrityError
+from bson import ObjectId
+from tornado import gen, testing
+from asyncmongoorm import memory
+from asyncmongoorm.collection import Collection
+from asyncmongoorm.field import IntegerField, ObjectIdField, StringField
+from asyncmongoorm.identitymap import IdentityMap
+from asyncmongoorm.session import Session
+from asyncmongoorm.signal import pre_update
+from asyncmongoorm.tracker import QueryTracker
+
+class Account(Collection):
+    __collection__ = 'account'
+    _id = ObjectIdField()
+    name = StringField()
+    balance = IntegerField()
+
+
+class IdentityMapTestCase(testing.AsyncTestCase, unittest2.TestCase):
+
+    def setUp(self):
+        super(IdentityMapTestCase, self).setUp()
+        memory.MemoryClient.reset()
+        Session._session = None
+        Session.create('localhost', 27017, 'test', client_class=memory.MemoryClient, io_loop=self.io_loop)
+        self.ids = []
+        for name in (u'alice', u'bob'):
+            account = Account()
+            account._id = ObjectId()
+            account.name = name
+            account.balance = 10
+            account.save(callback=self.stop)
+            self.wait()
+            self.ids.append(account._id)
+        self.identity_map = IdentityMap(io_loop=self.io_loop)
+
+    def tearDown(self):
+        Session.destroy()
+        super(IdentityMapTestCase, self).tearDown()
+
+    def test_a_document_is_loaded_into_one_instance(self):
+        with self.identity_map.scope():
+            Account.objects.find({}, callback=self.stop)
+            first = self.wait()
+            Account.objects.find({'name': 'alice'}, callback=self.stop)
+            second = self.wait()
+        self.assertIs(first[0], second[0])
+        self.assertEqual(2, len(self.identity_map))
+
+        Account.objects.find({'name': 'alice'}, callback=self.stop)
+        self.assertIsNot(first[0], self.wait()[0])
+
+    def test_find_one_by_id_is_answered_from_the_map(self):
+        tracker = QueryTracker()
+        with tracker.scope():
+            with self.identity_map.scope():
+                Account.objects.find_one({'_id': self.ids[0]}, callback=self.stop)
+                loaded = self.wait()
+                Account.objects.find_one({'_id': self.ids[0]}, callback=self.stop)
+                self.assertIs(loaded, self.wait())
+                Account.objects.find_one({'_id': self.ids[0], 'name': 'alice'}, callback=self.stop)
+                self.assertIs(loaded, self.wait())
+        self.assertEqual(2, tracker.count)
+        self.assertEqual(2, self.identity_map.hits)
+
+    def test_answers_from_the_map_are_asynchronous(self):
+        @gen.engine
+        def load_twice(callback):
+            first = yield gen.Task(Account.objects.find_one, {'_id': self.ids[0]})
+            second = yield gen.Task(Account.objects.find_one, {'_id': self.ids[0]})
+            callback((first, second))
+
+        with self.identity_map.scope():
+            load_twice(callback=self.stop)
+            first, second = self.wait()
+        self.assertIs(first, second)
+        self.assertEqual(1, self.identity_map.hits)
+
+    def test_flush_saves_changed_instances(self):
+        tracker = QueryTracker()
+        with self.identity_map.scope():
+            Account.objects.find({}, callback=self.stop)
+            alice, bob = self.wait()
+        self.assertEqual([], self.identity_map.dirty())
+
+        alice.balance = 5
+        self.assertEqual([alice], self.identity_map.dirty())
+        with tracker.scope():
+            self.identity_map.flush(callback=self.stop)
+            self.assertEqual([], self.wait())
+        self.assertEqual({('account', 'update'): 1}, tracker.operations)
+        self.assertEqual([], self.identity_map.dirty())
+
+        Account.objects.find_one({'_id': alice._id}, callback=self.stop)
+        self.assertEqual(5, self.wait().balance)
+
+    def test_flush_reports_the_saves_that_failed(self):
+        Session('account').create_index([('name', 1)], unique=True,
+                                        callback=lambda response, error: self.stop())
+        self.wait()
+        carol = Account()
+        carol._id = ObjectId()
+        carol.name = u'carol'
+        carol.save(callback=self.stop)
+        self.wait()
+        with self.identity_map.scope():
+            Account.objects.find({}, callback=self.stop)
+            alice, bob, carol = self.wait()
+
+        def refuse(sender, instance):
+            if instance is carol:
+                raise ValueError('frozen')
+        pre_update.connect(Account, refuse)
+        try:
+            alice.name = u'bob'
+            bob.balance = 20
+            carol.balance = 30
+            self.identity_map.flush(callback=self.stop)
+            failures = self.wait()
+        finally:
+            pre_update.disconnect(Account, refuse)
+        self.assertEqual([alice, carol], sorted((instance for instance, _ in failures), key=lambda i: i.name))
+        errors = dict((instance.name, error) for instance, error in failures)
+        self.assertIsInstance(errors[u'bob'], IntegrityError)
+        self.assertIsInstance(errors[u'carol'], ValueError)
+        self.assertEqual(set([alice, carol]), set(self.identity_map.dirty()))
+
+        Account.objects.find_one({'_id': bob._id}, callback=self.stop)
+        self.assertEqual(20, self.wait().balance)
+
+    def test_saved_instances_join_and_removed_ones_leave_the_map(self):
+        with self.identity_map.scope():
+            account = Account()
+            account._id = ObjectId()
+            account.name = u'carol'
+            account.save(callback=self.stop)
+            self.wait()
+            self.assertIn(account, self.identity_map)
+            self.assertEqual([], self.identity_map.dirty())
+
+            account.remove(callback=self.stop)
+            self.wait()
+            self.assertNotIn(account, self.identity_map)
@@ -233,7 +233,8 @@ class ManagerTestCase(testing.AsyncTestCase, unittest2.TestCase):
     def test_drop(self):
 
         fake_session = fudge.Fake()
-        fake_session.is_callable().with_args('some_collection').returns_fake().expects('remove')
+        fake_session.is_callable().with_args('some_collection').returns_fake()\
+                                .expects('remove').calls(lambda callback: callback(None, error=None))
 
         fake_collection = fudge.Fake().has_attr(__collection__='some_collection')
         with fudge.patched_context(manager, 'Session', fake_session):
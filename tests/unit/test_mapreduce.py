@@ -0,0 +1,128 @@
+import unittest2
+from bson import ObjectId
+from tornado import testing
+from asyncmongoorm import memory
+from asyncmongoorm.collection import Collection
+from asyncmongoorm.field import Field, IntegerField, ObjectIdField, StringField
+from asyncmongoorm.session import Session
+from asyncmongoorm.tracker import QueryTracker
+
+class Sale(Collection):
+    __collection__ = 'sale'
+    _id = ObjectIdField()
+    store = StringField()
+    amount = IntegerField()
+
+
+class StoreTotal(Collection):
+    __collection__ = 'store_total'
+    _id = StringField()
+    value = Field(field_type=object)
+
+
+def by_store(sale):
+    return [(sale['store'], sale['amount'])]
+
+def total(key, values):
+    return sum(values)
+
+
+class MapReduceTestCase(testing.AsyncTestCase, unittest2.TestCase):
+
+    def setUp(self):
+        super(MapReduceTestCase, self).setUp()
+        memory.MemoryClient.reset()
+        Session._session = None
+        Session.create('localhost', 27017, 'test', client_class=memory.MemoryClient, io_loop=self.io_loop)
+        self.sell((u'north', 10), (u'south', 5), (u'north', 1))
+
+    def tearDown(self):
+        Session.destroy()
+        super(MapReduceTestCase, self).tearDown()
+
+    def sell(self, *sales):
+        for store, amount in sales:
+            sale = Sale()
+            sale._id = ObjectId()
+            sale.store = store
+            sale.amount = amount
+            sale.save(callback=self.stop)
+            self.wait()
+
+    def totals(self, result):
+        result.find(callback=self.stop)
+        return dict((document['_id'], document['value']) for document in self.wait())
+
+    def test_inline_results_are_finalized(self):
+        Sale.objects.map_reduce(by_store, total, callback=self.stop, finalize=lambda key, value: value * 2)
+        self.assertEqual([{'_id': u'north', 'value': 22}, {'_id': u'south', 'value': 10}], self.wait())
+
+    def test_results_can_replace_an_output_collection(self):
+        Sale.objects.map_reduce(by_store, total, callback=self.stop, out='store_total', output_model=StoreTotal)
+        result = self.wait()
+        self.assertEqual('store_total', result.collection)
+        self.assertEqual(3, result.counts['input'])
+        result.find(callback=self.stop, query={'_id': u'north'})
+        north, = self.wait()
+        self.assertIsInstance(north, StoreTotal)
+        self.assertEqual(11, north.value)
+
+    def test_output_model_reads_the_output_collection(self):
+        for out in ('totals', {'replace': 'totals', 'db': 'reports'}):
+            Sale.objects.map_reduce(by_store, total, callback=self.stop, out=out, output_model=StoreTotal)
+            result = self.wait()
+            self.assertEqual('totals', result.collection)
+            result.find(callback=self.stop)
+            totals = self.wait()
+            self.assertEqual([StoreTotal, StoreTotal], [type(item) for item in totals])
+            self.assertEqual({u'north': 11, u'south': 5}, dict((item._id, item.value) for item in totals))
+        self.assertNotIn('store_total', memory.MemoryClient._databases['test'].collections)
+        self.assertIn('totals', memory.MemoryClient._databases['reports'].collections)
+
+    def test_incremental_runs_reduce_only_new_documents(self):
+        out = {'reduce': 'store_total'}
+        Sale.objects.map_reduce(by_store, total, callback=self.stop, out=out, incremental='_id')
+        self.assertEqual({u'north': 11, u'south': 5}, self.totals(self.wait()))
+
+        self.sell((u'south', 7), (u'east', 2))
+        Sale.objects.map_reduce(by_store, total, callback=self.stop, out=out, incremental='_id')
+        result = self.wait()
+        self.assertEqual(2, result.counts['input'])
+        self.assertEqual({u'north': 11, u'south': 12, u'east': 2}, self.totals(result))
+
+        tracker = QueryTracker()
+        with tracker.scope():
+            Sale.objects.map_reduce(by_store, total, callback=self.stop, out=out, incremental='_id')
+            result = self.wait()
+        self.assertEqual(0, result.counts['input'])
+        self.assertNotIn(('sale', 'map_reduce'), tracker.operations)
+
+        Session('map_reduce_watermarks').find_one({'_id': 'sale.store_total'},
+                                                  callback=lambda response, error: self.stop(response))
+        watermark = self.wait()
+        self.assertEqual(2, watermark['counts']['input'])
+
+    def test_incremental_runs_pick_up_documents_tied_with_the_watermark(self):
+        out = {'reduce': 'store_total'}
+        Sale.objects.map_reduce(by_store, total, callback=self.stop, out=out, incremental='amount')
+        self.assertEqual({u'north': 11, u'south': 5}, self.totals(self.wait()))
+
+        # as high as the highest amount already reduced, and lower
+        self.sell((u'south', 10), (u'east', 10), (u'east', 1))
+        Sale.objects.map_reduce(by_store, total, callback=self.stop, out=out, incremental='amount')
+        result = self.wait()
+        self.assertEqual(2, result.counts['input'])
+        self.assertEqual({u'north': 11, u'south': 15, u'east': 10}, self.totals(result))
+
+        self.sell((u'north', 12))
+        Sale.objects.map_reduce(by_store, total, callback=self.stop, out=out, incremental='amount')
+        result = self.wait()
+        self.assertEqual(1, result.counts['input'])
+        self.assertEqual({u'north': 23, u'south': 15, u'east': 10}, self.totals(result))
+
+        Sale.objects.map_reduce(by_store, total, callback=self.stop, out=out, incremental='amount')
+        self.assertEqual(0, self.wait().counts['input'])
+
+    def test_incremental_runs_need_an_output_to_merge_into(self):
+        with self.assertRaises(ValueError):
+            Sale.objects.map_reduce(by_store, total, callback=self.stop, out='store_total', incremental='_id')
@@ -0,0 +1,232 @@
+import re
+import unittest2
+from bson import ObjectId
+from tornado import gen
+from tornado import testing
+from asyncmongo.errors import IntegrityError
+from asyncmongoorm import memory
+from asyncmongoorm.collection import Collection
+from asyncmongoorm.session import Session
+from asyncmongoorm.field import StringField, IntegerField, ObjectIdField, ListField
+
+class MemoryClientTestCase(testing.AsyncTestCase, unittest2.TestCase):
+
+    def setUp(self):
+        super(MemoryClientTestCase, self).setUp()
+        memory.MemoryClient.reset()
+        self.client = memory.MemoryClient(dbname='test', io_loop=self.io_loop)
+
+    def insert(self, *documents):
+        for document in documents:
+            self.client.items.insert(document, callback=self.stop)
+            self.wait()
+
+    def find(self, spec=None, **kwargs):
+        self.client.items.find(spec, callback=self.stop, **kwargs)
+        return self.wait()['_arg']
+
+    def stop(self, _arg=None, **kwargs):
+        super(MemoryClientTestCase, self).stop(dict(kwargs, _arg=_arg))
+
+    def test_callbacks_run_on_the_ioloop(self):
+        called = []
+        self.client.items.insert({'a': 1}, callback=lambda *args, **kw: called.append(args))
+        self.assertEqual([], called)
+        self.client.items.find({}, callback=self.stop)
+        self.wait()
+        self.assertEqual(1, len(called))
+
+    def test_insert_assigns_id_and_find_returns_copies(self):
+        document = {'name': 'first'}
+        self.insert(document)
+        self.assertNotIn('_id', document)
+
+        found = self.find()
+        self.assertEqual(1, len(found))
+        self.assertIsInstance(found[0]['_id'], ObjectId)
+        found[0]['name'] = 'changed'
+        self.assertEqual('first', self.find()[0]['name'])
+
+    def test_find_one_returns_document_or_empty_list(self):
+        _id = ObjectId()
+        self.insert({'_id': _id, 'name': 'first'})
+
+        self.client.items.find_one(_id, callback=self.stop)
+        self.assertEqual('first', self.wait()['_arg']['name'])
+
+        self.client.items.find_one({'name': 'missing'}, callback=self.stop)
+        self.assertEqual([], self.wait()['_arg'])
+
+    def test_query_operators(self):
+        self.insert({'n': 1, 'tags': ['a', 'b'], 'sub': {'x': 1}},
+                    {'n': 2, 'tags': ['b'], 'sub': {'x': 2}},
+                    {'n': 3, 'name': 'Third'})
+
+        self.assertEqual([2, 3], [d['n'] for d in self.find({'n': {'$gt': 1}})])
+        self.assertEqual([1, 3], [d['n'] for d in self.find({'n': {'$in': [1, 3]}})])
+        self.assertEqual([1, 2], [d['n'] for d in self.find({'tags': 'b'})])
+        self.assertEqual([1], [d['n'] for d in self.find({'tags': {'$all': ['a', 'b']}})])
+        self.assertEqual([3], [d['n'] for d in self.find({'tags': {'$exists': False}})])
+        self.assertEqual([2], [d['n'] for d in self.find({'sub.x': {'$gte': 2}})])
+        self.assertEqual([1, 3], [d['n'] for d in self.find({'$or': [{'n': 1}, {'n': 3}]})])
+        self.assertEqual([3], [d['n'] for d in self.find({'name': re.compile('^th', re.I)})])
+        self.assertEqual([2, 3], [d['n'] for d in self.find({'n': {'$not': {'$lt': 2}}})])
+        self.assertEqual([1], [d['n'] for d in self.find({'tags': {'$size': 2}})])
+
+    def test_sort_skip_limit_and_fields(self):
+        self.insert({'n': 2, 'other': 'x'}, {'n': 1, 'other': 'y'}, {'n': 3, 'other': 'z'})
+
+        found = self.find(sort=[('n', -1)], skip=1, limit=1, fields=['n'])
+        self.assertEqual(1, len(found))
+        self.assertEqual(2, found[0]['n'])
+        self.assertNotIn('other', found[0])
+        self.assertIn('_id', found[0])
+
+    def test_update_operators_and_upsert(self):
+        _id = ObjectId()
+        self.insert({'_id': _id, 'n': 1, 'tags': ['a']})
+
+        self.client.items.update({'_id': _id}, {'$inc': {'n': 2}, '$push': {'tags': 'b'},
+                                                '$set': {'sub.x': 1}}, callback=self.stop)
+        status = self.wait()['_arg']
+        self.assertEqual(1, status[0]['n'])
+        self.assertEqual({'_id': _id, 'n': 3, 'tags': ['a', 'b'], 'sub': {'x': 1}}, self.find()[0])
+
+        self.client.items.update({'name': 'new'}, {'$set': {'n': 10}}, upsert=True, callback=self.stop)
+        self.wait()
+        self.assertEqual(10, self.find({'name': 'new'})[0]['n'])
+
+    def test_remove(self):
+        self.insert({'n': 1}, {'n': 2}, {'n': 3})
+        self.client.items.remove({'n': {'$lt': 3}}, callback=self.stop)
+        self.assertEqual(2, self.wait()['_arg'][0]['n'])
+        self.assertEqual([3], [d['n'] for d in self.find()])
+
+    def test_unique_index_rejects_duplicates(self):
+        self.client.items.create_index('email', unique=True, callback=self.stop)
+        self.wait()
+        self.insert({'email': 'a@b.com'})
+
+        self.client.items.insert({'email': 'a@b.com'}, callback=self.stop)
+        self.assertIsInstance(self.wait()['error'], IntegrityError)
+        self.assertEqual(1, len(self.find({'email': 'a@b.com'})))
+
+    def test_index_narrows_candidates(self):
+        self.client.items.create_index('n', callback=self.stop)
+        self.wait()
+        self.insert(*[{'n': i % 3} for i in range(9)])
+
+        collection = self.client.database().collection('items')
+        self.assertEqual(3, len(collection.candidates({'n': 1})))
+        self.assertEqual(3, len(self.find({'n': 1})))
+
+    def test_count_distinct_and_group_commands(self):
+        self.insert({'tag': 'a', 'v': 1}, {'tag': 'b', 'v': 2}, {'tag': 'a', 'v': 3})
+
+        self.client.command({'count': 'items', 'query': {'tag': 'a'}}, callback=self.stop)
+        self.assertEqual(2, self.wait()['_arg']['n'])
+
+        self.client.command({'distinct': 'items', 'key': 'tag'}, callback=self.stop)
+        self.assertEqual(['a', 'b'], self.wait()['_arg']['values'])
+
+        self.client.command({'group': {'ns': 'items', 'cond': {'tag': 'a'}, 'initial': {'csum': 0},
+                                       '$reduce': 'function(obj,prev){prev.csum+=obj.v;}'}},
+                            callback=self.stop)
+        self.assertEqual(4, self.wait()['_arg']['retval'][0]['csum'])
+
+    def test_map_reduce_with_python_callables(self):
+        self.insert({'tag': 'a'}, {'tag': 'b'}, {'tag': 'a'})
+
+        command = {'mapreduce': 'items', 'out': {'inline': 1},
+                   'map': lambda doc: [(doc['tag'], 1)],
+                   'reduce': lambda key, values: sum(values)}
+        self.client.command(command, callback=self.stop)
+        result = self.wait()['_arg']
+        self.assertEqual([{'_id': 'a', 'value': 2}, {'_id': 'b', 'value': 1}], result['results'])
+
+        self.client.command({'mapreduce': 'items', 'map': 'function(){}', 'reduce': 'function(){}'},
+                            callback=self.stop)
+        self.assertEqual(0, self.wait()['_arg']['ok'])
+
+    def test_geo_near_requires_geo_index(self):
+        self.insert({'loc': [0, 0], 'n': 1}, {'loc': [3, 4], 'n': 2}, {'loc': [1, 1], 'n': 3})
+
+        self.client.command({'geoNear': 'items', 'near': [0, 0]}, callback=self.stop)
+        self.assertEqual(0, self.wait()['_arg']['ok'])
+
+        self.client.items.create_index([('loc', memory.GEO2D)], callback=self.stop)
+        self.wait()
+        self.client.command({'geoNear': 'items', 'near': [0, 0], 'maxDistance': 2}, callback=self.stop)
+        result = self.wait()['_arg']
+        self.assertEqual([1, 3], [r['obj']['n'] for r in result['results']])
+
+
+class MemorySessionTestCase(testing.AsyncTestCase, unittest2.TestCase):
+
+    def setUp(self):
+        super(MemorySessionTestCase, self).setUp()
+        memory.MemoryClient.reset()
+        Session._session = None
+        Session.create('localhost', 27017, 'test', client_class=memory.MemoryClient, io_loop=self.io_loop)
+
+    def tearDown(self):
+        Session.destroy()
+        super(MemorySessionTestCase, self).tearDown()
+
+    @gen.engine
+    def _save_and_find(self, instance, callback):
+        yield gen.Task(instance.save)
+        found = yield gen.Task(instance.objects.find, {'name': instance.name})
+        callback(found)
+
+    def test_collection_and_manager_run_against_memory_backend(self):
+
+        class MemoryModel(Collection):
+            __collection__ = 'memory_model'
+            _id = ObjectIdField()
+            name = StringField()
+            hits = IntegerField()
+            tags = ListField()
+
+        instance = MemoryModel()
+        instance._id = ObjectId()
+        instance.name = u'first'
+        instance.hits = 1
+        self._save_and_find(instance, callback=self.stop)
+        found = self.wait()
+
+        self.assertEqual(1, len(found))
+        self.assertEqual(instance._id, found[0]._id)
+        self.assertFalse(found[0].is_new())
+
+        found[0].hits = 5
+        found[0].save(callback=self.stop)
+        self.wait()
+        MemoryModel.objects.count({'hits': 5}, callback=self.stop)
+        self.assertEqual(1, self.wait())
+        MemoryModel.objects.sum({}, 'hits', callback=self.stop)
+        self.assertEqual(5, self.wait())
+
+    def test_models_are_routed_to_their_session_and_database(self):
+
+        class ArchivedModel(Collection):
+            __collection__ = 'archived_model'
+            __session__ = 'archive'
+            __database__ = 'history'
+            _id = ObjectIdField()
+            name = StringField()
+
+        Session.create('localhost', 27018, 'archive', client_class=memory.MemoryClient,
+                       io_loop=self.io_loop, alias='archive')
+        self.addCleanup(Session.destroy, 'archive')
+
+        instance = ArchivedModel()
+        instance._id = ObjectId()
+        instance.name = u'old'
+        self._save_and_find(instance, callback=self.stop)
+        self.assertEqual(1, len(self.wait()))
+        ArchivedModel.objects.count(callback=self.stop)
+        self.assertEqual(1, self.wait())
+
+        self.assertIn('archived_model', Session(alias='archive').database('history').collections)
+        self.assertNotIn('archived_model', Session().database('test').collections)
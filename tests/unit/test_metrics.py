@@ -0,0 +1,120 @@
+import fudge
+import unittest2
+from tornado import gen
+from tornado import testing
+from asyncmongoorm import collection
+from asyncmongoorm import manager
+from asyncmongoorm import metrics
+from asyncmongoorm.field import StringField
+
+class RecordingSink(metrics.Sink):
+
+    def __init__(self):
+        self.operations = []
+
+    def record(self, operation):
+        self.operations.append(operation)
+
+
+class MetricsTestCase(testing.AsyncTestCase, unittest2.TestCase):
+
+    def setUp(self):
+        super(MetricsTestCase, self).setUp()
+        self.sink = RecordingSink()
+        metrics.add_sink(self.sink)
+
+    def tearDown(self):
+        metrics.clear_sinks()
+        super(MetricsTestCase, self).tearDown()
+
+    def test_start_returns_null_operation_without_sinks(self):
+        metrics.clear_sinks()
+        operation = metrics.start(object, 'find')
+        operation.lap('wire')
+        operation.finish(documents=1)
+        self.assertIs(metrics._null_operation, operation)
+
+    @fudge.test
+    def test_find_records_wire_and_hydration(self):
+
+        class CollectionTest(collection.Collection):
+            __collection__ = 'some_collection'
+            some_attr = StringField()
+
+        def fake_find(query, callback, limit):
+            callback([{'some_attr': 'a'}, {'some_attr': 'b'}], error=None)
+
+        fake_session = fudge.Fake()
+        fake_session.is_callable().with_args('some_collection').returns_fake().has_attr(find=fake_find)
+
+        with fudge.patched_context(manager, 'Session', fake_session):
+            manager.Manager(CollectionTest).find({'some_attr': 'a'}, limit=2, callback=self.stop)
+            self.wait()
+
+        operation = self.sink.operations[0]
+        self.assertEqual('some_collection', operation.model_name)
+        self.assertEqual('find', operation.name)
+        self.assertEqual({'some_attr': 'a'}, operation.query)
+        self.assertEqual({'limit': 2}, operation.options)
+        self.assertEqual(2, operation.documents)
+        self.assertEqual(set(['wire', 'hydration']), set(operation.phases))
+        self.assertIsNone(operation.error)
+
+    @fudge.test
+    @gen.engine
+    def test_save_records_signal_time_and_errors(self):
+
+        class CollectionTest(collection.Collection):
+            __collection__ = 'some_collection'
+            some_attr = StringField()
+
+        def fake_insert(data, callback, safe):
+            callback(None, error=ValueError('should_be_error'))
+
+        fake_session = fudge.Fake()
+        fake_session.is_callable().with_args('some_collection').returns_fake().has_attr(insert=fake_insert)
+
+        instance = CollectionTest()
+        instance.some_attr = 'value'
+        with fudge.patched_context(collection, 'Session', fake_session):
+            with self.assertRaises(ValueError):
+                instance.save()
+
+        operation = self.sink.operations[0]
+        self.assertEqual('insert', operation.name)
+        self.assertIsInstance(operation.error, ValueError)
+        self.assertIn('signal', operation.phases)
+        self.assertIn('wire', operation.phases)
+
+    def test_histogram_sink_aggregates_per_model_operation_and_phase(self):
+        sink = metrics.HistogramSink(buckets=(0.01, 0.1))
+        for elapsed in (0.005, 0.05, 0.5):
+            operation = metrics.Operation(type('Model', (object,), {'__collection__': 'model'}), 'find')
+            operation.phases['wire'] = elapsed
+            operation.documents = 2
+            sink.record(operation)
+
+        histogram = sink.histogram('model', 'find', 'wire')
+        self.assertEqual([1, 1, 1], histogram.counts)
+        self.assertEqual(0.1, histogram.percentile(0.5))
+        self.assertEqual(float('inf'), histogram.percentile(0.99))
+
+        snapshot = sink.snapshot()
+        self.assertEqual(3, snapshot['model']['find']['calls'])
+        self.assertEqual(6, snapshot['model']['find']['documents'])
+
+        exposition = sink.prometheus()
+        self.assertIn('asyncmongoorm_operation_seconds_bucket{model="model",operation="find",phase="wire",le="0.1"} 2',
+                      exposition)
+        self.assertIn('asyncmongoorm_documents_total{model="model",operation="find"} 6', exposition)
+
+    def test_statsd_sink_formats_timings_and_counters(self):
+        sink = metrics.StatsdSink(prefix='app')
+        operation = metrics.Operation(type('Model', (object,), {'__collection__': 'model'}), 'find')
+        operation.phases['wire'] = 0.002
+        operation.finish(documents=3)
+
+        lines = list(sink.lines(operation))
+        self.assertIn('app.model.find.calls:1|c', lines)
+        self.assertIn('app.model.find.documents:3|c', lines)
+        self.assertIn('app.model.find.wire:2.000|ms', lines)
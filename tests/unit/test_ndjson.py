@@ -0,0 +1,153 @@
+import unittest2
+from datetime import datetime
+from StringIO import StringIO
+from bson import ObjectId
+from tornado import testing
+from asyncmongo.errors import IntegrityError
+from asyncmongoorm import bson_json
+from asyncmongoorm import memory
+from asyncmongoorm.collection import Collection
+from asyncmongoorm.field import DateTimeField, IntegerField, ObjectIdField, StringField
+from asyncmongoorm.session import Session
+from asyncmongoorm.tracker import QueryTracker
+
+class Invoice(Collection):
+    __collection__ = 'invoice'
+    _id = ObjectIdField()
+    customer = StringField()
+    total = IntegerField()
+    issued = DateTimeField()
+
+
+class StrictJsonTestCase(unittest2.TestCase):
+
+    def test_strict_documents_load_back(self):
+        document = {'_id': ObjectId(), 'issued': datetime(2012, 5, 1, 10, 30, 15, 250000), 'lines': [1, 2]}
+        line = bson_json.dumps(document, strict=True)
+        self.assertIn('"$oid"', line)
+        self.assertEqual(document, bson_json.loads(line, tz_aware=False))
+
+    def test_default_conversion_is_unchanged(self):
+        _id = ObjectId()
+        self.assertEqual('{"_id": "%s"}' % _id, bson_json.dumps({'_id': _id}))
+
+
+class ExportImportTestCase(testing.AsyncTestCase, unittest2.TestCase):
+
+    def setUp(self):
+        super(ExportImportTestCase, self).setUp()
+        memory.MemoryClient.reset()
+        Session._session = None
+        Session.create('localhost', 27017, 'test', client_class=memory.MemoryClient, io_loop=self.io_loop)
+        self.ids = []
+        for index in range(5):
+            invoice = Invoice()
+            invoice._id = ObjectId()
+            invoice.customer = u'acme'
+            invoice.total = index * 100
+            invoice.issued = datetime(2012, 1, index + 1, 12)
+            invoice.save(callback=self.stop)
+            self.wait()
+            self.ids.append(invoice._id)
+
+    def tearDown(self):
+        Session.destroy()
+        super(ExportImportTestCase, self).tearDown()
+
+    def documents(self):
+        Invoice.objects.find({}, callback=self.stop, sort=[('_id', 1)])
+        return [invoice.as_dict() for invoice in self.wait()]
+
+    def test_export_and_import_round_trip(self):
+        original = self.documents()
+        stream = StringIO()
+        Invoice.objects.export(stream, callback=self.stop, batch_size=2)
+        self.assertEqual(5, self.wait())
+        self.assertEqual(5, len(stream.getvalue().splitlines()))
+
+        Invoice.objects.drop(callback=self.stop)
+        self.wait()
+        stream.seek(0)
+        Invoice.objects.import_(stream, callback=self.stop, upsert=False)
+        self.assertEqual(5, self.wait())
+        self.assertEqual(original, self.documents())
+
+    def test_export_resumes_after_a_checkpoint(self):
+        progress = []
+        stream = StringIO()
+        Invoice.objects.export(stream, callback=self.stop, query={'customer': 'acme'}, batch_size=2,
+                               on_progress=lambda count, last: progress.append((count, last)))
+        self.wait()
+        self.assertEqual([(2, self.ids[1]), (4, self.ids[3]), (5, self.ids[4])], progress)
+
+        resumed = StringIO()
+        Invoice.objects.export(resumed, callback=self.stop, after=self.ids[3])
+        self.assertEqual(1, self.wait())
+        self.assertEqual(stream.getvalue().splitlines()[-1], resumed.getvalue().strip())
+
+    def test_import_upserts_in_batches(self):
+        stream = StringIO()
+        Invoice.objects.export(stream, callback=self.stop)
+        self.wait()
+        lines = stream.getvalue().splitlines()
+        changed = bson_json.loads(lines[0])
+        changed['total'] = 999
+        lines[0] = bson_json.dumps(changed, strict=True)
+
+        progress = []
+        tracker = QueryTracker()
+        with tracker.scope():
+            Invoice.objects.import_(StringIO('\n'.join(lines) + '\n\n'), callback=self.stop, batch_size=2,
+                                    on_progress=lambda count, last: progress.append(count))
+            self.assertEqual(5, self.wait())
+        self.assertEqual([2, 4, 5], progress)
+        self.assertEqual(3, tracker.operations[('invoice', 'import')])
+        self.assertEqual(999, self.documents()[0]['total'])
+
+    def test_import_resumes_after_a_checkpoint(self):
+        stream = StringIO()
+        Invoice.objects.export(stream, callback=self.stop)
+        self.wait()
+        Invoice.objects.drop(callback=self.stop)
+        self.wait()
+
+        stream.seek(0)
+        progress = []
+        Invoice.objects.import_(stream, callback=self.stop, upsert=False, batch_size=3,
+                                on_progress=lambda count, position: progress.append(position))
+        self.wait()
+        self.assertEqual([3, 5], progress)
+        Invoice.objects.drop(callback=self.stop)
+        self.wait()
+
+        # documents without an _id are not loaded again on resume
+        lines = stream.getvalue().splitlines()
+        lines[4] = bson_json.dumps({'customer': u'walk-in', 'total': 1}, strict=True)
+        Invoice.objects.import_(StringIO('\n'.join(lines)), callback=self.stop, upsert=False, skip=3)
+        self.assertEqual(2, self.wait())
+        first, second = self.documents()
+        self.assertEqual(self.ids[3], first['_id'])
+        self.assertEqual(u'walk-in', second['customer'])
+
+    def test_documents_without_an_id_are_not_duplicated_on_resume(self):
+        Invoice.objects.drop(callback=self.stop)
+        self.wait()
+        lines = [bson_json.dumps({'customer': u'walk-in', 'total': total}, strict=True) for total in (1, 1, 2)]
+        Invoice.objects.import_(StringIO('\n'.join(lines[:2])), callback=self.stop)
+        self.assertEqual(2, self.wait())
+        # the interrupted import is resumed from its last checkpoint
+        Invoice.objects.import_(StringIO(u'\n'.join(lines)), callback=self.stop, skip=1)
+        self.assertEqual(2, self.wait())
+        self.assertEqual([1, 1, 2], [document['total'] for document in self.documents()])
+
+    def test_a_failed_upsert_fails_the_import(self):
+        Session('invoice').create_index([('total', 1)], unique=True,
+                                        callback=lambda response, error: self.stop())
+        self.wait()
+        lines = [bson_json.dumps({'_id': ObjectId(), 'total': total}, strict=True) for total in (1000, 100, 2000)]
+        progress = []
+        Invoice.objects.import_(StringIO('\n'.join(lines)), callback=self.stop,
+                                on_progress=lambda count, position: progress.append(count))
+        with self.assertRaises(IntegrityError):
+            self.wait()
+        self.assertEqual([], progress)
@@ -0,0 +1,122 @@
+import threading
+import unittest2
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from bson import ObjectId
+from tornado import testing
+from asyncmongoorm import memory
+from asyncmongoorm import offload
+from asyncmongoorm.collection import Collection
+from asyncmongoorm.field import IntegerField, ObjectIdField, StringField
+from asyncmongoorm.identitymap import IdentityMap
+from asyncmongoorm.session import Session
+
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
+threads = []
+
+class Reading(Collection):
+    __collection__ = 'reading'
+    _id = ObjectIdField()
+    station = StringField()
+    value = IntegerField()
+
+    failing = False
+
+    @classmethod
+    def create(cls, dictionary):
+        threads.append(threading.current_thread())
+        if cls.failing:
+            raise ValueError("can not hydrate %r" % dictionary)
+        return super(Reading, cls).create(dictionary)
+
+
+class OffloadTestCase(testing.AsyncTestCase, unittest2.TestCase):
+
+    def setUp(self):
+        super(OffloadTestCase, self).setUp()
+        memory.MemoryClient.reset()
+        Session._session = None
+        Session.create('localhost', 27017, 'test', client_class=memory.MemoryClient, io_loop=self.io_loop)
+        for index in range(4):
+            reading = Reading()
+            reading._id = ObjectId()
+            reading.station = u'north'
+            reading.value = index
+            reading.save(callback=self.stop)
+            self.wait()
+        self.pool = ThreadPool(1)
+        del threads[:]
+
+    def tearDown(self):
+        Reading.failing = False
+        offload.disable()
+        self.pool.terminate()
+        Session.destroy()
+        super(OffloadTestCase, self).tearDown()
+
+    def test_large_results_are_hydrated_by_the_pool(self):
+        hydration = offload.enable(self.pool, threshold=4, io_loop=self.io_loop)
+        Reading.objects.find({}, callback=self.stop)
+        readings = self.wait()
+        self.assertEqual([0, 1, 2, 3], [reading.value for reading in readings])
+        self.assertNotIn(threading.current_thread(), threads)
+        self.assertEqual({'batches': 1, 'documents': 4, 'errors': 0}, hydration.stats())
+
+    def test_small_results_are_hydrated_in_place(self):
+        offload.enable(self.pool, threshold=5, io_loop=self.io_loop)
+        Reading.objects.find({}, callback=self.stop)
+        self.assertEqual(4, len(self.wait()))
+        self.assertEqual([threading.current_thread()] * 4, threads)
+
+    def test_identity_map_is_consulted_on_the_ioloop(self):
+        offload.enable(self.pool, threshold=1, io_loop=self.io_loop)
+        identity_map = IdentityMap()
+        with identity_map.scope():
+            Reading.objects.find({'value': 2}, callback=self.stop)
+            first = self.wait()[0]
+            Reading.objects.find({}, callback=self.stop)
+            readings = self.wait()
+        self.assertIs(first, readings[2])
+        self.assertEqual(4, len(identity_map))
+
+    def test_process_pool(self):
+        processes = Pool(1)
+        self.addCleanup(processes.terminate)
+        offload.enable(processes, threshold=1, io_loop=self.io_loop)
+        running = threading.active_count()
+        for _ in range(3):
+            Reading.objects.find({}, callback=self.stop)
+            readings = self.wait()
+        self.assertEqual([0, 1, 2, 3], [reading.value for reading in readings])
+        self.assertFalse(readings[0].is_new())
+        # hydrated in the other process
+        self.assertEqual([], threads)
+        # one thread waits for every batch
+        self.assertEqual(running + 1, threading.active_count())
+
+    def test_hydration_errors_reach_the_caller(self):
+        hydration = offload.enable(self.pool, threshold=1, io_loop=self.io_loop)
+        Reading.failing = True
+        Reading.objects.find({}, callback=self.stop)
+        with self.assertRaises(ValueError):
+            self.wait()
+
+        # an executor that does not take work any more; Python 2 asserts
+        self.pool.close()
+        Reading.failing = False
+        Reading.objects.find({}, callback=self.stop)
+        with self.assertRaises((AssertionError, ValueError)):
+            self.wait()
+        self.assertEqual(2, hydration.stats()['errors'])
+
+    @unittest2.skipIf(futures is None, "concurrent.futures is not installed")
+    def test_futures_executor(self):
+        executor = futures.ThreadPoolExecutor(1)
+        offload.enable(executor, threshold=1, io_loop=self.io_loop)
+        Reading.objects.find({}, callback=self.stop)
+        self.assertEqual(4, len(self.wait()))
+        executor.shutdown()
@@ -0,0 +1,97 @@
+import fudge
+import unittest2
+from asyncmongo import pool as asyncmongo_pool
+from asyncmongo.errors import TooManyConnections
+from asyncmongoorm import memory
+from asyncmongoorm import pool
+from asyncmongoorm.session import Session
+
+class FakeConnection(object):
+
+    def __init__(self, *args, **kwargs):
+        self.usage_count = 0
+        self.closed = False
+
+    def _close(self):
+        self.closed = True
+
+
+class MonitoredConnectionPoolTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.patch = fudge.patch_object(asyncmongo_pool, 'Connection', FakeConnection)
+
+    def tearDown(self):
+        self.patch.restore()
+        Session._session = None
+
+    def test_counts_connections_in_use_idle_and_rejected(self):
+        connection_pool = pool.MonitoredConnectionPool(maxconnections=2)
+        first = connection_pool.connection()
+        connection_pool.connection()
+        with self.assertRaises(TooManyConnections):
+            connection_pool.connection()
+        connection_pool.cache(first)
+
+        stats = connection_pool.stats()
+        self.assertEqual(1, stats['in_use'])
+        self.assertEqual(1, stats['idle'])
+        self.assertEqual(2, stats['peak_in_use'])
+        self.assertEqual(2, stats['opened'])
+        self.assertEqual(1, stats['rejected'])
+        self.assertEqual(2, stats['acquire_time']['count'])
+
+    def test_counts_connections_closed_by_a_full_idle_cache(self):
+        connection_pool = pool.MonitoredConnectionPool(maxcached=1)
+        first, second = connection_pool.connection(), connection_pool.connection()
+        connection_pool.cache(first)
+        connection_pool.cache(second)
+        self.assertEqual(1, connection_pool.stats()['closed'])
+        self.assertTrue(second.closed)
+
+    def test_warm_up_opens_idle_connections(self):
+        client = pool.MonitoredClient(pool_id='warm_pool', dbname='test', warm_up=3)
+        self.addCleanup(asyncmongo_pool.ConnectionPools._pools.pop, 'warm_pool')
+        # nothing is dialed before the first use
+        self.assertEqual(0, client._pool.stats()['opened'])
+        client.connection('warm')
+        stats = client._pool.stats()
+        self.assertEqual(3, stats['idle'])
+        self.assertEqual(3, stats['opened'])
+
+        client._pool.connection()
+        self.assertEqual(3, client._pool.stats()['opened'])
+
+    def test_adaptive_pool_grows_while_acquiring_waits(self):
+        connection_pool = pool.MonitoredConnectionPool(adaptive=(1, 8), target_wait=0.001)
+        connection_pool.resize(0.005, 1)
+        self.assertEqual(2, connection_pool.size)
+        connection_pool.resize(0.005, 2)
+        connection_pool.resize(0.005, 4)
+        connection_pool.resize(0.005, 8)
+        self.assertEqual(8, connection_pool.size)
+
+    def test_adaptive_pool_shrinks_when_mostly_idle(self):
+        connection_pool = pool.MonitoredConnectionPool(adaptive=(2, 8))
+        connection_pool.resize(1, 8)
+        connection_pool.resize(1, 8)
+        connection_pool.warm_up(8)
+        self.assertEqual(8, connection_pool.stats()['idle'])
+
+        connection_pool.resize(0.0, 1)
+        self.assertEqual(4, connection_pool.size)
+        self.assertEqual(4, connection_pool.stats()['idle'])
+        self.assertEqual(4, connection_pool.stats()['closed'])
+        connection_pool.resize(0.0, 1)
+        connection_pool.resize(0.0, 1)
+        self.assertEqual(2, connection_pool.size)
+
+    def test_adaptive_pool_resizes_every_window(self):
+        connection_pool = pool.MonitoredConnectionPool(adaptive=(1, 4), target_wait=-1, adapt_every=3)
+        for i in range(3):
+            connection_pool.cache(connection_pool.connection())
+        self.assertEqual(2, connection_pool.size)
+
+    def test_session_pool_stats(self):
+        Session.create('localhost', 27017, 'test', client_class=memory.MemoryClient)
+        self.assertEqual({'in_use': 0, 'idle': 0, 'max_connections': 0}, Session.pool_stats())
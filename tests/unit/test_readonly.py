@@ -0,0 +1,81 @@
+import unittest2
+from bson import ObjectId
+from tornado import testing
+from asyncmongoorm import collection
+from asyncmongoorm import memory
+from asyncmongoorm.collection import Collection
+from asyncmongoorm.field import IntegerField, ObjectIdField, StringField
+from asyncmongoorm.identitymap import IdentityMap
+from asyncmongoorm.session import Session
+
+class Country(Collection):
+    __collection__ = 'country'
+    _id = ObjectIdField()
+    name = StringField()
+    population = IntegerField(default=0)
+
+
+class ReadOnlyInstanceTestCase(unittest2.TestCase):
+
+    def test_frozen_instance_shares_the_document(self):
+        document = {'_id': ObjectId(), 'name': u'Chile'}
+        country = Country.create_read_only(document)
+        self.assertIs(document, country._data)
+        self.assertEqual(u'Chile', country.name)
+        self.assertEqual(0, country.population)
+        self.assertNotIn('population', document)
+        self.assertIsInstance(country, Country)
+        self.assertFalse(country.is_new())
+        self.assertFalse(hasattr(country, '_changed_fields'))
+        self.assertIsNone(country.related('name'))
+
+    def test_frozen_instance_refuses_changes(self):
+        country = Country.create_read_only({'_id': ObjectId(), 'name': u'Peru'})
+        with self.assertRaises(AttributeError):
+            country.name = u'Bolivia'
+        with self.assertRaises(AttributeError):
+            country.anything = 1
+        with self.assertRaises(AttributeError):
+            del country.name
+        with self.assertRaises(AttributeError):
+            country.save()
+        self.assertEqual(u'Peru', country.name)
+
+    def test_frozen_class_is_not_registered(self):
+        Country.create_read_only({})
+        self.assertIs(Country, Collection('Country'))
+        self.assertEqual(1, len([model for model in collection.get_collections() if model.__name__ == 'Country']))
+
+
+class ReadOnlyQueryTestCase(testing.AsyncTestCase, unittest2.TestCase):
+
+    def setUp(self):
+        super(ReadOnlyQueryTestCase, self).setUp()
+        memory.MemoryClient.reset()
+        Session._session = None
+        Session.create('localhost', 27017, 'test', client_class=memory.MemoryClient, io_loop=self.io_loop)
+        country = Country()
+        country._id = ObjectId()
+        country.name = u'Chile'
+        country.save(callback=self.stop)
+        self.wait()
+        self._id = country._id
+
+    def tearDown(self):
+        Session.destroy()
+        super(ReadOnlyQueryTestCase, self).tearDown()
+
+    def test_reads_can_return_frozen_instances(self):
+        Country.objects.find({}, callback=self.stop, read_only=True)
+        countries = self.wait()
+        self.assertTrue(countries[0]._read_only)
+
+        with IdentityMap().scope():
+            Country.objects.find_one({'_id': self._id}, callback=self.stop, read_only=True)
+            country = self.wait()
+        self.assertTrue(country._read_only)
+        self.assertEqual(u'Chile', country.name)
+
+    def test_read_only_results_can_not_be_prefetched(self):
+        with self.assertRaises(ValueError):
+            Country.objects.find({}, callback=self.stop, read_only=True, prefetch='name')
@@ -0,0 +1,131 @@
+import unittest2
+from bson import ObjectId
+from tornado import testing
+from asyncmongoorm import memory
+from asyncmongoorm.collection import Collection
+from asyncmongoorm.field import ObjectIdField, ReferenceField, StringField
+from asyncmongoorm.identitymap import IdentityMap
+from asyncmongoorm.manager import prefetch_related
+from asyncmongoorm.session import Session
+from asyncmongoorm.tracker import QueryTracker
+
+class Publisher(Collection):
+    __collection__ = 'publisher'
+    _id = ObjectIdField()
+    name = StringField()
+
+
+class Writer(Collection):
+    __collection__ = 'writer'
+    _id = ObjectIdField()
+    name = StringField()
+    publisher = ReferenceField(Publisher)
+
+
+class Book(Collection):
+    __collection__ = 'book'
+    _id = ObjectIdField()
+    title = StringField()
+    writer = ReferenceField('Writer')
+    editor = ReferenceField('Writer')
+
+
+class ReferenceFieldTestCase(unittest2.TestCase):
+
+    def test_assigning_an_instance_stores_its_id(self):
+        writer = Writer()
+        writer._id = ObjectId()
+        book = Book()
+        book.writer = writer
+        self.assertEqual(writer._id, book.writer)
+        self.assertIs(writer, book.related('writer'))
+        self.assertEqual({'writer': writer._id}, book.as_dict(fields=['writer']))
+
+        book.writer = ObjectId()
+        self.assertIsNone(book.related('writer'))
+
+    def test_target_model_can_be_named(self):
+        self.assertIs(Writer, Book.writer.target_model)
+
+    def test_target_model_can_be_defined_later(self):
+        class Review(Collection):
+            __collection__ = 'review'
+            _id = ObjectIdField()
+            magazine = ReferenceField('Magazine')
+
+        _id = ObjectId()
+        review = Review.create({'_id': ObjectId(), 'magazine': _id})
+        self.assertEqual(_id, review.magazine)
+
+        with self.assertRaises(ValueError):
+            review.magazine = Book()
+
+        class Magazine(Collection):
+            __collection__ = 'magazine'
+            _id = ObjectIdField()
+
+        magazine = Magazine()
+        magazine._id = ObjectId()
+        review.magazine = magazine
+        self.assertEqual(magazine._id, review.magazine)
+        self.assertIs(Magazine, Review.magazine.target_model)
+
+
+class PrefetchTestCase(testing.AsyncTestCase, unittest2.TestCase):
+
+    def setUp(self):
+        super(PrefetchTestCase, self).setUp()
+        memory.MemoryClient.reset()
+        Session._session = None
+        Session.create('localhost', 27017, 'test', client_class=memory.MemoryClient, io_loop=self.io_loop)
+
+        self.publisher = self.save(Publisher(), name=u'press')
+        self.writers = [self.save(Writer(), name=name, publisher=self.publisher) for name in (u'ann', u'ben')]
+        for index in range(4):
+            self.save(Book(), title=u'book %d' % index, writer=self.writers[index % 2], editor=self.writers[0])
+
+    def tearDown(self):
+        Session.destroy()
+        super(PrefetchTestCase, self).tearDown()
+
+    def save(self, instance, **values):
+        instance._id = ObjectId()
+        for name, value in values.iteritems():
+            setattr(instance, name, value)
+        instance.save(callback=self.stop)
+        self.wait()
+        return instance
+
+    def test_references_are_loaded_with_one_query_per_model(self):
+        tracker = QueryTracker()
+        with tracker.scope():
+            Book.objects.find({}, callback=self.stop, prefetch=('writer', 'editor', 'writer.publisher'))
+            books = self.wait()
+        self.assertEqual({('book', 'find'): 1, ('writer', 'find'): 1, ('publisher', 'find'): 1},
+                         tracker.operations)
+        self.assertEqual([u'ann', u'ben', u'ann', u'ben'], [book.related('writer').name for book in books])
+        self.assertEqual(u'ann', books[1].related('editor').name)
+        self.assertIs(books[0].related('writer'), books[0].related('editor'))
+        self.assertEqual(u'press', books[3].related('writer').related('publisher').name)
+
+    def test_prefetch_skips_instances_of_the_identity_map(self):
+        tracker = QueryTracker()
+        with IdentityMap().scope():
+            Writer.objects.find({}, callback=self.stop)
+            writers = self.wait()
+            with tracker.scope():
+                Book.objects.find({}, callback=self.stop, prefetch='writer')
+                books = self.wait()
+        self.assertEqual({('book', 'find'): 1}, tracker.operations)
+        self.assertIn(books[0].related('writer'), writers)
+
+    def test_prefetch_of_loaded_instances(self):
+        book = Book()
+        book.writer = self.writers[1]._id
+        prefetch_related([book], 'writer', callback=self.stop)
+        self.wait()
+        self.assertEqual(u'ben', book.related('writer').name)
+
+    def test_only_reference_fields_can_be_prefetched(self):
+        with self.assertRaises(ValueError):
+            prefetch_related([Book()], 'title', callback=self.stop)
@@ -0,0 +1,135 @@
+import unittest2
+from bson import ObjectId
+from tornado import testing
+from asyncmongoorm import memory
+from asyncmongoorm import replica
+from asyncmongoorm.collection import Collection
+from asyncmongoorm.field import IntegerField, ObjectIdField, StringField
+from asyncmongoorm.session import Session
+from asyncmongoorm.signal import post_update, post_remove
+from asyncmongoorm.tracker import QueryTracker
+
+class Plan(Collection):
+    __collection__ = 'plan'
+    _id = ObjectIdField()
+    code = StringField(index='unique')
+    tier = StringField(index=('sparse',))
+    seats = IntegerField()
+
+
+class ReplicaTestCase(testing.AsyncTestCase, unittest2.TestCase):
+
+    def setUp(self):
+        super(ReplicaTestCase, self).setUp()
+        memory.MemoryClient.reset()
+        Session._session = None
+        Session.create('localhost', 27017, 'test', client_class=memory.MemoryClient, io_loop=self.io_loop)
+        self.plans = [self.save(Plan(), code=code, tier=tier, seats=seats)
+                      for code, tier, seats in ((u'free', u'basic', 1), (u'team', u'pro', 10), (u'corp', u'pro', 100))]
+        self.replica = replica.replicate(Plan, interval=None, batch_size=2, io_loop=self.io_loop)
+        self.replica.start(callback=self.stop)
+        self.assertTrue(self.wait())
+
+    def tearDown(self):
+        replica.clear()
+        Session.destroy()
+        super(ReplicaTestCase, self).tearDown()
+
+    def save(self, instance, **values):
+        if instance.is_new():
+            instance._id = ObjectId()
+        for name, value in values.iteritems():
+            setattr(instance, name, value)
+        instance.save(callback=self.stop)
+        self.wait()
+        return instance
+
+    def test_indexed_equalities_are_answered_from_memory(self):
+        tracker = QueryTracker()
+        with tracker.scope():
+            Plan.objects.find_one({'code': 'team'}, callback=self.stop)
+            plan = self.wait()
+            Plan.objects.find({'tier': 'pro', 'seats': 100}, callback=self.stop)
+            plans = self.wait()
+            Plan.objects.find_one({'_id': self.plans[0]._id}, callback=self.stop, read_only=True)
+            frozen = self.wait()
+        self.assertEqual({}, tracker.operations)
+        self.assertEqual(10, plan.seats)
+        self.assertFalse(plan.is_new())
+        self.assertEqual([u'corp'], [found.code for found in plans])
+        self.assertTrue(frozen._read_only)
+        self.assertEqual(3, self.replica.stats()['hits'])
+
+    def test_other_queries_go_to_the_database(self):
+        tracker = QueryTracker()
+        with tracker.scope():
+            Plan.objects.find_one({'seats': 10}, callback=self.stop)
+            self.wait()
+            Plan.objects.find({'seats': {'$gt': 5}}, callback=self.stop)
+            self.wait()
+            Plan.objects.find({'code': 'team'}, callback=self.stop, limit=1)
+            self.wait()
+        self.assertEqual({('plan', 'find_one'): 1, ('plan', 'find'): 2}, tracker.operations)
+
+    def test_instances_are_copies(self):
+        Plan.objects.find_one({'code': 'free'}, callback=self.stop)
+        plan = self.wait()
+        plan.seats = 2
+        Plan.objects.find_one({'code': 'free'}, callback=self.stop)
+        self.assertEqual(1, self.wait().seats)
+
+    def test_signals_keep_the_replica_current(self):
+        self.save(self.plans[1], code=u'group')
+        self.save(Plan(), code=u'solo', tier=u'basic', seats=1)
+        self.plans[2].remove(callback=self.stop)
+        self.wait()
+
+        Plan.objects.find_one({'code': 'team'}, callback=self.stop)
+        self.assertIsNone(self.wait())
+        Plan.objects.find({'tier': 'pro'}, callback=self.stop)
+        self.assertEqual([u'group'], [plan.code for plan in self.wait()])
+        Plan.objects.find({}, callback=self.stop)
+        self.assertEqual([u'free', u'group', u'solo'], [plan.code for plan in self.wait()])
+
+    def test_saved_data_reaches_the_replica(self):
+        self.plans[0].save(obj_data={'seats': 2}, callback=self.stop)
+        self.wait()
+        Plan.objects.find_one({'code': 'free'}, callback=self.stop)
+        self.assertEqual(2, self.wait().seats)
+
+    def test_answers_from_memory_are_asynchronous(self):
+        answered = []
+        Plan.objects.find_one({'code': 'team'}, callback=answered.append)
+        Plan.objects.find({'tier': 'pro'}, callback=answered.append)
+        self.assertEqual([], answered)
+        self.io_loop.add_callback(self.stop)
+        self.wait()
+        self.assertEqual(2, len(answered))
+
+    def test_signals_sent_during_a_reload_survive_it(self):
+        self.replica.load(callback=self.stop)
+        # the documents are read, the answer is on its way
+        team, corp = self.plans[1], self.plans[2]
+        team.seats = 20
+        post_update.send(instance=team)
+        post_remove.send(instance=corp)
+        self.assertTrue(self.wait())
+
+        Plan.objects.find_one({'code': 'team'}, callback=self.stop)
+        self.assertEqual(20, self.wait().seats)
+        Plan.objects.find({'tier': 'pro'}, callback=self.stop)
+        self.assertEqual([u'team'], [plan.code for plan in self.wait()])
+        self.assertEqual([], self.replica._journal)
+
+    def test_reload_picks_up_outside_writes(self):
+        Session('plan').insert({'_id': ObjectId(), 'code': u'edu', 'seats': 30},
+                              callback=lambda response, error: self.stop())
+        self.wait()
+        Plan.objects.find_one({'code': 'edu'}, callback=self.stop)
+        self.assertIsNone(self.wait())
+
+        self.replica.load(callback=self.stop)
+        self.wait()
+        Plan.objects.find_one({'code': 'edu'}, callback=self.stop)
+        self.assertEqual(30, self.wait().seats)
+        self.assertEqual(4, len(self.replica))
@@ -0,0 +1,168 @@
+import unittest2
+from asyncmongo.errors import InterfaceError
+from tornado import testing
+from asyncmongoorm import memory
+from asyncmongoorm import replicaset
+from asyncmongoorm.collection import Collection
+from asyncmongoorm.field import ObjectIdField, StringField
+from asyncmongoorm.session import Session
+
+HOSTS = ['db1:27017', 'db2:27017', 'db3:27017']
+
+class MemberClient(memory.MemoryClient):
+    """Memory client answering isMaster from `topology` and remembering the
+    collections it was asked for."""
+
+    topology = {}
+    unreachable = set()
+
+    def __init__(self, pool_id=None, host=None, port=None, **kwargs):
+        super(MemberClient, self).__init__(pool_id=pool_id, host=host, port=port, **kwargs)
+        self.pool_id = pool_id
+        self.address = '%s:%d' % (host, port)
+        self.used = []
+
+    def connection(self, collectionname, dbname=None):
+        self.used.append(collectionname)
+        return super(MemberClient, self).connection(collectionname, dbname)
+
+    def command(self, command, value=1, callback=None, **kwargs):
+        if command != 'isMaster':
+            return super(MemberClient, self).command(command, value, callback=callback, **kwargs)
+        if self.address in self.unreachable:
+            raise InterfaceError('[Errno 111] Connection refused')
+        status = self.topology.get(self.address)
+        if status is None:
+            self.deliver(callback, None, error='connection refused')
+        else:
+            self.deliver(callback, dict(status, hosts=HOSTS, ok=1.0))
+
+
+class ReportModel(Collection):
+    __collection__ = 'report_model'
+    __read_preference__ = replicaset.SECONDARY
+    _id = ObjectIdField()
+    name = StringField()
+
+
+class ReplicaSetTestCase(testing.AsyncTestCase, unittest2.TestCase):
+
+    def setUp(self):
+        super(ReplicaSetTestCase, self).setUp()
+        memory.MemoryClient.reset()
+        MemberClient.topology = {
+            'db1:27017': {'ismaster': False, 'secondary': True},
+            'db2:27017': {'ismaster': True, 'secondary': False},
+            'db3:27017': {'ismaster': False, 'secondary': True},
+        }
+        self.client = replicaset.ReplicaSetClient(pool_id='rs', seeds=['db1:27017'], dbname='test',
+                                                  member_class=MemberClient, heartbeat=None,
+                                                  io_loop=self.io_loop)
+        self.client.refresh(callback=self.stop)
+        self.wait()
+
+    def tearDown(self):
+        self.client.close()
+        super(ReplicaSetTestCase, self).tearDown()
+
+
+class ReplicaSetClientTestCase(ReplicaSetTestCase):
+
+    def member(self, address):
+        return [member for member in self.client.members if member.address == address][0]
+
+    def test_parse_address(self):
+        self.assertEqual(('db1', 27017), replicaset.parse_address('db1'))
+        self.assertEqual(('db1', 27018), replicaset.parse_address('db1:27018'))
+        self.assertEqual(('db1', 27019), replicaset.parse_address(('db1', '27019')))
+
+    def test_discovers_members_from_a_seed(self):
+        self.assertEqual(HOSTS, [member.address for member in self.client.members])
+        self.assertEqual('db2:27017', self.client.primary.address)
+        self.assertTrue(all(member.up for member in self.client.members))
+
+    def test_writes_and_primary_reads_go_to_the_primary(self):
+        self.client.some_collection
+        self.client.member(replicaset.PRIMARY).another_collection
+        self.assertEqual(['some_collection', 'another_collection'], self.client.primary.client.used)
+
+    def test_secondary_reads_avoid_the_primary(self):
+        for i in range(20):
+            self.assertNotEqual('db2:27017', self.client.select(replicaset.SECONDARY).address)
+
+    def test_secondary_reads_fall_back_to_the_primary(self):
+        MemberClient.topology['db1:27017'] = None
+        MemberClient.topology['db3:27017'] = None
+        self.client.refresh(callback=self.stop)
+        self.wait()
+        self.assertFalse(self.member('db1:27017').up)
+        self.assertEqual('db2:27017', self.client.select(replicaset.SECONDARY).address)
+
+    def test_nearest_picks_the_members_within_the_latency_window(self):
+        self.member('db1:27017').latency = 0.050
+        self.member('db2:27017').latency = 0.002
+        self.member('db3:27017').latency = 0.010
+        picked = set(self.client.select(replicaset.NEAREST).address for i in range(50))
+        self.assertEqual(set(['db2:27017', 'db3:27017']), picked)
+
+    def test_follows_a_new_primary(self):
+        MemberClient.topology['db2:27017'] = {'ismaster': False, 'secondary': True}
+        MemberClient.topology['db3:27017'] = {'ismaster': True, 'secondary': False}
+        self.client.refresh(callback=self.stop)
+        self.wait()
+        self.assertEqual('db3:27017', self.client.primary.address)
+
+    def test_an_unreachable_seed_is_marked_down(self):
+        MemberClient.unreachable = set(['db0:1'])
+        client = replicaset.ReplicaSetClient(pool_id='rs_dead', seeds=['db0:1', 'db1:27017'], dbname='test',
+                                             member_class=MemberClient, heartbeat=None, io_loop=self.io_loop)
+        try:
+            client.refresh(callback=self.stop)
+            self.wait()
+            self.assertEqual(['db0:1'] + HOSTS, [member.address for member in client.members])
+            self.assertEqual([False, True, True, True], [member.up for member in client.members])
+            self.assertEqual('db2:27017', client.select(replicaset.PRIMARY).address)
+            self.assertNotEqual('db0:1', client.select(replicaset.SECONDARY).address)
+        finally:
+            MemberClient.unreachable = set()
+            client.close()
+
+    def test_unknown_read_preference(self):
+        with self.assertRaises(ValueError):
+            self.client.select('anywhere')
+
+
+class ReplicaSetSessionTestCase(ReplicaSetTestCase):
+
+    def setUp(self):
+        super(ReplicaSetSessionTestCase, self).setUp()
+        Session._session = self.client
+
+    def tearDown(self):
+        Session._session = None
+        super(ReplicaSetSessionTestCase, self).tearDown()
+
+    def test_manager_reads_use_the_model_read_preference(self):
+        ReportModel.objects.find({}, callback=self.stop)
+        self.wait()
+        self.assertEqual([], self.client.primary.client.used)
+
+    def test_query_read_preference_overrides_the_model(self):
+        ReportModel.objects.count(callback=self.stop, read_preference=replicaset.PRIMARY)
+        self.wait()
+        self.assertEqual(['$cmd'], self.client.primary.client.used)
+
+    def test_saves_go_to_the_primary(self):
+        instance = ReportModel()
+        instance.name = u'monthly'
+        instance.save(callback=self.stop)
+        self.wait()
+        self.assertEqual(['report_model'], self.client.primary.client.used)
+
+    def test_create_replica_set_session(self):
+        Session.create_replica_set(['db1:27017'], 'test', client_class=MemberClient, alias='reports',
+                                   heartbeat=None, io_loop=self.io_loop)
+        self.addCleanup(Session.destroy, 'reports')
+        client = Session.client('reports')
+        self.assertIsInstance(client, replicaset.ReplicaSetClient)
+        self.assertEqual('mydb_reports_db1:27017', client.members[0].client.pool_id)
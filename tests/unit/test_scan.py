@@ -0,0 +1,69 @@
+import unittest2
+from bson import ObjectId
+from tornado import testing
+from asyncmongoorm import memory
+from asyncmongoorm.collection import Collection
+from asyncmongoorm.field import IntegerField, ObjectIdField, StringField
+from asyncmongoorm.session import Session
+from asyncmongoorm.tracker import QueryTracker
+
+class Event(Collection):
+    __collection__ = 'event'
+    _id = ObjectIdField()
+    kind = StringField()
+    bucket = IntegerField()
+
+
+class ParallelScanTestCase(testing.AsyncTestCase, unittest2.TestCase):
+
+    def setUp(self):
+        super(ParallelScanTestCase, self).setUp()
+        memory.MemoryClient.reset()
+        Session._session = None
+        Session.create('localhost', 27017, 'test', client_class=memory.MemoryClient, io_loop=self.io_loop)
+        self.ids = []
+        for index in range(20):
+            event = Event()
+            event._id = ObjectId()
+            event.kind = u'click' if index % 2 else u'view'
+            event.bucket = index // 3
+            event.save(callback=self.stop)
+            self.wait()
+            self.ids.append(event._id)
+
+    def tearDown(self):
+        Session.destroy()
+        super(ParallelScanTestCase, self).tearDown()
+
+    def test_split_points_of_the_whole_collection(self):
+        Event.objects.split_points(4, callback=self.stop)
+        self.assertEqual([self.ids[5], self.ids[10], self.ids[15]], self.wait())
+
+    def test_split_points_of_a_query_are_sampled(self):
+        Event.objects.split_points(2, callback=self.stop, query={'kind': 'view'})
+        self.assertEqual([self.ids[10]], self.wait())
+
+    def test_segments_are_scanned_concurrently_and_merged(self):
+        tracker = QueryTracker()
+        with tracker.scope():
+            Event.objects.parallel_scan(callback=self.stop, segments=4, batch_size=2)
+            events = self.wait()
+        self.assertEqual(self.ids, [event._id for event in events])
+        # three pages for each segment of five documents
+        self.assertEqual(12, tracker.operations[('event', 'find')])
+
+    def test_batches_are_handed_out_per_segment(self):
+        batches = []
+        Event.objects.parallel_scan(callback=self.stop, query={'kind': 'click'}, segments=2, batch_size=3,
+                                    on_batch=lambda instances, segment: batches.append((segment, len(instances))))
+        self.assertEqual(10, self.wait())
+        self.assertEqual(set([0, 1]), set(segment for segment, _ in batches))
+        self.assertEqual(10, sum(size for _, size in batches))
+
+    def test_scan_on_a_key_with_repeated_values(self):
+        Event.objects.parallel_scan(callback=self.stop, key='bucket', boundaries=[3], batch_size=2,
+                                    read_only=True)
+        events = self.wait()
+        self.assertEqual(20, len(events))
+        self.assertEqual(sorted(self.ids), sorted(event._id for event in events))
+        self.assertTrue(all(event._read_only for event in events))
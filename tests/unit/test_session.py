@@ -1,7 +1,24 @@
+import os
 import unittest2
 import fudge
+from asyncmongo import pool as asyncmongo_pool
+from asyncmongo.pool import ConnectionPools
+from tornado import process
+from tornado.ioloop import IOLoop
+from asyncmongoorm import memory
+from asyncmongoorm import pool
+from asyncmongoorm import replicaset
 from asyncmongoorm import session
 
+class FakeConnection(object):
+
+    def __init__(self, *args, **kwargs):
+        self.usage_count = 0
+
+    def _close(self):
+        pass
+
+
 class SessionTestCase(unittest2.TestCase):
     
     def setUp(self):
@@ -53,3 +70,124 @@ class SessionTestCase(unittest2.TestCase):
         session.Session._session = fudge.Fake().has_attr(collection_name='should_be_collection')
         self.assertEquals('should_be_collection', session.Session('collection_name'))
 
+    @fudge.test
+    def test_can_create_session_with_another_client_class(self):
+        client_class = (fudge.Fake().expects_call()
+                                    .with_args(pool_id='mydb',
+                                               host="should_be_host",
+                                               port="should_be_port",
+                                               dbname="should_be_dbname")
+                                    .returns("shouldBeMemorySession"))
+
+        session.Session.create(host="should_be_host",
+                               port="should_be_port",
+                               dbname="should_be_dbname",
+                               client_class=client_class)
+        self.assertEquals(session.Session(), "shouldBeMemorySession")
+
+    def test_sessions_are_created_per_alias(self):
+        client_class = fudge.Fake().is_callable().calls(lambda **kwargs: kwargs)
+
+        session.Session.create(host="host", port="port", dbname="main", client_class=client_class)
+        session.Session.create(host="other_host", port="port", dbname="archive",
+                               client_class=client_class, alias="archive")
+        self.addCleanup(session.Session._sessions.clear)
+
+        self.assertEquals('mydb', session.Session()['pool_id'])
+        self.assertEquals('mydb_archive', session.Session(alias='archive')['pool_id'])
+        self.assertEquals('other_host', session.Session(alias='archive')['host'])
+        self.assertEquals(['default', 'archive'], session.Session.aliases())
+
+    def test_raise_value_error_when_alias_is_not_created(self):
+        with self.assertRaises(ValueError):
+            session.Session(alias='missing')
+
+    @fudge.test
+    def test_can_get_collection_of_another_database(self):
+        client = fudge.Fake().expects('connection').with_args('collection_name', 'archive').returns('should_be_collection')
+        session.Session._session = client
+        self.assertEquals('should_be_collection', session.Session('collection_name', dbname='archive'))
+
+
+
+class ForkTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        session.Session._session = None
+        session.Session.create('localhost', 27017, 'test', client_class=memory.MemoryClient)
+        session.Session.create('localhost', 27017, 'archive', client_class=memory.MemoryClient, alias='archive')
+
+    def tearDown(self):
+        session.Session.destroy('archive')
+        session.Session.destroy()
+
+    def test_after_fork_rebuilds_every_session(self):
+        default, archive = session.Session(), session.Session(alias='archive')
+        self.addCleanup(setattr, ConnectionPools, '_pools', getattr(ConnectionPools, '_pools', {}))
+        other = object()
+        ConnectionPools._pools = {'mydb': default._pool, 'mydb_archive': archive._pool, 'other': other}
+
+        session.Session.after_fork()
+
+        self.assertIsNot(default, session.Session())
+        self.assertIsNot(archive, session.Session(alias='archive'))
+        self.assertEqual('archive', session.Session(alias='archive')._pool._dbname)
+        self.assertEqual({'other': other}, ConnectionPools._pools)
+
+    def test_sessions_are_rebuilt_on_first_use_in_a_child_process(self):
+        parent = session.Session()
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if session.Session() is not parent else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(0, os.WEXITSTATUS(status))
+        self.assertIs(parent, session.Session())
+
+    def test_sessions_can_be_created_before_fork_processes(self):
+        pid = os.fork()
+        if pid == 0:
+            # a fresh process, with an IOLoop nobody has asked for yet
+            if hasattr(IOLoop, '_instance'):
+                del IOLoop._instance
+            fudge.patch_object(asyncmongo_pool, 'Connection', FakeConnection)
+            try:
+                session.Session.create_replica_set(['db1:27017', 'db2:27017'], 'test',
+                                                   client_class=memory.MemoryClient, alias='rs')
+                session.Session.create('localhost', 27017, 'test', client_class=pool.MonitoredClient,
+                                       alias='warm', warm_up=2)
+                self.assertFalse(IOLoop.initialized())
+                if process.fork_processes(2, max_restarts=0) is not None:
+                    client = session.Session(alias='rs')
+                    started = isinstance(client, replicaset.ReplicaSetClient) and client._started
+                    warmed = session.Session.pool_stats('warm')['opened'] == 2
+                    os._exit(0 if started and warmed and IOLoop.initialized() else 1)
+            except BaseException:
+                os._exit(2)
+            # the parent gets there once every worker exited with 0
+            os._exit(0)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(0, os.WEXITSTATUS(status))
+
+
+class RouteTestCase(unittest2.TestCase):
+
+    def tearDown(self):
+        session.Session.set_router(None)
+
+    def test_route_is_empty_for_a_plain_model(self):
+        class Model(object):
+            pass
+        self.assertEquals({}, session.route(Model, 'find'))
+
+    def test_route_uses_model_session_and_database(self):
+        class Model(object):
+            __session__ = 'archive'
+            __database__ = 'history'
+        self.assertEquals({'alias': 'archive', 'dbname': 'history'}, session.route(Model, 'find'))
+
+    def test_router_takes_precedence_over_model_session(self):
+        class Model(object):
+            __session__ = 'archive'
+        session.Session.set_router(lambda model, operation: 'reports' if operation == 'count' else None)
+        self.assertEquals({'alias': 'reports'}, session.route(Model, 'count'))
+        self.assertEquals({'alias': 'archive'}, session.route(Model, 'find'))
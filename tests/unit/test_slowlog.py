@@ -0,0 +1,80 @@
+import fudge
+import unittest2
+from bson import ObjectId
+from asyncmongoorm import metrics
+from asyncmongoorm import slowlog
+
+class FakeModel(object):
+    __collection__ = 'some_collection'
+
+def make_operation(name, query, elapsed, documents=0, **options):
+    operation = metrics.Operation(FakeModel, name, query, options)
+    operation.finished = operation.started + elapsed
+    operation.documents = documents
+    return operation
+
+
+class SlowQueryLogTestCase(unittest2.TestCase):
+
+    def tearDown(self):
+        slowlog.disable()
+
+    def test_shape_replaces_values_with_placeholders(self):
+        query = {'name': 'john', 'age': {'$gt': 18, '$lt': 65},
+                 '$or': [{'tag': 'a'}, {'tags': {'$in': ['b', 'c']}}]}
+        expected = {'name': '?', 'age': {'$gt': '?', '$lt': '?'},
+                    '$or': [{'tag': '?'}, {'tags': {'$in': '?'}}]}
+        self.assertEqual(expected, slowlog.shape(query))
+
+    def test_shape_of_bare_id_and_empty_query(self):
+        self.assertEqual({'_id': '?'}, slowlog.shape(ObjectId()))
+        self.assertEqual({}, slowlog.shape(None))
+        self.assertEqual(slowlog.shape_key({'a': 1, 'b': 2}), slowlog.shape_key({'b': 3, 'a': 4}))
+
+    def test_aggregates_queries_per_shape(self):
+        log = slowlog.SlowQueryLog(threshold=10)
+        log.record(make_operation('find', {'name': 'a'}, 0.01, documents=2))
+        log.record(make_operation('find', {'name': 'b'}, 0.03, documents=1))
+        log.record(make_operation('count', {'age': {'$gt': 1}}, 0.001))
+
+        shapes = log.shapes()
+        self.assertEqual(2, len(shapes))
+        self.assertEqual('find', shapes[0]['operation'])
+        self.assertEqual('{"name": "?"}', shapes[0]['shape'])
+        self.assertEqual(2, shapes[0]['count'])
+        self.assertEqual(3, shapes[0]['documents'])
+        self.assertAlmostEqual(0.02, shapes[0]['mean_time'])
+        self.assertEqual(0, shapes[0]['slow'])
+
+    def test_ignores_operations_that_are_not_reads(self):
+        log = slowlog.SlowQueryLog(threshold=0)
+        log.record(make_operation('insert', None, 1))
+        self.assertEqual([], log.shapes())
+
+    @fudge.test
+    def test_logs_slow_queries_above_threshold(self):
+        logger = fudge.Fake('logger').expects('warning').times_called(1)
+        log = slowlog.SlowQueryLog(threshold=0.05, logger=logger)
+
+        log.record(make_operation('find', {'name': 'a'}, 0.01))
+        log.record(make_operation('find', {'name': 'a'}, 0.1, fields=['name'], sort=[('name', 1)], limit=10))
+
+        self.assertEqual(1, log.shapes()[0]['slow'])
+
+    @fudge.test
+    def test_sample_rate_limits_logged_queries(self):
+        logger = fudge.Fake('logger').provides('warning').times_called(0)
+        log = slowlog.SlowQueryLog(threshold=0, sample_rate=0.0, logger=logger)
+        log.record(make_operation('find', {'name': 'a'}, 0.1))
+        self.assertEqual(1, log.shapes()[0]['slow'])
+
+    def test_enable_attaches_a_single_log_as_metrics_sink(self):
+        first = slowlog.enable(threshold=1)
+        second = slowlog.enable(threshold=2)
+        self.assertNotIn(first, metrics._sinks)
+        self.assertIn(second, metrics._sinks)
+        self.assertIs(second, slowlog.current())
+
+        slowlog.disable()
+        self.assertNotIn(second, metrics._sinks)
+        self.assertIsNone(slowlog.current())
@@ -0,0 +1,119 @@
+import fudge
+import unittest2
+from bson import ObjectId
+from tornado import gen
+from tornado import testing
+from tornado import web
+from asyncmongoorm import memory
+from asyncmongoorm import tracker
+from asyncmongoorm.collection import Collection
+from asyncmongoorm.field import ObjectIdField, StringField
+from asyncmongoorm.session import Session
+
+class TrackedModel(Collection):
+    __collection__ = 'tracked_model'
+    _id = ObjectIdField()
+    name = StringField()
+
+
+class QueryTrackerTestCase(testing.AsyncTestCase, unittest2.TestCase):
+
+    def setUp(self):
+        super(QueryTrackerTestCase, self).setUp()
+        memory.MemoryClient.reset()
+        Session._session = None
+        Session.create('localhost', 27017, 'test', client_class=memory.MemoryClient, io_loop=self.io_loop)
+
+    def tearDown(self):
+        Session.destroy()
+        super(QueryTrackerTestCase, self).tearDown()
+
+    @gen.engine
+    def _lookups(self, ids, callback):
+        yield gen.Task(TrackedModel.objects.find, {})
+        for _id in ids:
+            yield gen.Task(TrackedModel.objects.find_one, {'_id': _id})
+        callback()
+
+    def test_counts_queries_issued_in_scope_and_its_callbacks(self):
+        query_tracker = tracker.QueryTracker()
+        with query_tracker.scope():
+            self._lookups([ObjectId(), ObjectId()], callback=self.stop)
+        self.wait()
+
+        TrackedModel.objects.count(callback=self.stop)
+        self.wait()
+
+        self.assertEqual(3, query_tracker.count)
+        self.assertEqual({'tracked_model.find': 1, 'tracked_model.find_one': 2},
+                         query_tracker.report()['operations'])
+
+    def test_flags_find_one_by_id_in_a_loop(self):
+        query_tracker = tracker.QueryTracker(n_plus_one_threshold=3)
+        with query_tracker.scope():
+            self._lookups([ObjectId() for i in range(4)], callback=self.stop)
+        self.wait()
+
+        suspects = query_tracker.report()['n_plus_one']
+        self.assertEqual(1, len(suspects))
+        self.assertEqual('tracked_model', suspects[0]['model'])
+        self.assertEqual(4, suspects[0]['calls'])
+
+    def test_same_id_repeated_is_not_flagged(self):
+        query_tracker = tracker.QueryTracker(n_plus_one_threshold=3)
+        _id = ObjectId()
+        with query_tracker.scope():
+            self._lookups([_id] * 4, callback=self.stop)
+        self.wait()
+
+        self.assertEqual([], query_tracker.report()['n_plus_one'])
+
+    def test_raises_when_budget_is_exceeded(self):
+        query_tracker = tracker.QueryTracker(budget=1, raise_on_budget=True)
+        with query_tracker.scope():
+            TrackedModel.objects.find({}, callback=self.stop)
+            self.wait()
+            with self.assertRaises(tracker.QueryBudgetExceeded):
+                TrackedModel.objects.find({}, callback=self.stop)
+
+    @fudge.test
+    def test_report_logs_when_over_budget(self):
+        logger = fudge.Fake('logger').expects('warning')
+        query_tracker = tracker.QueryTracker(budget=0, logger=logger)
+        with query_tracker.scope():
+            TrackedModel.objects.find({}, callback=self.stop)
+        self.wait()
+
+        self.assertTrue(query_tracker.over_budget)
+        self.assertEqual(1, query_tracker.report()['queries'])
+
+
+class TrackedHandler(tracker.QueryTrackingMixin, web.RequestHandler):
+
+    query_budget = 5
+
+    @web.asynchronous
+    @gen.engine
+    def get(self):
+        yield gen.Task(TrackedModel.objects.find, {})
+        yield gen.Task(TrackedModel.objects.count)
+        self.finish(str(self.query_tracker.count))
+
+
+class QueryTrackingMixinTestCase(testing.AsyncHTTPTestCase, unittest2.TestCase):
+
+    def setUp(self):
+        super(QueryTrackingMixinTestCase, self).setUp()
+        Session._session = None
+        Session.create('localhost', 27017, 'test', client_class=memory.MemoryClient, io_loop=self.io_loop)
+
+    def tearDown(self):
+        Session.destroy()
+        super(QueryTrackingMixinTestCase, self).tearDown()
+
+    def get_app(self):
+        return web.Application([('/', TrackedHandler)])
+
+    def test_tracks_queries_of_each_request(self):
+        self.assertEqual('2', self.fetch('/').body)
+        self.assertEqual('2', self.fetch('/').body)
@@ -0,0 +1,141 @@
+import time
+import unittest2
+from tornado import testing
+from asyncmongoorm import memory
+from asyncmongoorm import metrics
+from asyncmongoorm import writebehind
+from asyncmongoorm.collection import Collection
+from asyncmongoorm.field import IntegerField, ObjectIdField, StringField
+from asyncmongoorm.session import Session
+
+class Counter(Collection):
+    __collection__ = 'counter'
+    _id = ObjectIdField()
+    name = StringField()
+    views = IntegerField()
+
+
+class Uncounted(Collection):
+    __collection__ = 'uncounted'
+    __write_behind__ = False
+    _id = ObjectIdField()
+
+
+class WriteBehindTestCase(testing.AsyncTestCase, unittest2.TestCase):
+
+    def setUp(self):
+        super(WriteBehindTestCase, self).setUp()
+        memory.MemoryClient.reset()
+        Session._session = None
+        Session.create('localhost', 27017, 'test', client_class=memory.MemoryClient, io_loop=self.io_loop)
+        self.errors = []
+        self.buffer = writebehind.enable(interval=0.01, max_pending=3, io_loop=self.io_loop,
+                                         on_error=lambda *args: self.errors.append(args))
+        self.counter = Counter()
+        self.counter.name = u'home'
+        self.counter.views = 0
+        self.counter.save(callback=self.stop)
+        self.wait()
+
+    def tearDown(self):
+        writebehind.disable()
+        metrics.clear_sinks()
+        Session.destroy()
+        super(WriteBehindTestCase, self).tearDown()
+
+    def reload(self):
+        Counter.objects.find_one({'_id': self.counter._id}, callback=self.stop)
+        return self.wait()
+
+    def test_updates_of_a_document_are_coalesced(self):
+        for _ in range(5):
+            Counter.objects.update_later(self.counter._id, increments={'views': 1})
+        Counter.objects.update_later(self.counter._id, values={'name': u'index'})
+        self.buffer.flush(callback=self.stop)
+        self.wait()
+
+        counter = self.reload()
+        self.assertEqual((u'index', 5), (counter.name, counter.views))
+        stats = self.buffer.stats()
+        self.assertEqual((6, 5, 1, 1), (stats['writes'], stats['coalesced'], stats['flushes'], stats['flushed']))
+
+    def test_set_after_increment_wins_and_increment_after_set_adds(self):
+        Counter.objects.update_later(self.counter._id, increments={'views': 3})
+        Counter.objects.update_later(self.counter._id, values={'views': 10})
+        Counter.objects.update_later(self.counter._id, increments={'views': 2})
+        self.buffer.flush(callback=self.stop)
+        self.wait()
+        self.assertEqual(12, self.reload().views)
+
+    def test_increment_after_a_set_to_a_non_number_is_a_second_update(self):
+        Counter.objects.update_later(self.counter._id, values={'name': u'reset', 'views': None})
+        Counter.objects.update_later(self.counter._id, increments={'views': 2})
+        self.buffer.flush(callback=self.stop)
+        self.wait()
+        counter = self.reload()
+        self.assertEqual(u'reset', counter.name)
+        self.assertEqual(2, self.buffer.stats()['flushed'])
+        # as on a server, null can not be incremented; the $set still went through
+        self.assertEqual([{'$inc': {'views': 2}}], [update for _, _, update, _ in self.errors])
+
+    def test_updates_wait_for_the_ones_in_flight_on_the_same_document(self):
+        Counter.objects.update_later(self.counter._id, values={'views': None})
+        Counter.objects.update_later(self.counter._id, increments={'views': 2})
+        flushed = []
+        self.buffer.flush(callback=lambda: flushed.append(1))
+        # the $inc is still to be sent when the next flush comes
+        Counter.objects.update_later(self.counter._id, values={'views': 7})
+        self.buffer.flush(callback=self.stop)
+        self.assertEqual(1, self.buffer.stats()['pending'])
+        self.wait()
+        self.assertEqual([1], flushed)
+        self.assertEqual(0, self.buffer.stats()['pending'])
+        self.assertEqual(7, self.reload().views)
+
+    def test_increments_must_be_numbers(self):
+        for amount in (True, u'1', None):
+            with self.assertRaises(ValueError):
+                Counter.objects.update_later(self.counter._id, increments={'views': amount})
+        Counter.objects.update_later(self.counter._id, values={'views': False})
+        Counter.objects.update_later(self.counter._id, increments={'views': 1})
+        self.assertEqual(2, len(self.buffer._pending.values()[0]))
+
+    def test_pending_updates_are_flushed_on_a_timer(self):
+        Counter.objects.update_later(self.counter._id, increments={'views': 1})
+        self.io_loop.add_timeout(time.time() + 0.05, self.stop)
+        self.wait()
+        self.assertEqual(1, self.reload().views)
+
+    def test_max_pending_documents_trigger_a_flush(self):
+        for name in (u'a', u'b', u'c'):
+            Counter.objects.update_later(name, values={'name': name})
+        self.assertEqual(0, self.buffer.stats()['pending'])
+        self.assertEqual(1, self.buffer.flushes)
+
+    def test_save_later_buffers_changed_fields(self):
+        self.counter.name = u'renamed'
+        self.counter.save_later()
+        self.assertEqual(u'home', self.reload().name)
+        self.assertEqual(set(), self.counter._changed_fields)
+        writebehind.shutdown(callback=self.stop)
+        self.wait()
+        self.assertEqual(u'renamed', self.reload().name)
+
+    def test_failed_update_is_handed_to_the_error_hook(self):
+        sink = metrics.HistogramSink()
+        metrics.add_sink(sink)
+        Counter.objects.update_later(self.counter._id, values={'_id': u'other'})
+        self.buffer.flush(callback=self.stop)
+        self.wait()
+        self.assertEqual(1, len(self.errors))
+        model, _id, update, error = self.errors[0]
+        self.assertEqual((Counter, self.counter._id), (model, _id))
+        self.assertEqual({'$set': {'_id': u'other'}}, update)
+        self.assertEqual(1, self.buffer.errors)
+        self.assertEqual(1, sink.snapshot()['counter']['update']['errors'])
+
+    def test_models_can_opt_out(self):
+        with self.assertRaises(ValueError):
+            Uncounted.objects.update_later(1, values={'a': 1})
+        with self.assertRaises(ValueError):
+            Counter().save_later()
@@ -0,0 +1,206 @@
+import struct
+import bson
+import fudge
+import unittest2
+from fudge.inspector import arg
+from tornado import testing
+from asyncmongo.cursor import Cursor
+from asyncmongo.errors import DatabaseError, IntegrityError, TooManyConnections
+from asyncmongo.pool import ConnectionPool
+from asyncmongoorm import memory
+from asyncmongoorm import writeconcern
+from asyncmongoorm.collection import Collection
+from asyncmongoorm.field import ObjectIdField, StringField
+from asyncmongoorm.session import Session
+
+class RecordingConnection(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, message, callback):
+        self.sent.append((message, callback))
+
+
+class RecordingPool(ConnectionPool):
+
+    def __init__(self):
+        super(RecordingPool, self).__init__()
+        self.recording = RecordingConnection()
+
+    def connection(self):
+        return self.recording
+
+
+def opcodes(data):
+    codes = []
+    while data:
+        length, _, _, opcode = struct.unpack('<iiii', data[:16])
+        codes.append(opcode)
+        data = data[length:]
+    return codes
+
+
+def command(data):
+    """Collection name and command document of a query message."""
+    name, _, rest = data[20:].partition('\x00')
+    return name, bson.BSON(rest[8:]).decode()
+
+
+class AuditEntry(Collection):
+    __collection__ = 'audit_entry'
+    __write_concern__ = writeconcern.UNACKNOWLEDGED
+    _id = ObjectIdField()
+    action = StringField()
+
+
+class WriteConcernTestCase(unittest2.TestCase):
+
+    def test_get_last_error_options(self):
+        self.assertEqual({}, writeconcern.ACKNOWLEDGED.options())
+        self.assertEqual({'j': True}, writeconcern.JOURNALED.options())
+        self.assertEqual({'w': 2, 'wtimeout': 100}, writeconcern.WriteConcern(w=2, wtimeout=100).options())
+        self.assertFalse(writeconcern.UNACKNOWLEDGED.acknowledged)
+
+    @fudge.test
+    def test_acknowledged_write_passes_options_to_get_last_error(self):
+        insert = fudge.Fake('insert').expects_call().with_args({'a': 1}, safe=True, w=2, callback=arg.any())
+        writeconcern.WriteConcern(w=2).write(insert, {'a': 1}, safe=True, callback=lambda *a, **kw: None)
+
+    @fudge.test
+    def test_unacknowledged_write_calls_back_at_once(self):
+        insert = fudge.Fake('insert').expects_call().with_args({'a': 1}, safe=False)
+        replies = []
+        writeconcern.UNACKNOWLEDGED.write(insert, {'a': 1}, safe=True,
+                                          callback=lambda *args, **kwargs: replies.append(kwargs))
+        self.assertEqual([{'error': None}], replies)
+
+
+class GroupCommitTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.pool = RecordingPool()
+        self.cursor = Cursor('test', 'audit_entry', self.pool)
+        self.replies = []
+
+    def reply(self, *args, **kwargs):
+        self.replies.append((args, kwargs))
+
+    def sent(self):
+        (request_id, data), acknowledge = self.pool.recording.sent[-1]
+        self.assertEqual([2004], opcodes(data))
+        return command(data) + (acknowledge,)
+
+    def test_consecutive_writes_of_a_kind_share_a_command(self):
+        group = writeconcern.GroupCommit(j=True, max_batch=4)
+        group.write(self.cursor.insert, {'a': 1}, safe=True, callback=self.reply)
+        group.write(self.cursor.insert, [{'a': 2}, {'a': 3}], safe=True, callback=self.reply)
+        group.write(self.cursor.update, {'a': 1}, {'$set': {'b': 2}}, safe=True, callback=self.reply)
+        self.assertEqual([], self.pool.recording.sent)
+        group.write(self.cursor.remove, {'a': 1}, callback=self.reply)
+
+        namespace, sent, acknowledge = self.sent()
+        self.assertEqual('test.$cmd', namespace)
+        self.assertEqual(['insert', 'documents', 'ordered', 'writeConcern'], sent.keys())
+        self.assertEqual(('audit_entry', [{'a': 1}, {'a': 2}, {'a': 3}], False, {'j': True}),
+                         (sent['insert'], sent['documents'], sent['ordered'], sent['writeConcern']))
+        acknowledge({'data': [{'ok': 1.0, 'n': 3}]})
+        self.assertEqual(2, len(self.replies))
+        self.assertEqual({'error': None}, self.replies[0][1])
+
+        # the next kind of write goes once the previous one is acknowledged
+        _, sent, acknowledge = self.sent()
+        self.assertEqual([{'q': {'a': 1}, 'u': {'$set': {'b': 2}}, 'upsert': False, 'multi': False}],
+                         sent['updates'])
+        acknowledge({'data': [{'ok': 1.0, 'n': 1, 'nModified': 1}]})
+        _, sent, acknowledge = self.sent()
+        self.assertEqual([{'q': {'a': 1}, 'limit': 0}], sent['deletes'])
+        acknowledge({'data': [{'ok': 1.0, 'n': 1}]})
+        self.assertEqual(4, len(self.replies))
+        self.assertEqual(3, len(self.pool.recording.sent))
+        self.assertEqual((4, 1), (group.writes, group.batches))
+
+    def test_each_writer_gets_the_error_of_its_own_write(self):
+        group = writeconcern.GroupCommit(max_batch=3)
+        group.write(self.cursor.insert, {'a': 1}, callback=self.reply)
+        group.write(self.cursor.insert, [{'a': 1}, {'a': 2}], callback=self.reply)
+        group.write(self.cursor.insert, {'a': 3}, callback=self.reply)
+
+        _, sent, acknowledge = self.sent()
+        self.assertNotIn('writeConcern', sent)
+        acknowledge({'data': [{'ok': 1.0, 'n': 3, 'writeErrors': [
+            {'index': 1, 'code': 11000, 'errmsg': 'E11000 duplicate key'}]}]})
+        self.assertEqual([{'error': None}, None, {'error': None}],
+                         [None if kwargs['error'] else kwargs for _, kwargs in self.replies])
+        self.assertIsInstance(self.replies[1][1]['error'], IntegrityError)
+        self.assertEqual(11000, self.replies[1][1]['error'].code)
+
+    def test_a_failed_command_fails_its_writers(self):
+        group = writeconcern.GroupCommit(w=2, max_batch=2)
+        group.write(self.cursor.insert, {'a': 1}, callback=self.reply)
+        group.write(self.cursor.insert, {'a': 2}, callback=self.reply)
+        acknowledge = self.sent()[2]
+        acknowledge({'data': [{'ok': 1.0, 'n': 2, 'writeConcernError': {'code': 64, 'errmsg': 'waiting timed out'}}]})
+        self.assertEqual(2, len(self.replies))
+        self.assertIsInstance(self.replies[0][1]['error'], DatabaseError)
+
+    def test_a_batch_that_can_not_be_sent_fails_every_writer(self):
+        def exhausted():
+            raise TooManyConnections("too many connections")
+        self.pool.connection = exhausted
+        group = writeconcern.GroupCommit(max_batch=2)
+        group.write(self.cursor.insert, {'a': 1}, callback=self.reply)
+        group.write(self.cursor.insert, {'a': 2}, callback=self.reply)
+        self.assertEqual(2, len(self.replies))
+        self.assertIsInstance(self.replies[0][1]['error'], TooManyConnections)
+
+        del self.pool.connection
+        def dead_socket(message, callback):
+            raise IOError("connection reset")
+        self.pool.recording.send_message = dead_socket
+        self.pool.recording.close = lambda: setattr(self.pool.recording, 'closed', True)
+        group.write(self.cursor.insert, {'a': 3}, callback=self.reply)
+        group.write(self.cursor.insert, {'a': 4}, callback=self.reply)
+        self.assertEqual(4, len(self.replies))
+        self.assertIsInstance(self.replies[3][1]['error'], IOError)
+        self.assertTrue(self.pool.recording.closed)
+
+
+class GroupCommitFlushTestCase(testing.AsyncTestCase, unittest2.TestCase):
+
+    def test_pending_writes_are_flushed_on_the_next_iteration(self):
+        pool = RecordingPool()
+        cursor = Cursor('test', 'audit_entry', pool)
+        group = writeconcern.GroupCommit(io_loop=self.io_loop)
+        group.write(cursor.insert, {'a': 1}, callback=lambda *args, **kwargs: None)
+        group.write(cursor.insert, {'a': 2}, callback=lambda *args, **kwargs: None)
+        self.io_loop.add_callback(self.stop)
+        self.wait()
+        self.assertEqual(1, len(pool.recording.sent))
+        self.assertEqual([{'a': 1}, {'a': 2}], command(pool.recording.sent[0][0][1])[1]['documents'])
+
+
+class CollectionWriteConcernTestCase(testing.AsyncTestCase, unittest2.TestCase):
+
+    def setUp(self):
+        super(CollectionWriteConcernTestCase, self).setUp()
+        memory.MemoryClient.reset()
+        Session._session = None
+        Session.create('localhost', 27017, 'test', client_class=memory.MemoryClient, io_loop=self.io_loop)
+
+    def tearDown(self):
+        Session.destroy()
+        super(CollectionWriteConcernTestCase, self).tearDown()
+
+    def test_model_and_call_write_concerns(self):
+        entry = AuditEntry()
+        entry.action = u'login'
+        entry.save(callback=self.stop)
+        self.assertEqual({'error': None}, self.wait())
+
+        entry.action = u'logout'
+        entry.save(callback=self.stop, write_concern=writeconcern.GroupCommit(j=True))
+        self.assertEqual({'error': None}, self.wait())
+
+        AuditEntry.objects.find({'action': 'logout'}, callback=self.stop)
+        self.assertEqual(1, len(self.wait()))